@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+How long does it take to build (and sign) a full batch of scrobbles? Compares building the request from a dict of
+parameters, signed with sign_signature (how every batch used to be built), against encode_scrobbles on freshly queued
+scrobbles and on ones that have been tried before (whose fragments are already encoded).
+
+Run from the repository root:
+
+    python benchmarks/request_build.py [--batches N]
+"""
+
+import argparse
+import os
+import sys
+import time
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from yams.record import Scrobble  # noqa: E402
+from yams.scrobble import (  # noqa: E402
+    MAX_TRACKS_PER_SCROBBLE,
+    encode_scrobbles,
+    sign_signature,
+)
+
+API_KEY = "293ef0836603c5c8023ba86eb413794b"
+API_SECRET = "e952c611efe32c66f2b48a93b39d6219"
+SESSION_KEY = "0123456789abcdef0123456789abcdef"
+
+
+def make_batch(offset=0):
+    """ A full batch of scrobbles off the same album, with every field set """
+
+    return [
+        Scrobble(
+            artist="Sigur Rós",
+            track="Track {} – Ágætis byrjun".format(i),
+            timestamp=1600000000 + offset + i * 300,
+            album="Ágætis byrjun",
+            trackNumber=str(i % 12 + 1),
+            albumArtist="Sigur Rós",
+            duration=300,
+        )
+        for i in range(MAX_TRACKS_PER_SCROBBLE)
+    ]
+
+
+def build_from_dict(tracks):
+    parameters = {"method": "track.scrobble", "api_key": API_KEY, "sk": SESSION_KEY}
+    for i, track in enumerate(tracks):
+        for field, value in track.items():
+            parameters["{}[{}]".format(field, i)] = value
+    parameters["api_sig"] = sign_signature(parameters, API_SECRET)
+    return urlencode(parameters).encode("ascii")
+
+
+def build_encoded(tracks):
+    return encode_scrobbles(tracks, API_KEY, API_SECRET, SESSION_KEY)
+
+
+def measure(name, build, batches):
+    start = time.perf_counter()
+    for batch in batches:
+        build(batch)
+    elapsed = time.perf_counter() - start
+    print(
+        "{:<32} {:>8.1f} µs per batch of {}".format(
+            name, elapsed / len(batches) * 1e6, MAX_TRACKS_PER_SCROBBLE
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--batches", type=int, default=2000)
+    args = parser.parse_args()
+
+    batches = [make_batch(offset) for offset in range(args.batches)]
+
+    # Both ways of building a request have to come up with the same one
+    assert sorted(build_from_dict(batches[0]).split(b"&")) == sorted(
+        build_encoded(make_batch()).split(b"&")
+    )
+
+    measure("dict + sign_signature", build_from_dict, batches)
+    measure("encode_scrobbles (first try)", build_encoded, batches)
+    measure("encode_scrobbles (retry)", build_encoded, batches)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,11 +35,11 @@ setup(
     entry_points={"console_scripts": ["yams = yams.__main__:main"]},
     # Dependent packages (distributions)
     install_requires=[
-        "python-mpd2>=1.0.0",
+        "python-mpd2>=3.0.2",
         "PyYAML>=5.1",
         "requests>=2.21.0",
         "psutil>=5.6.3",
     ],
-    python_requires=">=3",
+    python_requires=">=3.7",
     zip_safe=False,
 )
@@ -0,0 +1,90 @@
+import pytest
+
+from yams import backoff
+from yams.backoff import (
+    CIRCUIT_CLOSED,
+    CIRCUIT_HALF_OPEN,
+    CIRCUIT_OPEN,
+    Backoff,
+    CircuitBreaker,
+)
+from tests.util import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(backoff, "time", clock)
+    return clock
+
+
+def make_breaker():
+    return CircuitBreaker("Last.FM", 3, Backoff(10, 100))
+
+
+def test_delay_is_jittered_and_capped():
+    delays = Backoff(10, 100)
+    for attempt, ceiling in [(0, 10), (1, 20), (2, 40), (5, 100)]:
+        for _ in range(20):
+            assert ceiling / 2 <= delays.delay(attempt) <= ceiling
+
+
+def test_opens_after_threshold(clock):
+    breaker = make_breaker()
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CIRCUIT_CLOSED and breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert not breaker.allow()
+    assert 5 <= breaker.retry_in() <= 10
+
+    # Requests that were already under way don't reopen it
+    retry_at = breaker.retry_at
+    breaker.record_failure()
+    assert breaker.retry_at == retry_at
+
+
+def test_half_open_probe(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.sleep(10)
+    assert breaker.ready()
+    assert breaker.allow()
+    assert breaker.state == CIRCUIT_HALF_OPEN
+    # Only one probe at a time
+    assert not breaker.ready()
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == CIRCUIT_CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_backs_off_for_longer(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.sleep(10)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CIRCUIT_OPEN
+    assert 10 <= breaker.retry_in() <= 20
+
+
+def test_released_probe_can_be_claimed_again(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record_failure()
+
+    clock.sleep(10)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == CIRCUIT_OPEN
+    # Released, not failed: no extra backoff
+    assert breaker.retry_in() == 0
+    assert breaker.allow()
@@ -0,0 +1,62 @@
+import io
+import json
+
+from yams import bulk
+from yams.configure import DEFAULTS
+from tests.util import make_scrobbles, open_cache, tracks
+
+
+def jsonl(records):
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def test_read_jsonl_skips_bad_lines():
+    scrobbles = make_scrobbles(3)
+    stream = io.StringIO(
+        jsonl(scrobbles[:1])
+        + '{"artist": "Artist", "track": \n'
+        + "\n"
+        + "[1, 2]\n"
+        + jsonl(scrobbles[1:])
+    )
+    progress = bulk.BulkProgress("Imported")
+
+    assert list(bulk.read_scrobbles(stream, "jsonl", progress)) == scrobbles
+    assert progress.counts == {"skipped": 2}
+
+
+def test_read_csv_translates_field_names():
+    stream = io.StringIO(
+        "Artist,Title,Timestamp,Album,Comment\nArtist,Track,1000.5,,Great\n"
+    )
+
+    assert list(bulk.read_scrobbles(stream, "csv")) == [
+        {"artist": "Artist", "track": "Track", "timestamp": 1000}
+    ]
+
+
+def test_export_then_import(tmp_path, monkeypatch):
+    submitted = []
+
+    def scrobble_tracks(tracks, *args, **kwargs):
+        submitted.extend(tracks)
+        return list(tracks), [], []
+
+    monkeypatch.setattr(bulk, "scrobble_tracks", scrobble_tracks)
+    path = str(tmp_path / "backlog.jsonl")
+
+    cache = open_cache(tmp_path, "journal")
+    cache.extend(make_scrobbles(120))
+    bulk.export_scrobbles(cache, path)
+    cache.close()
+    with open(path, "a") as backlog:
+        backlog.write("not json\n")
+        backlog.write(jsonl(make_scrobbles(1, start=120)))
+
+    config = dict(DEFAULTS, base_url="http://lastfm", api_key="key", api_secret="s")
+    cache = open_cache(tmp_path, "sqlite")
+    bulk.import_scrobbles(path, "session", config, cache)
+    cache.close()
+
+    assert len(tracks(submitted)) == 121
+    assert tracks(submitted)[-1] == "Track 120"
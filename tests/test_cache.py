@@ -0,0 +1,167 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from yams.cache import CACHE_BACKENDS, SCROBBLE_MAX_AGE, save_failed_scrobbles_to_disk
+from tests.util import make_scrobbles, open_cache, tracks, wait_for
+
+
+@pytest.mark.parametrize("backend", CACHE_BACKENDS)
+def test_reopen_keeps_queue(tmp_path, backend):
+    cache = open_cache(tmp_path, backend)
+    assert cache.extend(make_scrobbles(5)) == 5
+    cache.truncate(2)
+    cache.remove([make_scrobbles(1, start=3)[0]])
+    cache.close()
+
+    cache = open_cache(tmp_path, backend)
+    assert len(cache) == 2
+    assert tracks(cache) == ["Track 2", "Track 4"]
+    assert cache.pending(1)[0]["track"] == "Track 2"
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite"])
+def test_legacy_cache_imported_once(tmp_path, backend):
+    path = str(tmp_path / "scrobbles.cache")
+    save_failed_scrobbles_to_disk(path, make_scrobbles(3))
+
+    cache = open_cache(tmp_path, backend)
+    wait_for(lambda: os.path.exists(path + ".imported"))
+    assert not os.path.exists(path)
+    assert tracks(cache) == ["Track 0", "Track 1", "Track 2"]
+    cache.close()
+
+    cache = open_cache(tmp_path, backend)
+    assert len(cache) == 3
+    cache.close()
+
+
+def write_partly_readable_cache(path, count):
+    save_failed_scrobbles_to_disk(path, make_scrobbles(count))
+    with open(path, "a") as cache_file:
+        cache_file.write("- {artist: [unterminated\n")
+
+
+def test_yaml_keeps_unreadable_file(tmp_path):
+    path = str(tmp_path / "scrobbles.cache")
+    write_partly_readable_cache(path, 60)
+    with open(path) as cache_file:
+        original = cache_file.read()
+
+    cache = open_cache(tmp_path, "yaml")
+    # Only whole chunks are handed over
+    assert len(cache) == 50
+    cache.append(make_scrobbles(1, start=60)[0])
+    cache.close()
+
+    with open(path + ".unreadable") as backup:
+        assert backup.read() == original
+    cache = open_cache(tmp_path, "yaml")
+    assert len(cache) == 51
+    cache.close()
+
+
+def test_yaml_left_alone_if_it_cant_be_backed_up(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise PermissionError("read-only directory")
+
+    monkeypatch.setattr(shutil, "copy2", fail)
+    path = str(tmp_path / "scrobbles.cache")
+    write_partly_readable_cache(path, 60)
+    with open(path) as cache_file:
+        original = cache_file.read()
+
+    cache = open_cache(tmp_path, "yaml")
+    # What could be read is still triaged and submitted, the file just isn't written to
+    assert cache.triage() is not None
+    cache.append(make_scrobbles(1, start=60)[0])
+    cache.truncate(49)
+    assert tracks(cache.pending(5)) == ["Track 49", "Track 60"]
+    cache.close()
+
+    with open(path) as cache_file:
+        assert cache_file.read() == original
+
+
+@pytest.mark.parametrize("backend", CACHE_BACKENDS)
+def test_duplicates_rejected_after_reopen(tmp_path, backend):
+    scrobbles = make_scrobbles(3)
+    cache = open_cache(tmp_path, backend)
+    cache.extend(scrobbles)
+    cache.close()
+
+    cache = open_cache(tmp_path, backend)
+    assert scrobbles[0] in cache
+    assert not cache.append(scrobbles[0])
+    assert cache.extend(scrobbles + make_scrobbles(1, start=3)) == 1
+    assert len(cache) == 4
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", CACHE_BACKENDS)
+def test_write_behind_flushes_on_close(tmp_path, backend):
+    cache = open_cache(tmp_path, backend, cache_write_mode="write-behind")
+    for scrobble in make_scrobbles(3):
+        cache.append(scrobble)
+    cache.truncate(1)
+    cache.close()
+
+    cache = open_cache(tmp_path, backend)
+    assert tracks(cache) == ["Track 1", "Track 2"]
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", CACHE_BACKENDS)
+def test_triage_removes_what_lastfm_would_reject(tmp_path, backend):
+    expired = {
+        "artist": "Artist",
+        "track": "Too old",
+        "timestamp": int(time.time()) - SCROBBLE_MAX_AGE - 60,
+    }
+    untitled = dict(make_scrobbles(1, start=9)[0], track="")
+
+    cache = open_cache(tmp_path, backend)
+    cache.extend(make_scrobbles(2) + [expired, untitled])
+    removed = cache.triage()
+    assert removed["expired"] == 1
+    assert removed["malformed"] == 1
+    cache.close()
+
+    cache = open_cache(tmp_path, backend)
+    assert tracks(cache) == ["Track 0", "Track 1"]
+    cache.close()
+
+
+def test_yaml_skips_malformed_entries(tmp_path):
+    path = str(tmp_path / "scrobbles.cache")
+    save_failed_scrobbles_to_disk(
+        path,
+        make_scrobbles(3)
+        + [{"artist": "Artist"}, {"artist": [], "track": "Track", "timestamp": 1}],
+    )
+
+    cache = open_cache(tmp_path, "yaml")
+    assert len(cache) == 3
+    assert cache.skipped == 2
+    cache.close()
+
+
+@pytest.mark.parametrize("backend", ["journal", "sqlite"])
+def test_legacy_cache_skips_malformed_entries(tmp_path, backend):
+    path = str(tmp_path / "scrobbles.cache")
+    save_failed_scrobbles_to_disk(
+        path,
+        make_scrobbles(3)
+        + [
+            {"track": "No artist", "timestamp": 1},
+            dict(artist=[], track="", timestamp=1),
+        ],
+    )
+
+    cache = open_cache(tmp_path, backend)
+    wait_for(lambda: os.path.exists(path + ".imported"))
+    assert tracks(cache) == ["Track 0", "Track 1", "Track 2"]
+    cache.close()
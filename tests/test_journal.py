@@ -0,0 +1,94 @@
+import errno
+import json
+import os
+import time
+
+from yams import journal
+from tests.util import make_scrobbles, open_cache, tracks, wait_for
+
+
+def read_journal(path):
+    with open(path) as journal_file:
+        return [json.loads(line) for line in journal_file]
+
+
+def test_compaction(tmp_path):
+    cache = open_cache(tmp_path, "journal")
+    cache.extend(make_scrobbles(10))
+    cache.truncate(8)
+    cache.compact()
+
+    assert [record["op"] for record in read_journal(cache.path)] == [
+        "enqueue",
+        "enqueue",
+    ]
+
+    # Writes after a compaction go to the compacted journal
+    cache.append(make_scrobbles(1, start=10)[0])
+    cache.close()
+
+    cache = open_cache(tmp_path, "journal")
+    assert tracks(cache) == ["Track 8", "Track 9", "Track 10"]
+    cache.close()
+
+
+def test_compacts_in_background(tmp_path):
+    cache = open_cache(tmp_path, "journal", journal_compact_threshold=5)
+    cache.extend(make_scrobbles(10))
+    cache.truncate(8)
+
+    wait_for(lambda: len(read_journal(cache.path)) == 2)
+    cache.close()
+
+    cache = open_cache(tmp_path, "journal")
+    assert tracks(cache) == ["Track 8", "Track 9"]
+    cache.close()
+
+
+def test_drops_torn_record(tmp_path):
+    cache = open_cache(tmp_path, "journal")
+    cache.extend(make_scrobbles(2))
+    cache.close()
+
+    with open(cache.path, "a") as journal:
+        journal.write('{"op":"enqueue","seq":2,"scr')
+
+    cache = open_cache(tmp_path, "journal")
+    assert tracks(cache) == ["Track 0", "Track 1"]
+    cache.append(make_scrobbles(1, start=2)[0])
+    cache.close()
+
+    cache = open_cache(tmp_path, "journal")
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_failed_compaction_waits_before_retrying(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal, "JOURNAL_COMPACT_RETRY_INTERVAL", 0.2)
+    attempts = []
+    real_replace = os.replace
+
+    def replace(source, destination):
+        if source.endswith(".compact"):
+            attempts.append(source)
+            raise OSError(errno.ENOSPC, "No space left on device")
+        return real_replace(source, destination)
+
+    monkeypatch.setattr(os, "replace", replace)
+    cache = open_cache(tmp_path, "journal", journal_compact_threshold=5)
+    cache.extend(make_scrobbles(10))
+    cache.truncate(8)
+
+    wait_for(lambda: len(attempts) >= 2)
+    time.sleep(0.3)
+    # Once every retry interval, rather than over and over
+    assert len(attempts) <= 4
+    assert not os.path.exists(cache.path + ".compact")
+
+    monkeypatch.setattr(os, "replace", real_replace)
+    wait_for(lambda: len(read_journal(cache.path)) == 2)
+    cache.close()
+
+    cache = open_cache(tmp_path, "journal")
+    assert tracks(cache) == ["Track 8", "Track 9"]
+    cache.close()
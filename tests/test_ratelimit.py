@@ -0,0 +1,59 @@
+import pytest
+
+from yams import ratelimit
+from yams.ratelimit import MIN_RATE, TokenBucket
+from tests.util import FakeClock
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(ratelimit, "time", clock)
+    return clock
+
+
+def test_bursts_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+
+    for _ in range(3):
+        assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0.1)
+
+    assert bucket.acquire()
+    assert clock.now == pytest.approx(1000000.5)
+
+
+def test_refills_at_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    while bucket.acquire(timeout=0):
+        pass
+
+    clock.sleep(1)
+    assert bucket.available() == pytest.approx(2)
+    clock.sleep(10)
+    assert bucket.available() == pytest.approx(3)
+
+
+def test_throttle_empties_bucket_and_halves_rate(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.throttle()
+
+    assert bucket.rate == 1
+    assert bucket.available() == 0
+    assert bucket.acquire()
+    assert clock.now == pytest.approx(1000001)
+
+    for _ in range(10):
+        bucket.throttle()
+    assert bucket.rate == MIN_RATE
+
+
+def test_recovers_gradually(clock):
+    bucket = TokenBucket(rate=2, capacity=3)
+    bucket.throttle()
+
+    bucket.recover()
+    assert bucket.rate == pytest.approx(1.1)
+    for _ in range(100):
+        bucket.recover()
+    assert bucket.rate == 2
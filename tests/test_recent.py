@@ -0,0 +1,86 @@
+import json
+import time
+
+from yams.recent import RECENT_SCROBBLE_WINDOW, RecentScrobbles
+
+
+def make_scrobble(timestamp, track="Track", duration=None):
+    scrobble = {"artist": "Artist", "track": track, "timestamp": timestamp}
+    if duration is not None:
+        scrobble["duration"] = duration
+    return scrobble
+
+
+def test_plays_within_a_track_length_are_duplicates(tmp_path):
+    recent = RecentScrobbles(str(tmp_path / "scrobbles.recent"))
+    recent.add([make_scrobble(1000, duration=180)])
+
+    # e.g. watching the same play again after a reconnect
+    assert make_scrobble(1090, duration=180) in recent
+    # Playing it again straight after it finished is a new play, even if we noticed a little early
+    assert make_scrobble(1000 + 175, duration=180) not in recent
+    assert make_scrobble(1000 - 175, duration=180) not in recent
+    assert make_scrobble(1090, track="Other", duration=180) not in recent
+
+
+def test_short_tracks_get_a_narrower_window(tmp_path):
+    recent = RecentScrobbles(str(tmp_path / "scrobbles.recent"))
+    recent.add([make_scrobble(1000, duration=12)])
+
+    assert make_scrobble(1005, duration=12) in recent
+    assert make_scrobble(1006, duration=12) not in recent
+
+
+def test_unknown_duration_uses_default_window(tmp_path):
+    recent = RecentScrobbles(str(tmp_path / "scrobbles.recent"))
+    recent.add([make_scrobble(1000)])
+
+    assert make_scrobble(1000 + RECENT_SCROBBLE_WINDOW - 60) in recent
+    assert make_scrobble(1000 + RECENT_SCROBBLE_WINDOW) not in recent
+
+
+def test_survives_restart(tmp_path):
+    path = str(tmp_path / "scrobbles.recent")
+    RecentScrobbles(path).add([make_scrobble(1000, duration=180)])
+
+    assert make_scrobble(1000, duration=180) in RecentScrobbles(path)
+
+
+def test_evicts_by_when_accepted(tmp_path):
+    path = str(tmp_path / "scrobbles.recent")
+    now = int(time.time())
+    with open(path, "w") as recent_file:
+        json.dump(
+            [
+                # Played two days ago, but only just accepted (e.g. from a backlog)
+                ["Artist", "Backlog", now - 2 * 86400, 180, now - 60],
+                # Accepted two days ago
+                ["Artist", "Stale", now - 2 * 86400, 180, now - 2 * 86400],
+            ],
+            recent_file,
+        )
+
+    recent = RecentScrobbles(path, max_age=86400)
+    assert len(recent) == 1
+    assert make_scrobble(now - 2 * 86400, track="Backlog") in recent
+    assert make_scrobble(now - 2 * 86400, track="Stale") not in recent
+
+
+def test_evicts_least_recently_seen(tmp_path):
+    recent = RecentScrobbles(str(tmp_path / "scrobbles.recent"), size=2)
+    recent.add([make_scrobble(1000, "A"), make_scrobble(1000, "B")])
+    # Seeing A again makes B the least recently seen
+    assert make_scrobble(1000, "A") in recent
+    recent.add([make_scrobble(1000, "C")])
+
+    assert len(recent) == 2
+    assert make_scrobble(1000, "A") in recent
+    assert make_scrobble(1000, "B") not in recent
+
+
+def test_reads_entries_without_accepted_time(tmp_path):
+    path = str(tmp_path / "scrobbles.recent")
+    with open(path, "w") as recent_file:
+        json.dump([["Artist", "Track", 1000, 180]], recent_file)
+
+    assert make_scrobble(1000) in RecentScrobbles(path)
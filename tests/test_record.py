@@ -0,0 +1,44 @@
+import pytest
+
+from yams.record import Scrobble, as_scrobble, as_scrobbles
+
+
+def test_from_dict_keeps_known_fields():
+    scrobble = Scrobble.from_dict(
+        {"artist": "Artist", "track": "Track", "timestamp": 1000, "file": "a.flac"}
+    )
+    assert dict(scrobble) == {"artist": "Artist", "track": "Track", "timestamp": 1000}
+    assert as_scrobble(scrobble) is scrobble
+
+
+def test_from_dict_takes_first_of_multi_value_tags():
+    scrobble = Scrobble.from_dict(
+        {"artist": ["One", "Two"], "track": "Track", "timestamp": 1000, "album": []}
+    )
+    assert scrobble["artist"] == "One"
+    assert "album" not in scrobble
+
+
+def test_from_dict_rejects_empty_required_tag():
+    with pytest.raises(TypeError):
+        Scrobble.from_dict({"artist": [], "track": "Track", "timestamp": 1000})
+
+
+def test_interns_shared_strings():
+    # Built at runtime, so they start out as different objects
+    first = Scrobble("".join(["Art", "ist"]), "A", 1)
+    second = Scrobble("".join(["Art", "ist"]), "B", 2)
+    assert first["artist"] is second["artist"]
+
+
+def test_as_scrobbles_skips_malformed_entries():
+    scrobbles, skipped = as_scrobbles(
+        [
+            {"artist": "Artist", "track": "Track", "timestamp": 1000},
+            {"artist": "Artist", "timestamp": 1000},
+            {"artist": [], "track": "Track", "timestamp": 1000},
+            None,
+        ]
+    )
+    assert [scrobble["track"] for scrobble in scrobbles] == ["Track"]
+    assert skipped == 3
@@ -0,0 +1,309 @@
+import json
+from urllib.parse import parse_qsl
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from yams import scrobble
+from yams.deadletter import DeadLetters
+from yams.transport import HTTPStatusError
+from tests.util import make_scrobbles
+
+XML_RESPONSE = """<lfm status="ok">
+<scrobbles accepted="1" ignored="2">
+<scrobble><track corrected="0">Track 0</track><ignoredMessage code="0"></ignoredMessage></scrobble>
+<scrobble><track corrected="0">Track 1</track><ignoredMessage code="1">Artist was ignored</ignoredMessage></scrobble>
+<scrobble><track corrected="0">Track 2</track><ignoredMessage code="5">Daily scrobble limit exceeded</ignoredMessage></scrobble>
+</scrobbles>
+</lfm>"""
+
+XML_TOTALS_ONLY = (
+    '<lfm status="ok"><scrobbles accepted="3" ignored="0"></scrobbles></lfm>'
+)
+
+INVALID_PARAMETERS = (
+    '<lfm status="failed"><error code="6">Invalid parameters</error></lfm>'
+)
+
+XML_ERROR = '<lfm status="failed"><error code="9">Invalid session key</error></lfm>'
+
+
+def names(tracks):
+    return [track["track"] for track in tracks]
+
+
+def test_parse_xml_response():
+    response = ET.fromstring(XML_RESPONSE)
+
+    assert scrobble.response_error(response) is None
+    assert scrobble.accepted_count(response) == 1
+    assert scrobble.ignored_codes(response) == [0, 1, 5]
+
+
+def test_parse_xml_totals_only():
+    response = ET.fromstring(XML_TOTALS_ONLY)
+
+    assert scrobble.accepted_count(response) == 3
+    assert scrobble.ignored_codes(response) == []
+
+
+def test_parse_xml_error():
+    response = ET.fromstring(XML_ERROR)
+
+    assert "Invalid session key" in scrobble.response_error(response)
+
+
+@pytest.fixture
+def respond(monkeypatch):
+    """ Have Last.FM respond to the next request with the given (parsed) response """
+
+    def install(response):
+        monkeypatch.setattr(scrobble, "make_request", lambda *args, **kwargs: response)
+
+    return install
+
+
+def post(tracks):
+    return scrobble.post_scrobbles(tracks, "http://lastfm", "key", "secret", "session")
+
+
+def test_post_sorts_scrobbles_by_outcome(respond):
+    respond(ET.fromstring(XML_RESPONSE))
+
+    accepted, ignored, retry = post(make_scrobbles(3))
+
+    assert names(accepted) == ["Track 0"]
+    assert names(ignored) == ["Track 1"]
+    assert names(retry) == ["Track 2"]
+
+
+def test_post_goes_by_totals_when_scrobbles_arent_listed(respond):
+    respond(ET.fromstring(XML_TOTALS_ONLY))
+
+    accepted, ignored, retry = post(make_scrobbles(3))
+
+    assert len(accepted) == 3
+    assert ignored == retry == []
+
+
+def test_post_retries_everything_without_a_response(respond):
+    respond(None)
+    tracks = make_scrobbles(3)
+
+    assert post(tracks) == ([], [], tracks)
+
+
+def test_post_raises_on_error_response(respond):
+    respond(ET.fromstring(XML_ERROR))
+
+    with pytest.raises(HTTPStatusError):
+        post(make_scrobbles(3))
+
+
+def json_scrobble(name, code):
+    return {
+        "track": {"corrected": "0", "#text": name},
+        "ignoredMessage": {"code": str(code), "#text": ""},
+    }
+
+
+JSON_RESPONSE = {
+    "scrobbles": {
+        "scrobble": [
+            json_scrobble("Track 0", 0),
+            json_scrobble("Track 1", 1),
+            json_scrobble("Track 2", 5),
+        ],
+        "@attr": {"accepted": 1, "ignored": 2},
+    }
+}
+
+# A lone scrobble isn't wrapped in a list
+JSON_SINGLE = {
+    "scrobbles": {
+        "scrobble": json_scrobble("Track 0", 2),
+        "@attr": {"accepted": 0, "ignored": 1},
+    }
+}
+
+JSON_ERROR = {"error": 9, "message": "Invalid session key"}
+
+
+def test_parse_json_response():
+    assert scrobble.response_error(JSON_RESPONSE) is None
+    assert scrobble.accepted_count(JSON_RESPONSE) == 1
+    assert scrobble.ignored_codes(JSON_RESPONSE) == [0, 1, 5]
+
+
+def test_parse_json_single_scrobble():
+    assert scrobble.accepted_count(JSON_SINGLE) == 0
+    assert scrobble.ignored_codes(JSON_SINGLE) == [2]
+
+
+def test_parse_json_totals_only():
+    response = {"scrobbles": {"@attr": {"accepted": "3", "ignored": "0"}}}
+
+    assert scrobble.accepted_count(response) == 3
+    assert scrobble.ignored_codes(response) is None
+
+
+def test_parse_json_error():
+    error = scrobble.response_error(JSON_ERROR)
+
+    assert "Invalid session key" in error
+    assert not scrobble.is_rejected_batch(HTTPStatusError(200, "failed", error))
+    assert scrobble.is_rejected_batch(
+        HTTPStatusError(
+            400, "Bad Request", '{"error": 6, "message": "Invalid parameters"}'
+        )
+    )
+
+
+def test_post_sorts_json_scrobbles_by_outcome(respond):
+    respond(JSON_SINGLE)
+
+    accepted, ignored, retry = post(make_scrobbles(1))
+
+    assert accepted == retry == []
+    assert names(ignored) == ["Track 0"]
+
+
+class FakeLastFM:
+    """ Stands in for post_scrobbles: rejects any batch with a bad scrobble in it, and accepts the rest """
+
+    def __init__(self, bad=(), error=None):
+        self.bad = set(bad)
+        self.error = error
+        self.requests = []
+
+    def __call__(self, tracks, url, api_key, api_secret, session_key, deadline=None):
+        self.requests.append([track["track"] for track in tracks])
+        if self.error is not None:
+            raise self.error
+        if any(track["track"] in self.bad for track in tracks):
+            raise HTTPStatusError(400, "Bad Request", INVALID_PARAMETERS)
+        return list(tracks), [], []
+
+
+@pytest.fixture
+def lastfm(monkeypatch):
+    def install(**kwargs):
+        fake = FakeLastFM(**kwargs)
+        monkeypatch.setattr(scrobble, "post_scrobbles", fake)
+        return fake
+
+    return install
+
+
+def bisect(tracks, dead_letters=None):
+    return scrobble.bisect_rejected_batch(
+        tracks, "http://lastfm", "key", "secret", "session", dead_letters=dead_letters
+    )
+
+
+def test_bisect_finds_bad_scrobble(lastfm, tmp_path):
+    fake = lastfm(bad={"Track 5"})
+    dead_letters = DeadLetters(str(tmp_path / "scrobbles.rejected"))
+
+    accepted, ignored, retry = bisect(make_scrobbles(8), dead_letters)
+
+    assert sorted(names(accepted)) == sorted(
+        "Track {}".format(i) for i in range(8) if i != 5
+    )
+    assert names(ignored) == ["Track 5"]
+    assert retry == []
+    # The first half is tried first
+    assert fake.requests[0] == ["Track 0", "Track 1", "Track 2", "Track 3"]
+
+    with open(dead_letters.path) as quarantined:
+        records = [json.loads(line) for line in quarantined]
+    assert [record["track"] for record in records] == ["Track 5"]
+    assert records[0]["error"] == "error 6: Invalid parameters"
+
+
+def test_bisect_finds_several_bad_scrobbles(lastfm):
+    lastfm(bad={"Track 0", "Track 6"})
+
+    accepted, ignored, retry = bisect(make_scrobbles(8))
+
+    assert len(accepted) == 6
+    assert sorted(names(ignored)) == ["Track 0", "Track 6"]
+    assert retry == []
+
+
+def test_bisect_gives_up_when_nothing_gets_through(lastfm):
+    tracks = make_scrobbles(8)
+    fake = lastfm(bad=set(names(tracks)))
+
+    accepted, ignored, retry = bisect(tracks)
+
+    assert accepted == []
+    assert ignored == []
+    assert sorted(names(retry)) == sorted(names(tracks))
+    singles = [request for request in fake.requests if len(request) == 1]
+    assert len(singles) == scrobble.BISECTION_GIVE_UP
+
+
+def test_bisect_retries_on_server_errors(lastfm):
+    lastfm(error=HTTPStatusError(503, "Service Unavailable"))
+
+    accepted, ignored, retry = bisect(make_scrobbles(4))
+
+    assert accepted == []
+    assert ignored == []
+    assert len(retry) == 4
+
+
+def test_rejected_batch_errors():
+    assert scrobble.is_rejected_batch(HTTPStatusError(400, "Bad Request"))
+    assert scrobble.is_rejected_batch(
+        HTTPStatusError(400, "Bad Request", INVALID_PARAMETERS)
+    )
+    assert not scrobble.is_rejected_batch(
+        HTTPStatusError(403, "Forbidden", '{"error": 9, "message": "Invalid session"}')
+    )
+    assert not scrobble.is_rejected_batch(HTTPStatusError(500, "Server Error"))
+
+
+def varied_scrobbles(count):
+    """ Scrobbles with the odd optional field and some characters that need encoding """
+
+    tracks = []
+    for i in range(count):
+        track = {
+            "artist": "Sigur Rós & Friends",
+            "track": "Track {} (Live?)".format(i),
+            "timestamp": 1000 + i,
+        }
+        if i % 3 == 0:
+            track["album"] = "Ágætis byrjun"
+        if i % 4 == 1:
+            track["trackNumber"] = str(i)
+            track["duration"] = 180 + i
+        tracks.append(track)
+    return tracks
+
+
+@pytest.mark.parametrize("count", [1, 10, 11, 50])
+def test_encode_scrobbles_signs_like_sign_signature(count):
+    tracks = varied_scrobbles(count)
+
+    body = scrobble.encode_scrobbles(tracks, "key", "secret", "session")
+    parameters = dict(parse_qsl(body.decode("ascii"), strict_parsing=True))
+    signature = parameters.pop("api_sig")
+
+    expected = {"method": "track.scrobble", "api_key": "key", "sk": "session"}
+    for index, track in enumerate(tracks):
+        for field, value in track.items():
+            expected["{}[{}]".format(field, index)] = str(value)
+    assert parameters == expected
+    assert signature == scrobble.sign_signature(expected, "secret")
+
+
+@pytest.mark.parametrize("count", [1, 10, 11, 50])
+def test_signing_order_matches_sorted_keys(count):
+    keys = sorted("track[{}]".format(index) for index in range(count))
+
+    assert [
+        "track[{}]".format(index) for index in scrobble.signing_order(count)
+    ] == keys
@@ -0,0 +1,32 @@
+import sqlite3
+
+from tests.util import make_scrobbles, open_cache, tracks
+
+
+def test_expires_acked_scrobbles(tmp_path):
+    scrobbles = make_scrobbles(3)
+    cache = open_cache(tmp_path, "sqlite")
+    cache.extend(scrobbles)
+    cache.truncate(1)
+    # Acked scrobbles are kept around, so queuing them again is a no-op
+    assert not cache.append(scrobbles[0])
+    cache.close()
+
+    cache = open_cache(tmp_path, "sqlite", spool_acked_retention=0)
+    cache.close()
+
+    with sqlite3.connect(cache.path) as db:
+        assert db.execute("SELECT COUNT(*) FROM scrobbles").fetchone()[0] == 2
+
+
+def test_requeues_in_flight_scrobbles(tmp_path):
+    cache = open_cache(tmp_path, "sqlite")
+    cache.extend(make_scrobbles(3))
+    assert len(cache.pending(2)) == 2
+    assert tracks(cache.pending(2)) == ["Track 2"]
+    # Closing without acknowledging puts them back in the queue
+    cache.close()
+
+    cache = open_cache(tmp_path, "sqlite")
+    assert tracks(cache.pending(3)) == ["Track 0", "Track 1", "Track 2"]
+    cache.close()
@@ -0,0 +1,58 @@
+import builtins
+import os
+
+from tests.util import make_scrobbles, open_cache, tracks
+
+
+def test_shared_by_several_producers(tmp_path):
+    first = open_cache(tmp_path, "spooldir")
+    second = open_cache(tmp_path, "spooldir")
+    first.extend(make_scrobbles(2))
+    assert not second.append(make_scrobbles(1)[0])
+    second.append(make_scrobbles(1, start=2)[0])
+
+    assert first.lock_uploader()
+    assert not second.lock_uploader()
+    assert tracks(first) == ["Track 0", "Track 1", "Track 2"]
+
+    first.truncate(2)
+    assert tracks(second) == ["Track 2"]
+    first.close()
+    assert second.lock_uploader()
+    second.close()
+
+
+def test_triage_quarantines_malformed_records(tmp_path):
+    cache = open_cache(tmp_path, "spooldir")
+    cache.extend(make_scrobbles(2))
+    names = sorted(os.listdir(cache._new))
+    with open(os.path.join(cache._new, names[0]), "w") as record:
+        record.write('{"artist": "Artist"')
+    with open(os.path.join(cache._new, names[1]), "w") as record:
+        record.write('{"track": "No artist", "timestamp": 1}')
+
+    assert cache.triage()["malformed"] == 2
+    assert len(cache) == 0
+    assert sorted(os.listdir(os.path.join(cache.path, "bad"))) == names
+    cache.close()
+
+
+def test_triage_leaves_records_it_cant_read_yet(tmp_path, monkeypatch):
+    cache = open_cache(tmp_path, "spooldir")
+    cache.extend(make_scrobbles(2))
+
+    real_open = builtins.open
+
+    def flaky_open(path, *args, **kwargs):
+        if str(path).startswith(cache._new):
+            raise OSError(5, "Input/output error")
+        return real_open(path, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "open", flaky_open)
+    assert not cache.triage()
+    assert cache.pending(2) == []
+    monkeypatch.undo()
+
+    assert tracks(cache.pending(2)) == ["Track 0", "Track 1"]
+    assert not os.path.exists(os.path.join(cache.path, "bad"))
+    cache.close()
@@ -0,0 +1,111 @@
+import asyncio
+
+from yams import aio
+from yams.scrobble import TrackCache, TrackInfo, mpd_player_state
+
+SONG = {
+    "id": "3",
+    "file": "a.flac",
+    "artist": "Artist",
+    "title": "Track",
+    "album": "Album",
+}
+
+
+def make_status(state="play", songid="3", playlist="7", **extra):
+    status = {"state": state, "songid": songid, "playlist": playlist}
+    if state != "stop":
+        status.update(duration="180.000", elapsed="12.000")
+    status.update(extra)
+    return status
+
+
+class FakeMPD:
+    """ Just enough of python-mpd2's client to fetch the player state """
+
+    def __init__(self, status, song=SONG):
+        self.state = status
+        self.song = song
+        self.commands = []
+
+    def status(self):
+        self.commands.append("status")
+        return dict(self.state)
+
+    def currentsong(self):
+        self.commands.append("currentsong")
+        return dict(self.song)
+
+    def command_list_ok_begin(self):
+        self.commands.append("command_list_ok_begin")
+
+    def command_list_end(self):
+        return [self.status(), self.currentsong()]
+
+
+class FakeAsyncMPD(FakeMPD):
+    async def status(self):
+        return FakeMPD.status(self)
+
+    async def currentsong(self):
+        return FakeMPD.currentsong(self)
+
+
+def test_cache_keyed_by_songid_and_playlist():
+    tracks = TrackCache(size=2)
+    track = TrackInfo(SONG, make_status())
+    tracks.put(make_status(), track)
+
+    assert tracks.get(make_status(elapsed="100.000")) is track
+    assert tracks.get(make_status(playlist="8")) is None
+    assert tracks.get({"state": "stop"}) is None
+
+
+def test_cache_evicts_least_recently_played():
+    tracks = TrackCache(size=2)
+    for songid in ("1", "2"):
+        tracks.put(make_status(songid=songid), TrackInfo(SONG, make_status()))
+    tracks.get(make_status(songid="1"))
+    tracks.put(make_status(songid="3"), TrackInfo(SONG, make_status()))
+
+    assert tracks.get(make_status(songid="1")) is not None
+    assert tracks.get(make_status(songid="2")) is None
+
+
+def test_fetches_track_only_when_it_changes():
+    client = FakeMPD(make_status())
+    tracks = TrackCache()
+
+    status, track = mpd_player_state(client, tracks)
+    assert track.scrobbleable
+    assert track.scrobble["duration"] == "180.000"
+    client.commands = []
+
+    assert mpd_player_state(client, tracks)[1] is track
+    assert client.commands == ["status"]
+
+
+def test_stopped_track_not_cached():
+    # MPD reports the songid while stopped, but not the duration
+    client = FakeMPD(make_status("stop"))
+    tracks = TrackCache()
+
+    assert not mpd_player_state(client, tracks)[1].scrobbleable
+
+    client.state = make_status("play")
+    status, track = mpd_player_state(client, tracks)
+    assert track.scrobbleable
+    assert track.scrobble["duration"] == "180.000"
+
+
+def test_stopped_track_not_cached_asyncio():
+    client = FakeAsyncMPD(make_status("stop"))
+    tracks = TrackCache()
+
+    async def check():
+        assert not (await aio.mpd_player_state(client, tracks))[1].scrobbleable
+        client.state = make_status("play")
+        return await aio.mpd_player_state(client, tracks)
+
+    status, track = asyncio.run(check())
+    assert track.scrobbleable
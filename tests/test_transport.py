@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+
+from yams import transport
+
+
+@pytest.fixture
+def prewarmed(monkeypatch):
+    prewarmed = []
+    fired = threading.Event()
+
+    def prewarm(url):
+        prewarmed.append(url)
+        fired.set()
+
+    monkeypatch.setattr(transport, "prewarm", prewarm)
+    yield prewarmed, fired
+    transport.reset_session()
+
+
+def test_prewarms_for_different_owners_dont_cancel_each_other(prewarmed):
+    urls, fired = prewarmed
+    transport.schedule_prewarm("http://kitchen", 3600, owner="kitchen")
+    kitchen = transport._prewarm_timers["kitchen"]
+
+    transport.schedule_prewarm("http://lounge", 0, owner="lounge")
+    assert fired.wait(5)
+    assert urls == ["http://lounge"]
+    assert not kitchen.finished.is_set()
+
+
+def test_prewarm_replaced_by_same_owner(prewarmed):
+    urls, fired = prewarmed
+    transport.schedule_prewarm("http://first", 3600, owner="kitchen")
+    first = transport._prewarm_timers["kitchen"]
+
+    transport.schedule_prewarm("http://second", 0, owner="kitchen")
+    assert fired.wait(5)
+    assert urls == ["http://second"]
+    assert first.finished.is_set()
+
+
+def test_cancel_prewarm(prewarmed):
+    transport.schedule_prewarm("http://kitchen", 3600, owner="kitchen")
+    timer = transport._prewarm_timers["kitchen"]
+
+    transport.cancel_prewarm("kitchen")
+    assert timer.finished.is_set()
+    assert "kitchen" not in transport._prewarm_timers
@@ -0,0 +1,137 @@
+import pytest
+
+from yams import uploader
+from yams.uploader import (
+    NOW_PLAYING_RESEND_INTERVAL,
+    SCROBBLE_RETRY_INTERVAL,
+    UploadWork,
+)
+from tests.util import FakeClock
+
+CONFIG = {"base_url": "http://lastfm", "api_key": "key", "api_secret": "secret"}
+
+
+def make_song(title):
+    return {"artist": "Artist", "title": title, "album": "Album"}
+
+
+def make_status(duration="180.000"):
+    status = {"state": "play", "elapsed": "1.000"}
+    if duration is not None:
+        status["duration"] = duration
+    return status
+
+
+class Harness:
+    def __init__(self, monkeypatch):
+        self.clock = FakeClock()
+        self.sent = []
+        self.available = True
+        self.tokens = 10
+        monkeypatch.setattr(uploader, "time", self.clock)
+        monkeypatch.setattr(
+            uploader,
+            "now_playing",
+            lambda song, status, *args: self.sent.append(song["title"]),
+        )
+        monkeypatch.setattr(
+            uploader.transport, "is_available", lambda url: self.available
+        )
+        monkeypatch.setattr(
+            uploader.transport, "rate_limit_available", lambda: self.tokens
+        )
+        self.cache = []
+        self.work = UploadWork(
+            "session", dict(CONFIG, now_playing_settle=2), self.cache
+        )
+        # Nothing to retry, so don't try
+        self.work._last_retry_time = self.clock.now + 10 * SCROBBLE_RETRY_INTERVAL
+
+    def play(self, title, duration="180.000"):
+        self.work.now_playing(make_song(title), make_status(duration))
+
+    def step(self, seconds=0, jobs_waiting=False):
+        self.clock.sleep(seconds)
+        self.work.step(None, jobs_waiting)
+
+
+@pytest.fixture
+def harness(monkeypatch):
+    return Harness(monkeypatch)
+
+
+def test_waits_for_track_to_settle(harness):
+    harness.play("A")
+    assert harness.work.wait_time() == 2
+
+    harness.step()
+    assert harness.sent == []
+    harness.step(2)
+    assert harness.sent == ["A"]
+    harness.step(2)
+    assert harness.sent == ["A"]
+
+
+def test_only_latest_update_sent(harness):
+    harness.play("A")
+    harness.step(1)
+    harness.play("B")
+    harness.step(1)
+    assert harness.sent == []
+
+    harness.step(1)
+    assert harness.sent == ["B"]
+
+
+def test_same_track_not_resent_within_its_length(harness):
+    harness.play("A")
+    harness.step(2)
+    # e.g. after reconnecting to MPD
+    harness.play("A")
+    harness.step(100)
+    assert harness.sent == ["A"]
+
+    harness.play("A")
+    harness.step(100)
+    assert harness.sent == ["A", "A"]
+
+
+def test_same_track_resent_after_interval_without_duration(harness):
+    harness.play("A", duration=None)
+    harness.step(2)
+    harness.play("A", duration=None)
+    harness.step(NOW_PLAYING_RESEND_INTERVAL - 10)
+    assert harness.sent == ["A"]
+
+    harness.play("A", duration=None)
+    harness.step(20)
+    assert harness.sent == ["A", "A"]
+
+
+def test_different_track_sent_straight_after(harness):
+    harness.play("A")
+    harness.step(2)
+    harness.play("B")
+    harness.step(2)
+    assert harness.sent == ["A", "B"]
+
+
+def test_gives_way_to_scrobbles_when_rate_limit_low(harness):
+    harness.tokens = 1
+    harness.play("A")
+    harness.step(2, jobs_waiting=True)
+    assert harness.sent == []
+
+    harness.tokens = 10
+    harness.play("B")
+    harness.step(2, jobs_waiting=True)
+    assert harness.sent == ["B"]
+
+
+def test_dropped_while_lastfm_down(harness):
+    harness.available = False
+    harness.play("A")
+    harness.step(2)
+    harness.available = True
+    harness.step(2)
+    assert harness.sent == []
@@ -0,0 +1,53 @@
+import time
+
+from yams.cache import open_scrobble_cache
+from yams.configure import DEFAULTS
+
+
+def make_scrobbles(count, start=0):
+    now = int(time.time())
+    return [
+        {"artist": "Artist", "track": "Track {}".format(i), "timestamp": now - 1000 + i}
+        for i in range(start, start + count)
+    ]
+
+
+def open_cache(tmp_path, backend, **options):
+    """ Open a cache in tmp_path the way yams would, and wait for it to finish loading """
+
+    config = dict(DEFAULTS)
+    config.update(
+        cache_file=str(tmp_path / "scrobbles.cache"),
+        spool_dir=str(tmp_path / "spool"),
+        cache_backend=backend,
+    )
+    config.update(options)
+    cache = open_scrobble_cache(config)
+    loader = getattr(cache, "loader", None)
+    if loader is not None:
+        loader.join()
+    return cache
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def tracks(scrobbles):
+    return [scrobble["track"] for scrobble in scrobbles]
+
+
+class FakeClock:
+    """ Stands in for the time module, so tests don't have to wait: sleeping just moves the clock on """
+
+    def __init__(self, now=1000000):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
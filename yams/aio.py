@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import logging
+import time
+
+from mpd.asyncio import MPDClient
+from mpd.base import ConnectionError
+
+from yams import transport
+from yams.scrobble import (
+    IDLE_WAKE_MARGIN,
+    TrackCache,
+    TrackInfo,
+    print_song_info,
+    real_time_scrobble_threshold,
+)
+from yams.uploader import JOB_NOW_PLAYING, JOB_SCROBBLE, JOB_STOP, UploadWork
+
+logger = logging.getLogger("yams")
+
+# How long (in seconds) to wait before trying to reconnect to MPD
+RECONNECT_TIMEOUT = 10
+
+# The name of the player the running code is working for, when watching several (see PlayerLogFilter)
+current_player = contextvars.ContextVar("current_player", default=None)
+
+
+class PlayerLogFilter(logging.Filter):
+    """ Prefixes log messages with the name of the player they're about, when watching several """
+
+    def filter(self, record):
+        name = current_player.get()
+        if name is not None and isinstance(record.msg, str):
+            record.msg = "[{}] {}".format(name, record.msg)
+        return True
+
+
+class AsyncUploader:
+    """
+    The uploader (see yams.uploader.Uploader), run as a task on the event loop rather than as a thread of its own.
+    Jobs, the now playing settle time and the cache retry interval are all waited on with asyncio, and only the
+    requests themselves (see yams.uploader.UploadWork) are handed to a worker thread, one at a time, so they still go
+    through yams.transport (its connection pool, rate limiter and circuit breakers) in order. Each uploader has a
+    worker thread of its own, so a long drain of one player's cache never holds up another player's scrobbles.
+    """
+
+    def __init__(self, session, config, cache, recent=None, dead_letters=None):
+        self.work = UploadWork(session, config, cache, recent, dead_letters)
+        self._jobs = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="yams-upload")
+        self._task = None
+
+    def now_playing(self, song, status):
+        """ See yams.uploader.Uploader.now_playing """
+
+        self.work.now_playing(song, status)
+        self._jobs.put_nowait((JOB_NOW_PLAYING,))
+
+    def scrobble(self, song, status, timestamp):
+        """ See yams.uploader.Uploader.scrobble """
+
+        self._jobs.put_nowait((JOB_SCROBBLE, song, status, timestamp))
+
+    def start(self):
+        """ Start uploading, on the current event loop """
+
+        self._task = asyncio.get_event_loop().create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop the uploader, once it's finished whatever it's sending right now. Scrobbles that haven't been sent yet
+        are queued in the cache.
+        """
+
+        self.work.stop()
+        self._jobs.put_nowait((JOB_STOP,))
+        if self._task is not None:
+            await self._task
+        self._executor.shutdown()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                job = await asyncio.wait_for(self._jobs.get(), self.work.wait_time())
+            except asyncio.TimeoutError:
+                job = None
+            if job is not None and job[0] == JOB_STOP:
+                return
+            # Take the context along, so we know which player we're uploading for
+            await loop.run_in_executor(
+                self._executor,
+                contextvars.copy_context().run,
+                self.work.step,
+                job,
+                not self._jobs.empty(),
+            )
+
+
+class PlayerEvents:
+    """
+    Follows MPD's player subsystem (through idle) in the background, so the watcher can wait for the player to
+    change - or for a while, whichever comes first
+    """
+
+    def __init__(self, client):
+        self._changed = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._follow(client))
+
+    async def _follow(self, client):
+        async for changes in client.idle(["player"]):
+            logger.debug("Received event in subsystem: {}".format(changes))
+            self._changed.set()
+
+    def clear(self):
+        """ Forget about any changes so far, e.g. just before fetching the player's state """
+
+        self._changed.clear()
+
+    async def wait(self, timeout=None):
+        """
+        Wait until the player changes (unless it already has, since clear() was last called)
+
+        :param timeout: How long to wait at most (in seconds), forever if not given
+        :type timeout: float
+
+        :raises ConnectionError: If we lost the connection to MPD
+        :return: Did the player change?
+        :rtype: bool
+        """
+
+        changed = asyncio.get_event_loop().create_task(self._changed.wait())
+        try:
+            await asyncio.wait(
+                [changed, self._task],
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            changed.cancel()
+        if self._task.done():
+            # Following the player only stops when the connection does
+            self._task.result()
+            raise ConnectionError("Stopped receiving events from MPD")
+        return self._changed.is_set()
+
+    def close(self):
+        self._task.cancel()
+
+
+async def mpd_player_state(client, tracks):
+    """
+    Fetch the player status and the current track from MPD, only fetching the track if it isn't in the track cache.
+    The asyncio client can't send them together as a command list, so the track's checked against the status (by
+    its songid): if the track changed in between, we start again with the new one's status.
+
+    :param client: The MPD client object
+    :param tracks: The tracks we've already fetched
+
+    :type client: mpd.asyncio.MPDClient
+    :type tracks: yams.scrobble.TrackCache
+
+    :return: The player status and current track
+    :rtype: (dict,yams.scrobble.TrackInfo)
+    """
+
+    status = await client.status()
+    track = tracks.get(status)
+    while track is None:
+        song = await client.currentsong()
+        if "id" not in song or song["id"] == status.get("songid"):
+            track = TrackInfo(song, status)
+            tracks.put(status, track)
+        else:
+            status = await client.status()
+            track = tracks.get(status)
+    return status, track
+
+
+async def mpd_watch_track(client, config, cache, uploader=None):
+    """
+    The asyncio version of yams.scrobble.mpd_watch_track: watches MPD and tracks the currently playing song, and
+    decides when to send Last.FM updates. MPD is never polled, we wait on player events, or until the track's due to
+    be watched or scrobbled (whichever comes first), and plan again from there.
+
+    :param client: The MPD client object, connected
+    :param config: The global config file
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :param uploader: The uploader that sends our updates. Without one, scrobbles are only queued in the cache.
+
+    :type client: mpd.asyncio.MPDClient
+    :type config: dict
+    :type cache: yams.cache.ScrobbleCache
+    :type uploader: AsyncUploader
+
+    :raises ConnectionError: If we lost the connection to MPD
+    """
+
+    loop = asyncio.get_event_loop()
+    base_url = config["base_url"]
+
+    use_real_time = config["real_time"]
+    allow_scrobble_same_song_twice_in_a_row = config[
+        "allow_same_track_scrobble_in_a_row"
+    ]
+
+    default_scrobble_threshold = config["scrobble_threshold"]
+    scrobble_min_time = config["scrobble_min_time"]
+    watch_threshold = config["watch_threshold"]
+
+    current_watched_track = ""
+    reject_track = ""
+    scrobble_threshold = default_scrobble_threshold
+    tracks = TrackCache()
+    last_track = None
+    prewarm = None
+
+    # For use with `use_real_time` parameter
+    start_time = time.time()
+    reported_start_time = 0
+
+    events = PlayerEvents(client)
+    try:
+        while True:
+            events.clear()
+            status, track = await mpd_player_state(client, tracks)
+
+            if status["state"] != "play" or not track.scrobbleable:
+                if status["state"] == "play":
+                    logger.warn("Track cannot be scrobbled, waiting for next track...")
+                logger.debug("Waiting for the next mpd event...")
+                last_track = None
+                await events.wait()
+                continue
+
+            if track is not last_track:
+                print_song_info(client, status, track.song)
+                last_track = track
+
+            song = track.song
+            title = track.title
+
+            # The time since the song claims it started, that we've been able to measure in python
+            real_time_elapsed = reported_start_time + (time.time() - start_time)
+
+            song_duration = float(
+                status["duration"]
+                if "duration" in status
+                else status["time"].split(":")[-1]
+            )
+            elapsed = float(status["elapsed"])
+            percent_elapsed = elapsed / song_duration * 100
+
+            if current_watched_track != title:
+                scrobble_threshold = default_scrobble_threshold
+
+            if (
+                current_watched_track != title
+                and title != ""
+                and title != reject_track
+                and percent_elapsed < scrobble_threshold
+                and real_time_elapsed > watch_threshold
+                and elapsed > watch_threshold
+            ):
+                current_watched_track = title
+                reject_track = ""
+
+                start_time = time.time()
+                reported_start_time = elapsed - watch_threshold
+                real_time_elapsed = reported_start_time
+
+                if use_real_time:
+                    scrobble_threshold = real_time_scrobble_threshold(
+                        reported_start_time, song_duration, default_scrobble_threshold
+                    )
+
+                logger.info(
+                    "Starting to watch track: {} by {}, currently at: {}/{}s ({}%). Will scrobble in: {}s".format(
+                        title,
+                        track.artist,
+                        format(elapsed, ".0f"),
+                        format(song_duration, ".0f"),
+                        format(percent_elapsed, ".1f"),
+                        format(
+                            (song_duration * scrobble_threshold / 100) - elapsed, ".0f"
+                        ),
+                    )
+                )
+                if uploader is not None:
+                    uploader.now_playing(song, status)
+                    # Have a connection ready for when the track's due to be scrobbled
+                    if prewarm is not None:
+                        prewarm.cancel()
+                    prewarm = loop.call_later(
+                        max(
+                            0,
+                            (song_duration * scrobble_threshold / 100)
+                            - elapsed
+                            - transport.PREWARM_LEAD_TIME,
+                        ),
+                        transport.prewarm,
+                        base_url,
+                    )
+
+            elif (
+                current_watched_track == title
+                and percent_elapsed >= scrobble_threshold
+                and elapsed > scrobble_min_time
+            ):
+                # If we're using real time, lets ensure we've been listening this long:
+                if (
+                    not use_real_time
+                    or real_time_elapsed >= (scrobble_threshold / 100) * song_duration
+                ):
+                    current_watched_track = ""
+                    if uploader is not None:
+                        uploader.scrobble(song, status, start_time)
+                    else:
+                        # Someone else is uploading from this cache, queue it for them
+                        cache.append(dict(track.scrobble, timestamp=start_time))
+                        logger.info("Queued {} for the uploader.".format(title))
+
+                    if not allow_scrobble_same_song_twice_in_a_row:
+                        reject_track = title
+                else:
+                    logger.warn(
+                        "Can't scrobble yet, time elapsed ({}s) < adjusted duration ({}s)".format(
+                            real_time_elapsed,
+                            (scrobble_threshold / 100) * song_duration,
+                        )
+                    )
+
+            # Work out when there'll next be something to do, going by where the track is now
+            wake_in = None
+            if current_watched_track == title:
+                # When it's due to be scrobbled
+                wake_in = max(
+                    song_duration * scrobble_threshold / 100 - elapsed,
+                    scrobble_min_time - elapsed,
+                    (scrobble_threshold / 100) * song_duration - real_time_elapsed
+                    if use_real_time
+                    else 0,
+                )
+            elif (
+                title != ""
+                and title != reject_track
+                and percent_elapsed < scrobble_threshold
+            ):
+                # When it's due to be watched
+                wake_in = max(
+                    watch_threshold - elapsed, watch_threshold - real_time_elapsed
+                )
+
+            if wake_in is not None:
+                wake_in = max(0, wake_in) + IDLE_WAKE_MARGIN
+                logger.debug(
+                    "Waiting on MPD for up to {}s".format(format(wake_in, ".1f"))
+                )
+            else:
+                logger.debug("Nothing to do until MPD's player changes")
+            await events.wait(wake_in)
+    finally:
+        events.close()
+        if prewarm is not None:
+            prewarm.cancel()
+
+
+async def watch_mpd(config, cache, uploader=None):
+    """
+    Connect to MPD and watch it, reconnecting every RECONNECT_TIMEOUT seconds if the connection's lost (or can't be
+    made), until we're cancelled
+
+    :param config: The global config file
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :param uploader: The uploader that sends our updates
+
+    :type config: dict
+    :type cache: yams.cache.ScrobbleCache
+    :type uploader: AsyncUploader
+    """
+
+    while True:
+        client = MPDClient()
+        try:
+            await client.connect(config["mpd_host"], config["mpd_port"])
+            logger.info("Connected to MPD, watching it with the asyncio engine.")
+            await mpd_watch_track(client, config, cache, uploader)
+        # A connection error implies we lost connection with MPD - lets retry unless the user kills us
+        except (ConnectionError, OSError) as e:
+            logger.error("Received an MPD Connection error!: {}".format(e))
+            logger.info(
+                "YAMS will keep trying to reconnect to MPD, every {} seconds.".format(
+                    RECONNECT_TIMEOUT
+                )
+            )
+        finally:
+            client.disconnect()
+        await asyncio.sleep(RECONNECT_TIMEOUT)
+
+
+class Player:
+    """
+    An MPD instance to watch, with everything that's its own: its config (host, port, thresholds and all), Last.FM
+    session, scrobbles cache and uploader (with its own worker thread). Players share nothing else but the event loop,
+    and yams.transport's connection pool, rate limiter and circuit breakers.
+    """
+
+    def __init__(self, config, session, cache, recent=None, dead_letters=None):
+        self.name = (
+            config["name"]
+            if "name" in config
+            else "{}:{}".format(config["mpd_host"], config["mpd_port"])
+        )
+        self.config = config
+        self.session = session
+        self.cache = cache
+        self.recent = recent
+        self.dead_letters = dead_letters
+        self.uploader = None
+
+    def start(self):
+        """ Start the player's uploader, on the current event loop """
+
+        # Shared caches are drained by a separate uploader process ('yams --uploader'), so we don't send anything at all
+        if not self.cache.shared:
+            self.uploader = AsyncUploader(
+                self.session, self.config, self.cache, self.recent, self.dead_letters,
+            )
+            self.uploader.start()
+
+    async def stop(self):
+        if self.uploader is not None:
+            await self.uploader.stop()
+
+    def close(self):
+        self.cache.close()
+
+
+async def supervise(player, restart=False):
+    """
+    Watch a player until we're cancelled. With 'restart', the player is started again (after RECONNECT_TIMEOUT
+    seconds) if something unexpected goes wrong, rather than bringing every other player down with it.
+
+    :param player: The player to watch
+    :param restart: Should the player be restarted if something goes wrong?
+
+    :type player: Player
+    :type restart: bool
+    """
+
+    if restart:
+        current_player.set(player.name)
+    player.start()
+
+    while True:
+        try:
+            await watch_mpd(player.config, player.cache, player.uploader)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if not restart:
+                raise
+            logger.exception(
+                "Something went very wrong! Restarting this player in {} seconds.".format(
+                    RECONNECT_TIMEOUT
+                )
+            )
+            await asyncio.sleep(RECONNECT_TIMEOUT)
+
+
+def run_engine(session, config, cache, recent=None, dead_letters=None):
+    """
+    Run YAMS on an event loop (the 'asyncio' engine): watching MPD, the now playing and scrobble timers, and the
+    uploader all run together, waiting on events rather than polling. Returns once we're told to stop.
+
+    :param session: The Last.FM session key
+    :param config: The YAMS config
+    :param cache: The scrobbles cache
+    :param recent: The scrobbles Last.FM has already accepted, if we're keeping track
+    :param dead_letters: Where to put the scrobbles Last.FM rejects, if anywhere
+
+    :type session: str
+    :type config: dict
+    :type cache: yams.cache.ScrobbleCache
+    :type recent: yams.recent.RecentScrobbles
+    :type dead_letters: yams.deadletter.DeadLetters
+    """
+
+    run_players([Player(config, session, cache, recent, dead_letters)])
+
+
+def run_players(players):
+    """
+    Watch several MPD instances at once, on one event loop (see run_engine). Each player is supervised on its own,
+    so one failing (or losing its connection) doesn't affect the others, and uploads from its own worker thread, so
+    one player's backlog doesn't hold up the others. Their requests all go through the same connection pool and rate
+    limiter, so together they stay within Last.FM's rate limit. Returns once we're told to stop.
+
+    :param players: The players to watch
+    :type players: list
+    """
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    several = len(players) > 1
+    log_filter = PlayerLogFilter()
+    if several:
+        logger.addFilter(log_filter)
+        logger.info(
+            "Watching {} players: {}".format(
+                len(players), ", ".join(player.name for player in players)
+            )
+        )
+
+    watchers = [loop.create_task(supervise(player, several)) for player in players]
+    watching = asyncio.gather(*watchers)
+    try:
+        loop.run_until_complete(watching)
+    # User is in no-daemon mode and wants to exit
+    except KeyboardInterrupt:
+        print("")
+        logger.info("Keyboard Interrupt detected - Exiting!")
+    # If we receive an unknown exception lets exit, as this is undefined behaviour
+    except Exception:
+        logger.exception("Something went very wrong!")
+    finally:
+        watching.cancel()
+        loop.run_until_complete(
+            asyncio.gather(watching, *watchers, return_exceptions=True)
+        )
+        for player in players:
+            loop.run_until_complete(player.stop())
+        logger.removeFilter(log_filter)
+        loop.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("yams")
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+
+class Backoff:
+    """
+    Exponential backoff with jitter: the n'th delay is somewhere between half and all of base * 2^n seconds (capped
+    at 'maximum'), so clients that failed together don't all retry together.
+    """
+
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+
+    def delay(self, attempt):
+        """
+        :param attempt: How many times we've already backed off, starting at 0
+        :type attempt: int
+        :rtype: float
+        """
+
+        ceiling = min(self.maximum, self.base * 2 ** attempt)
+        return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+class CircuitBreaker:
+    """
+    Stops us sending requests to an endpoint that's down. After 'failure_threshold' failures in a row the circuit
+    opens, and requests are turned away until the backoff delay has passed. Then it's half-open: a single request is
+    let through to probe the endpoint. If that works the circuit closes again, if not it reopens, for longer.
+    Thread safe.
+    """
+
+    def __init__(self, name, failure_threshold, backoff):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        # How many times in a row we've opened the circuit, for the backoff
+        self.opened = 0
+        self.retry_at = 0
+        self._lock = threading.Lock()
+
+    def ready(self):
+        """
+        Would a request be let through right now? Unlike allow(), this doesn't claim the half-open probe.
+
+        :rtype: bool
+        """
+
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            return self.state == CIRCUIT_OPEN and time.time() >= self.retry_at
+
+    def allow(self):
+        """
+        Can we send a request? If the circuit's due a probe, the caller gets to send it and must report back with
+        record_success() or record_failure().
+
+        :rtype: bool
+        """
+
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.time() >= self.retry_at:
+                self.state = CIRCUIT_HALF_OPEN
+                logger.info("Probing {} to see if it's back...".format(self.name))
+                return True
+            return False
+
+    def retry_in(self):
+        """ Returns how long (in seconds) until the next request will be let through """
+
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return 0
+            return max(0, self.retry_at - time.time())
+
+    def record_success(self):
+        with self._lock:
+            if self.state != CIRCUIT_CLOSED:
+                logger.info("{} is back, resuming requests".format(self.name))
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+            self.opened = 0
+
+    def release(self):
+        """ Hand back a probe claimed with allow() that was never sent, so another request can be the probe """
+
+        with self._lock:
+            if self.state == CIRCUIT_HALF_OPEN:
+                self.state = CIRCUIT_OPEN
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            # Requests that were already under way when the circuit opened don't open it again (which would back off
+            # for longer), only a failed probe does
+            if self.state == CIRCUIT_HALF_OPEN or (
+                self.state == CIRCUIT_CLOSED and self.failures >= self.failure_threshold
+            ):
+                delay = self.backoff.delay(self.opened)
+                self.opened += 1
+                self.state = CIRCUIT_OPEN
+                self.retry_at = time.time() + delay
+                logger.warn(
+                    "{} looks to be down ({} failures in a row), backing off for {}s".format(
+                        self.name, self.failures, format(delay, ".0f")
+                    )
+                )
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+from yams.cache import SCROBBLE_MAX_AGE, triage_scrobbles
+from yams.record import SCROBBLE_FIELDS, Scrobble
+from yams.scrobble import MAX_TRACKS_PER_SCROBBLE, scrobble_tracks
+
+logger = logging.getLogger("yams")
+
+BULK_FORMATS = ["jsonl", "csv"]
+
+# How often (in seconds) to report progress during an import or export
+BULK_PROGRESS_INTERVAL = 5
+
+# Column names other scrobblers use for our fields (matched case insensitively)
+FIELD_ALIASES = {field.lower(): field for field in SCROBBLE_FIELDS}
+FIELD_ALIASES.update(
+    {"title": "track", "album_artist": "albumArtist", "track_number": "trackNumber"}
+)
+
+
+def guess_format(path, default="jsonl"):
+    """
+    Returns the bulk format a file is in (or should be written in), going by its extension
+
+    :param path: The path to the file, or '-' for stdin/stdout
+    :param default: The format to fall back on
+
+    :type path: str
+    :type default: str
+    :rtype: str
+    """
+
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension in BULK_FORMATS:
+        return extension
+    return default
+
+
+def read_scrobbles(stream, fmt, progress=None):
+    """
+    Stream scrobbles out of a JSONL or CSV file, one at a time. Unknown fields are dropped and other scrobblers'
+    names for fields are translated (see FIELD_ALIASES). Records that aren't even a scrobble (or can't be read at
+    all) are skipped.
+
+    :param stream: The file to read from
+    :param fmt: The file's format, one of BULK_FORMATS
+    :param progress: Where to count the skipped records, if anywhere
+
+    :type stream: file
+    :type fmt: str
+    :type progress: BulkProgress
+
+    :return: A generator of scrobble dicts
+    :rtype: generator
+    """
+
+    if fmt == "jsonl":
+        records = stream
+    elif fmt == "csv":
+        records = csv.DictReader(stream)
+    else:
+        raise ValueError(
+            "Unknown format '{}', expected one of: {}".format(
+                fmt, ", ".join(BULK_FORMATS)
+            )
+        )
+
+    def skip(line_number, reason):
+        logger.warn("Skipping record {}: {}".format(line_number, reason))
+        if progress is not None:
+            progress.count("skipped")
+
+    for line_number, record in enumerate(records, 1):
+        if fmt == "jsonl":
+            if not record.strip():
+                continue
+            try:
+                record = json.loads(record)
+            except ValueError as e:
+                skip(line_number, "not valid JSON ({})".format(e))
+                continue
+
+        if not isinstance(record, dict):
+            skip(line_number, "not a scrobble")
+            continue
+
+        scrobble = {}
+        for key, value in record.items():
+            field = FIELD_ALIASES.get(str(key).strip().lower())
+            if field is not None and value not in (None, ""):
+                scrobble[field] = value
+
+        # CSV gives us strings, Last.FM wants whole seconds (unusable timestamps are left for triage_scrobbles to find)
+        if "timestamp" in scrobble:
+            try:
+                scrobble["timestamp"] = int(float(scrobble["timestamp"]))
+            except (TypeError, ValueError):
+                pass
+        yield scrobble
+
+
+def write_scrobbles(stream, scrobbles, fmt):
+    """
+    Write scrobbles out to a JSONL or CSV file, one at a time
+
+    :param stream: The file to write to
+    :param scrobbles: The scrobbles to write
+    :param fmt: The file's format, one of BULK_FORMATS
+
+    :type stream: file
+    :type scrobbles: iterable
+    :type fmt: str
+
+    :return: The number of scrobbles written
+    :rtype: int
+    """
+
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, fieldnames=SCROBBLE_FIELDS)
+        writer.writeheader()
+        write = writer.writerow
+    elif fmt == "jsonl":
+        write = lambda scrobble: stream.write(
+            json.dumps(scrobble, separators=(",", ":")) + "\n"
+        )
+    else:
+        raise ValueError(
+            "Unknown format '{}', expected one of: {}".format(
+                fmt, ", ".join(BULK_FORMATS)
+            )
+        )
+
+    written = 0
+    for scrobble in scrobbles:
+        write(dict(scrobble))
+        written += 1
+    return written
+
+
+def open_bulk_file(path, mode):
+    """ Open a file for importing/exporting, '-' meaning stdin/stdout """
+
+    if path == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+class BulkProgress:
+    """ Keeps count of what happened to the scrobbles in an import or export, and logs it every so often """
+
+    def __init__(self, action):
+        self.action = action
+        self.start = time.time()
+        self.last_report = self.start
+        self.counts = {}
+        self.total = 0
+
+    def count(self, outcome, amount=1):
+        self.counts[outcome] = self.counts.get(outcome, 0) + amount
+
+    def advance(self, amount):
+        self.total += amount
+        if time.time() - self.last_report >= BULK_PROGRESS_INTERVAL:
+            self.report()
+
+    def report(self, final=False):
+        self.last_report = time.time()
+        elapsed = self.last_report - self.start
+        logger.info(
+            "{} {} scrobbles{} in {}s ({} scrobbles/s){}".format(
+                self.action,
+                self.total,
+                ""
+                if not any(self.counts.values())
+                else " ({})".format(
+                    ", ".join(
+                        "{} {}".format(count, outcome)
+                        for outcome, count in sorted(self.counts.items())
+                        if count > 0
+                    )
+                ),
+                format(elapsed, ".1f"),
+                format(self.total / elapsed if elapsed > 0 else 0, ".1f"),
+                "" if final else "...",
+            )
+        )
+
+
+def export_scrobbles(cache, path, fmt=None):
+    """
+    Write every scrobble waiting in the cache out to a JSONL or CSV file, without removing them
+
+    :param cache: The scrobbles cache
+    :param path: The file to write to, or '-' for stdout
+    :param fmt: The format to write in, guessed from the path if not given
+
+    :type cache: yams.cache.ScrobbleCache
+    :type path: str
+    :type fmt: str
+    """
+
+    fmt = fmt or guess_format(path)
+    progress = BulkProgress("Exported")
+
+    def counted(scrobbles):
+        for scrobble in scrobbles:
+            yield scrobble
+            progress.advance(1)
+
+    stream = open_bulk_file(path, "w")
+    try:
+        write_scrobbles(stream, counted(cache), fmt)
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+    progress.report(final=True)
+
+
+def import_scrobbles(
+    path, session, config, cache, recent=None, fmt=None, dead_letters=None
+):
+    """
+    Submit the scrobbles in a JSONL or CSV file (e.g. exported from another scrobbler or an offline device) to
+    Last.FM, batch by batch as they're read, so the file can be as large as you like. Scrobbles Last.FM can't accept
+    are skipped (see triage_scrobbles), as are ones that are already cached or have recently been submitted. Batches
+    that fail (and scrobbles Last.FM asks us to send again) are queued in the cache, to be retried later.
+
+    :param path: The file to read, or '-' for stdin
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param cache: The scrobbles cache
+    :param recent: The recently accepted scrobbles, if we're keeping track of them
+    :param fmt: The format to read, guessed from the path if not given
+    :param dead_letters: Where to quarantine scrobbles Last.FM rejects, if anywhere
+
+    :type path: str
+    :type session: str
+    :type config: dict
+    :type cache: yams.cache.ScrobbleCache
+    :type recent: yams.recent.RecentScrobbles
+    :type fmt: str
+    :type dead_letters: yams.deadletter.DeadLetters
+    """
+
+    base_url = config["base_url"]
+    api_key = config["api_key"]
+    api_secret = config["api_secret"]
+
+    fmt = fmt or guess_format(path)
+    progress = BulkProgress("Imported")
+
+    def submit(batch):
+        scrobbles, removed = triage_scrobbles(
+            batch, int(time.time() - SCROBBLE_MAX_AGE)
+        )
+        for reason, count in removed.items():
+            progress.count(reason, count)
+
+        fresh = [
+            scrobble
+            for scrobble in scrobbles
+            if scrobble not in cache and (recent is None or scrobble not in recent)
+        ]
+        progress.count("already submitted", len(scrobbles) - len(fresh))
+
+        if fresh:
+            accepted, ignored, retry = scrobble_tracks(
+                fresh,
+                base_url,
+                api_key,
+                api_secret,
+                session,
+                dead_letters=dead_letters,
+            )
+            progress.count("accepted", len(accepted))
+            progress.count("ignored by Last.FM", len(ignored))
+            if recent is not None and accepted:
+                recent.add(accepted)
+            if retry:
+                progress.count("queued", cache.extend(retry))
+        progress.advance(len(batch))
+
+    stream = open_bulk_file(path, "r")
+    try:
+        batch = []
+        for scrobble in read_scrobbles(stream, fmt, progress):
+            try:
+                batch.append(Scrobble.from_dict(scrobble))
+            except TypeError:
+                # Missing a required field
+                batch.append(scrobble)
+
+            if len(batch) >= MAX_TRACKS_PER_SCROBBLE:
+                submit(batch)
+                batch = []
+        if batch:
+            submit(batch)
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    progress.report(final=True)
@@ -0,0 +1,842 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import yaml
+
+from yams.record import as_scrobble, as_scrobbles
+
+logger = logging.getLogger("yams")
+
+CACHE_BACKENDS = ["yaml", "journal", "sqlite", "spooldir"]
+
+# Scrobbles are loaded from disk in chunks of one Last.FM batch, with a few chunks parsed ahead
+LOAD_CHUNK_SIZE = 50
+LOAD_PREFETCH_CHUNKS = 4
+
+# In write-behind mode, queue changes are written out this often (in seconds), or once this many have piled up
+SCROBBLE_DISK_SAVE_INTERVAL = 1200
+SCROBBLE_DISK_SAVE_THRESHOLD = 50
+
+CACHE_WRITE_MODES = ["write-through", "write-behind"]
+
+# Last.FM won't accept scrobbles older than this (in seconds), so there's no point keeping them around
+SCROBBLE_MAX_AGE = 14 * 24 * 60 * 60
+
+# Prefer libyaml's (much faster) parser, if PyYAML was built with it
+YAML_LOADER = yaml.CSafeLoader if hasattr(yaml, "CSafeLoader") else yaml.SafeLoader
+
+
+def save_failed_scrobbles_to_disk(path, scrobbles):
+    logger.info("Writing scrobbles to disk...")
+    if os.path.exists(path):
+        os.remove(path)
+
+    with open(path, "w+") as file_stream:
+        yaml.dump(
+            {"scrobbles": [dict(scrobble) for scrobble in scrobbles]},
+            file_stream,
+            default_flow_style=False,
+            Dumper=yaml.Dumper,
+        )
+    logger.info("Failed scrobbles written to: {}".format(path))
+
+
+def _construct_scalar(loader, event):
+    """ Turn a YAML scalar event into its python value, resolving its (implicit) type the same way yaml.load would """
+
+    tag = event.tag
+    # Quoted scalars without an explicit tag are always strings, skip the resolver for these
+    if tag is None and not event.implicit[0]:
+        return event.value
+    if tag is None or tag == "!":
+        tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+
+    constructor = loader.yaml_constructors.get(tag, loader.yaml_constructors[None])
+    return constructor(loader, yaml.ScalarNode(tag, event.value, style=event.style))
+
+
+def iter_failed_scrobbles_from_disk(path):
+    """
+    Stream the scrobbles out of a YAML cache file one at a time, without ever building the whole document in memory.
+    libyaml's C parser is used if PyYAML was built with it.
+
+    :param path: The path to the YAML cache file
+    :type path: str
+
+    :return: A generator of scrobbles, in the order they're stored in
+    :rtype: generator
+    """
+
+    with open(path) as scrobbles_file_stream:
+        loader = YAML_LOADER(scrobbles_file_stream)
+        # Each frame is [container, key waiting for its value (mappings only), is this the list of scrobbles?]
+        stack = []
+
+        try:
+            while loader.check_event():
+                event = loader.get_event()
+
+                if isinstance(event, yaml.MappingStartEvent):
+                    stack.append([{}, None, False])
+                    continue
+                elif isinstance(event, yaml.SequenceStartEvent):
+                    is_scrobbles = (
+                        len(stack) == 1
+                        and isinstance(stack[0][0], dict)
+                        and stack[0][1] == "scrobbles"
+                    )
+                    stack.append([[], None, is_scrobbles])
+                    continue
+                elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+                    value = stack.pop()[0]
+                    # Hand out finished scrobbles instead of collecting them
+                    if stack and stack[-1][2]:
+                        yield value
+                        continue
+                elif isinstance(event, yaml.ScalarEvent):
+                    value = _construct_scalar(loader, event)
+                elif isinstance(event, yaml.AliasEvent):
+                    raise ValueError(
+                        "YAML aliases aren't supported in scrobble caches ({})".format(
+                            event.start_mark
+                        )
+                    )
+                else:
+                    continue
+
+                if not stack:
+                    continue
+
+                frame = stack[-1]
+                if isinstance(frame[0], list):
+                    frame[0].append(value)
+                elif frame[1] is None:
+                    frame[1] = value
+                else:
+                    frame[0][frame[1]] = value
+                    frame[1] = None
+        finally:
+            loader.dispose()
+
+
+def read_failed_scrobbles_from_disk(path):
+
+    if os.path.exists(path):
+        try:
+            start = time.time()
+            logger.info("Scrobbles found, reading from file at {}...".format(path))
+            scrobbles = list(iter_failed_scrobbles_from_disk(path))
+            logger.info(
+                "Read {} scrobbles in {}s".format(
+                    len(scrobbles), format(time.time() - start, ".2f")
+                )
+            )
+            return scrobbles
+        except Exception as e:
+            logger.warn("Couldn't read failed scrobbles file!: {}".format(e))
+    return []
+
+
+class ScrobbleLoader(threading.Thread):
+    """
+    Streams the scrobbles in a YAML cache file into 'sink' in the background, 'chunk_size' scrobbles at a time.
+    Parsing runs on its own thread, at most 'prefetch' chunks ahead of the sink, so memory use doesn't grow with the
+    size of the file. 'on_done' is called with True once every scrobble has been handed to the sink, or with False if
+    loading failed.
+    """
+
+    def __init__(
+        self,
+        path,
+        sink,
+        on_done=None,
+        chunk_size=LOAD_CHUNK_SIZE,
+        prefetch=LOAD_PREFETCH_CHUNKS,
+    ):
+        super().__init__(name="yams-loader", daemon=True)
+        self.path = path
+        self.sink = sink
+        self.on_done = on_done
+        self.chunk_size = chunk_size
+        self.loaded = 0
+        self.error = None
+
+        self._chunks = queue.Queue(maxsize=prefetch)
+        self._stopped = threading.Event()
+
+    def _put(self, chunk):
+        while not self._stopped.is_set():
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _parse(self):
+        try:
+            chunk = []
+            for scrobble in iter_failed_scrobbles_from_disk(self.path):
+                chunk.append(scrobble)
+                if len(chunk) >= self.chunk_size:
+                    self._put(chunk)
+                    chunk = []
+                if self._stopped.is_set():
+                    return
+            if chunk:
+                self._put(chunk)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put(None)
+
+    def run(self):
+        start = time.time()
+        logger.info("Loading scrobbles from {} in the background...".format(self.path))
+
+        parser = threading.Thread(
+            target=self._parse, name="yams-loader-parser", daemon=True
+        )
+        parser.start()
+
+        while True:
+            chunk = self._chunks.get()
+            if chunk is None:
+                break
+            try:
+                self.sink(chunk)
+            except Exception as e:
+                self.error = e
+                self._stopped.set()
+                break
+            self.loaded += len(chunk)
+
+        elapsed = time.time() - start
+        if self.error is None:
+            logger.info(
+                "Loaded {} scrobbles from {} in {}s ({} scrobbles/s)".format(
+                    self.loaded,
+                    self.path,
+                    format(elapsed, ".2f"),
+                    format(self.loaded / elapsed if elapsed > 0 else 0, ".0f"),
+                )
+            )
+        else:
+            logger.warn(
+                "Couldn't read failed scrobbles file (stopped after {} scrobbles)!: {}".format(
+                    self.loaded, self.error
+                )
+            )
+
+        if self.on_done:
+            self.on_done(self.error is None)
+
+
+def truncate_pending_scrobbles_list(count, scrobbles, path_to_cache):
+    """
+    Removes 'count' number of scrobbles from the current cached list and then writes to disk if necessary.
+
+    :param count: The number of scrobbles to remove
+    :param scrobbles: The list of cached scrobbles to remove from
+    :param path_to_cache: The path to the cached scrobbles file, if a write to disk is necessary
+
+    :type count: int
+    :type scrobbles: list
+    :type path_to_cache: str
+
+    :return: The truncated list of scrobbles, or an empty list (if the count to remove was larger than the length of the scrobbles list)
+    :rtype: list
+    """
+
+    if count >= len(scrobbles):
+        logger.debug(
+            "Removing all ({}/{}) scrobbles from cache".format(count, len(scrobbles))
+        )
+
+        if os.path.exists(path_to_cache):
+            logger.debug("Removing scrobble cache: {}".format(path_to_cache))
+            os.remove(path_to_cache)
+
+        return []
+    else:
+        scrobbles = scrobbles[count:]
+        logger.debug(
+            "Removed {} scrobbles from cache, {} left to submit.".format(
+                count, len(scrobbles)
+            )
+        )
+        save_failed_scrobbles_to_disk(path_to_cache, scrobbles)
+
+        return scrobbles
+
+
+def scrobble_identity(scrobble):
+    """
+    Returns the key identifying a scrobble: two scrobbles of the same track, by the same artist, started in the same
+    second are the same scrobble as far as Last.FM is concerned.
+
+    :param scrobble: The scrobble
+    :type scrobble: yams.record.Scrobble or dict
+    :rtype: (str,str,int)
+    """
+
+    # Converting first flattens any multi-value tags, so a scrobble has the same identity before and after it's queued
+    scrobble = as_scrobble(scrobble)
+    return (
+        str(scrobble["artist"]),
+        str(scrobble["track"]),
+        int(float(scrobble["timestamp"])),
+    )
+
+
+def triage_scrobbles(scrobbles, oldest):
+    """
+    Sort out a queue of scrobbles in a single pass: scrobbles that are too old for Last.FM to accept, scrobbles
+    missing an artist, track or valid timestamp (which Last.FM ignores) and exact duplicates are removed, and the rest
+    are put in timestamp order.
+
+    :param scrobbles: The queued scrobbles
+    :param oldest: The oldest timestamp Last.FM will still accept
+
+    :type scrobbles: iterable
+    :type oldest: int
+
+    :return: A tuple of (the scrobbles worth submitting, oldest first, a Counter of the removed scrobbles by reason)
+    :rtype: (list,collections.Counter)
+    """
+
+    kept = {}
+    removed = Counter()
+
+    for scrobble in scrobbles:
+        try:
+            identity = scrobble_identity(scrobble)
+        except (KeyError, TypeError, ValueError):
+            removed["malformed"] += 1
+            continue
+
+        if not identity[0] or not identity[1]:
+            removed["malformed"] += 1
+        elif identity[2] < oldest:
+            removed["expired"] += 1
+        elif identity in kept:
+            removed["duplicate"] += 1
+        else:
+            kept[identity] = scrobble
+
+    # sorted() is stable, so scrobbles with the same timestamp stay in the order they were queued
+    return [kept[identity] for identity in sorted(kept, key=lambda i: i[2])], removed
+
+
+class ScrobbleCache:
+    """
+    A queue of scrobbles waiting to be (re)submitted to Last.FM, oldest first.
+    Subclasses decide how the queue is persisted. All public methods are thread safe.
+
+    By default every change is written out as it happens. In write-behind mode changes are only written out every
+    'flush_interval' seconds, once 'flush_threshold' of them have piled up, or when the cache is flushed or closed.
+    """
+
+    # Shared caches are drained by a separate uploader process (yams --uploader), rather than by whoever queued the
+    # scrobbles
+    shared = False
+
+    def __init__(
+        self,
+        write_behind=False,
+        flush_interval=SCROBBLE_DISK_SAVE_INTERVAL,
+        flush_threshold=SCROBBLE_DISK_SAVE_THRESHOLD,
+    ):
+        self._lock = threading.RLock()
+        self.write_behind = write_behind
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        # Number of changes that haven't been written out yet
+        self._dirty = 0
+        self._stop_flushing = threading.Event()
+        # When the queue was last triaged (see triage())
+        self.last_triage = 0
+
+        if write_behind:
+            threading.Thread(
+                target=self._flush_periodically, name="yams-flush", daemon=True
+            ).start()
+
+    def _changed(self, count=1):
+        """
+        Record 'count' changes to the queue, writing them out straight away unless we're in write-behind mode.
+        Must be called with the lock held.
+        """
+
+        self._dirty += count
+        if not self.write_behind or self._dirty >= self.flush_threshold:
+            self.flush()
+
+    def _write_out(self):
+        """ Persist every change made since the last flush. Called with the lock held. """
+        pass
+
+    def _flush_periodically(self):
+        while not self._stop_flushing.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warn("Could not write scrobbles cache to disk: {}".format(e))
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, scrobble):
+        raise NotImplementedError
+
+    def __iter__(self):
+        """
+        Iterate over every queued scrobble in order, without handing any of them out (see pending()). Scrobbles
+        queued or removed while iterating may or may not show up.
+        """
+        raise NotImplementedError
+
+    def append(self, scrobble):
+        """
+        Add a scrobble to the end of the queue, unless it's already queued (see scrobble_identity). Scrobbles are
+        stored (and handed back out) as yams.record.Scrobble objects.
+
+        :param scrobble: The scrobble
+        :type scrobble: yams.record.Scrobble or dict
+
+        :return: True if the scrobble was added, False if it was a duplicate
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def extend(self, scrobbles):
+        """
+        Add several scrobbles to the end of the queue, skipping duplicates
+
+        :param scrobbles: The scrobbles to add
+        :type scrobbles: list
+
+        :return: The number of scrobbles added
+        :rtype: int
+        """
+        with self._lock:
+            return len([scrobble for scrobble in scrobbles if self.append(scrobble)])
+
+    def pending(self, count):
+        """
+        Returns (without removing) the oldest 'count' scrobbles in the queue. Caches that track in-flight scrobbles
+        won't hand these out again until they're released.
+
+        :param count: The maximum number of scrobbles to return
+        :type count: int
+        :rtype: list
+        """
+        raise NotImplementedError
+
+    def truncate(self, count):
+        """
+        Removes the oldest 'count' scrobbles from the queue, e.g. after they've been accepted by Last.FM
+
+        :param count: The number of scrobbles to remove
+        :type count: int
+        """
+        raise NotImplementedError
+
+    def remove(self, scrobbles):
+        """
+        Removes the given scrobbles from the queue, wherever they are in it, e.g. after several batches were submitted
+        at once and only some were accepted. Scrobbles that aren't queued are ignored.
+
+        :param scrobbles: The scrobbles to remove
+        :type scrobbles: list
+
+        :return: The number of scrobbles removed
+        :rtype: int
+        """
+        raise NotImplementedError
+
+    def release(self):
+        """ Put any scrobbles handed out by pending() that weren't truncated (or removed) back in the queue """
+        pass
+
+    def triage(self, max_age=SCROBBLE_MAX_AGE):
+        """
+        Clean up the whole queue in one pass before it's submitted (see triage_scrobbles), and log what was removed
+
+        :param max_age: How old (in seconds) a scrobble can be before Last.FM stops accepting it
+        :type max_age: int
+
+        :return: A Counter of the removed scrobbles by reason, or None if the queue can't be triaged just yet
+        :rtype: collections.Counter
+        """
+
+        start = time.time()
+        with self._lock:
+            removed = self._triage(int(start - max_age))
+            if removed is None:
+                return None
+            self.last_triage = time.time()
+            remaining = len(self)
+
+        if sum(removed.values()) > 0:
+            logger.info(
+                "Removed {} scrobbles from the cache that Last.FM would never accept ({}), {} left to submit. Took {}s".format(
+                    sum(removed.values()),
+                    ", ".join(
+                        "{} {}".format(count, reason)
+                        for reason, count in sorted(removed.items())
+                    ),
+                    remaining,
+                    format(self.last_triage - start, ".2f"),
+                )
+            )
+        return removed
+
+    def _triage(self, oldest):
+        """
+        Remove the scrobbles Last.FM won't accept and put the rest in timestamp order. Called with the lock held.
+
+        :param oldest: The oldest timestamp Last.FM will still accept
+        :type oldest: int
+        :return: A Counter of the removed scrobbles by reason, or None if the queue can't be triaged just yet
+        :rtype: collections.Counter
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """ Make sure everything queued so far is safely on disk """
+        with self._lock:
+            if self._dirty > 0:
+                logger.debug("Writing {} cache changes to disk".format(self._dirty))
+                self._write_out()
+                self._dirty = 0
+
+    def close(self):
+        """ Flush the queue and release any resources held by it """
+        self._stop_flushing.set()
+        self.flush()
+
+
+class YamlScrobbleCache(ScrobbleCache):
+    """
+    The original scrobbles cache: a YAML file that's rewritten in its entirety every time it's written out.
+    The file is loaded in the background; writes are held back until it's been read in full.
+    """
+
+    def __init__(self, path, **write_options):
+        super().__init__(**write_options)
+        self.path = path
+        self._scrobbles = []
+        # identity -> number of copies in the queue (old cache files may well contain duplicates)
+        self._index = Counter()
+        self._loading = False
+        # Set if the file could only be partly read and couldn't be backed up: it's then never written to, so what we
+        # couldn't read isn't lost
+        self._read_only = False
+        # How many entries in the file were skipped, as they were missing an artist, track or timestamp
+        self.skipped = 0
+
+        if os.path.exists(path):
+            self._loading = True
+            self.loader = ScrobbleLoader(path, self._load_chunk, self._load_done)
+            self.loader.start()
+
+    def _load_chunk(self, scrobbles):
+        # Entries that can't be scrobbles are left behind, triage would only throw them out anyway
+        scrobbles, skipped = as_scrobbles(scrobbles)
+        with self._lock:
+            self.skipped += skipped
+            self._scrobbles.extend(scrobbles)
+            self._index.update(scrobble_identity(scrobble) for scrobble in scrobbles)
+
+    def _forget(self, scrobbles):
+        """ Drop removed scrobbles from the index. Must be called with the lock held. """
+
+        for scrobble in scrobbles:
+            identity = scrobble_identity(scrobble)
+            self._index[identity] -= 1
+            if self._index[identity] <= 0:
+                del self._index[identity]
+
+    def _load_done(self, success):
+        with self._lock:
+            if self.skipped > 0:
+                logger.warn(
+                    "Skipped {} scrobbles in {} missing an artist, track or timestamp".format(
+                        self.skipped, self.path
+                    )
+                )
+            if not success:
+                # What we couldn't read would be lost the next time the file's written out, so keep a copy of it
+                backup = self.path + ".unreadable"
+                try:
+                    shutil.copy2(self.path, backup)
+                    logger.warn(
+                        "Only part of {} could be read, the original's been kept at {}".format(
+                            self.path, backup
+                        )
+                    )
+                except OSError as e:
+                    # Without a copy, leave the file alone - new scrobbles are only kept in memory, but everything
+                    # queued is still submitted
+                    logger.error(
+                        "Only part of {} could be read, and it couldn't be backed up ({}), so it won't be written to".format(
+                            self.path, e
+                        )
+                    )
+                    self._read_only = True
+            self._loading = False
+            self.flush()
+
+    def flush(self):
+        # Writing now would throw away whatever we haven't loaded yet
+        with self._lock:
+            if not self._loading:
+                super().flush()
+
+    def _write_out(self):
+        if self._read_only:
+            return
+        if len(self._scrobbles) > 0:
+            save_failed_scrobbles_to_disk(self.path, self._scrobbles)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._scrobbles)
+
+    def __contains__(self, scrobble):
+        with self._lock:
+            return scrobble_identity(scrobble) in self._index
+
+    def __iter__(self):
+        # Wait for the rest of the file, half a queue is no use to anyone
+        if self._loading:
+            self.loader.join()
+        with self._lock:
+            return iter(list(self._scrobbles))
+
+    def _add(self, scrobble):
+        identity = scrobble_identity(scrobble)
+        if identity in self._index:
+            return False
+        self._index[identity] += 1
+        self._scrobbles.append(as_scrobble(scrobble))
+        return True
+
+    def append(self, scrobble):
+        with self._lock:
+            if not self._add(scrobble):
+                return False
+            self._changed()
+            return True
+
+    def extend(self, scrobbles):
+        with self._lock:
+            added = len([scrobble for scrobble in scrobbles if self._add(scrobble)])
+            if added > 0:
+                self._changed(added)
+            return added
+
+    def pending(self, count):
+        with self._lock:
+            return self._scrobbles[:count]
+
+    def truncate(self, count):
+        with self._lock:
+            self._forget(self._scrobbles[:count])
+            if self._loading or self.write_behind or self._read_only:
+                self._scrobbles = self._scrobbles[count:]
+                self._changed(count)
+            else:
+                self._scrobbles = truncate_pending_scrobbles_list(
+                    count, self._scrobbles, self.path
+                )
+
+    def remove(self, scrobbles):
+        with self._lock:
+            identities = set(scrobble_identity(scrobble) for scrobble in scrobbles)
+            removed = [
+                scrobble
+                for scrobble in self._scrobbles
+                if scrobble_identity(scrobble) in identities
+            ]
+            if not removed:
+                return 0
+
+            self._forget(removed)
+            self._scrobbles = [
+                scrobble
+                for scrobble in self._scrobbles
+                if scrobble_identity(scrobble) not in identities
+            ]
+            self._changed(len(removed))
+            return len(removed)
+
+    def _triage(self, oldest):
+        # Only triage once we've got the whole queue
+        if self._loading:
+            return None
+
+        scrobbles, removed = triage_scrobbles(self._scrobbles, oldest)
+        reordered = any(a is not b for a, b in zip(scrobbles, self._scrobbles))
+        if removed or reordered:
+            self._scrobbles = scrobbles
+            self._index = Counter(scrobble_identity(scrobble) for scrobble in scrobbles)
+            self._changed(sum(removed.values()) or 1)
+        return removed
+
+    def close(self):
+        # Anything queued while loading is only written out once the whole file has been read
+        if self._loading:
+            logger.info("Waiting for {} to finish loading...".format(self.path))
+            self.loader.join()
+        super().close()
+
+
+def cache_path(config, extension):
+    """
+    Returns the path of a cache file sitting next to the configured (YAML) cache file, e.g. scrobbles.journal
+
+    :param config: The YAMS config
+    :param extension: The new file extension, without the leading dot
+
+    :type config: dict
+    :type extension: str
+    :rtype: str
+    """
+
+    return "{}.{}".format(os.path.splitext(config["cache_file"])[0], extension)
+
+
+def import_legacy_cache(cache, path):
+    """
+    Move the scrobbles in an old YAML cache file into another cache, in the background. Scrobbles missing an artist,
+    track or timestamp are skipped. The YAML file is renamed once it's been read (to .unreadable if only part of it
+    could be), so this only happens once.
+
+    :param cache: The cache to import into
+    :param path: The path to the YAML cache file
+
+    :type cache: ScrobbleCache
+    :type path: str
+
+    :return: The (already started) loader doing the import, or None if there was nothing to import
+    :rtype: ScrobbleLoader
+    """
+
+    if not os.path.exists(path):
+        return None
+
+    skipped = [0]
+
+    def import_chunk(scrobbles):
+        scrobbles, malformed = as_scrobbles(scrobbles)
+        skipped[0] += malformed
+        cache.extend(scrobbles)
+
+    def import_done(success):
+        cache.flush()
+        if skipped[0] > 0:
+            logger.warn(
+                "Skipped {} scrobbles in {} missing an artist, track or timestamp".format(
+                    skipped[0], path
+                )
+            )
+        # Either way the file's moved aside, so what was imported isn't imported (and submitted) again on every start
+        if success:
+            os.replace(path, path + ".imported")
+            logger.info(
+                "Imported the legacy cache at {} (renamed to {}.imported)".format(
+                    path, path
+                )
+            )
+        else:
+            os.replace(path, path + ".unreadable")
+            logger.warn(
+                "Only part of the legacy cache at {} could be imported, the rest is in {}.unreadable".format(
+                    path, path
+                )
+            )
+
+    loader = ScrobbleLoader(path, import_chunk, import_done)
+    loader.start()
+    return loader
+
+
+def open_scrobble_cache(config):
+    """
+    Open the scrobbles cache selected by the 'cache_backend' config option
+
+    :param config: The YAMS config
+    :type config: dict
+    :rtype: ScrobbleCache
+    """
+
+    backend = config["cache_backend"] if "cache_backend" in config else "journal"
+    write_mode = (
+        config["cache_write_mode"] if "cache_write_mode" in config else "write-through"
+    )
+
+    if write_mode not in CACHE_WRITE_MODES:
+        raise ValueError(
+            "Unknown cache write mode '{}', expected one of: {}".format(
+                write_mode, ", ".join(CACHE_WRITE_MODES)
+            )
+        )
+
+    write_options = {
+        "write_behind": write_mode == "write-behind",
+        "flush_interval": config["cache_flush_interval"]
+        if "cache_flush_interval" in config
+        else SCROBBLE_DISK_SAVE_INTERVAL,
+        "flush_threshold": config["cache_flush_threshold"]
+        if "cache_flush_threshold" in config
+        else SCROBBLE_DISK_SAVE_THRESHOLD,
+    }
+
+    if backend == "yaml":
+        return YamlScrobbleCache(config["cache_file"], **write_options)
+    elif backend == "journal":
+        from yams.journal import ScrobbleJournal
+
+        cache = ScrobbleJournal(
+            cache_path(config, "journal"),
+            fsync_interval=config["journal_fsync_interval"],
+            fsync_batch=config["journal_fsync_batch"],
+            compact_threshold=config["journal_compact_threshold"],
+            **write_options
+        )
+        import_legacy_cache(cache, config["cache_file"])
+        return cache
+    elif backend == "sqlite":
+        from yams.spool import ScrobbleSpool
+
+        cache = ScrobbleSpool(
+            cache_path(config, "sqlite"),
+            acked_retention=config["spool_acked_retention"],
+            **write_options
+        )
+        import_legacy_cache(cache, config["cache_file"])
+        return cache
+    elif backend == "spooldir":
+        from yams.spooldir import SpoolDirectory
+
+        return SpoolDirectory(
+            config["spool_dir"]
+            if "spool_dir" in config
+            else cache_path(config, "spool"),
+            **write_options
+        )
+
+    raise ValueError(
+        "Unknown cache backend '{}', expected one of: {}".format(
+            backend, ", ".join(CACHE_BACKENDS)
+        )
+    )
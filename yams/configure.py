@@ -3,6 +3,7 @@
 from pathlib import Path
 import argparse
 import os
+import re
 import yaml
 import signal
 import logging
@@ -29,6 +30,8 @@ LOG_FILE_NAME = "yams.log"
 DEFAULT_SESSION_FILENAME = ".lastfm_session"
 DEFAULT_PID_FILENAME = "yams.pid"
 DEFAULT_CACHE_FILENAME = "scrobbles.cache"
+# The files (and directories) each player gets its own of, next to the main one, unless its config says where
+PLAYER_FILE_OPTIONS = ["session_file", "cache_file", "spool_dir", "dead_letter_file"]
 
 DEFAULTS = {
     "scrobble_threshold": 50,
@@ -44,6 +47,30 @@ DEFAULTS = {
     "allow_same_track_scrobble_in_a_row": False,
     "disable_log": False,
     "no_daemon": False,
+    "cache_backend": "journal",
+    "cache_write_mode": "write-through",
+    "journal_fsync_interval": 1,
+    "journal_fsync_batch": 32,
+    "journal_compact_threshold": 1000,
+    "spool_acked_retention": 1209600,
+    "recent_scrobbles_size": 1000,
+    "recent_scrobbles_max_age": 86400,
+    "spool_upload_interval": 60,
+    "http_connect_timeout": 5,
+    "http_read_timeout": 15,
+    "request_deadline": 30,
+    "drain_deadline": 120,
+    "drain_concurrency": 4,
+    "rate_limit": 5,
+    "rate_limit_burst": 10,
+    "circuit_breaker_threshold": 3,
+    "backoff_base": 10,
+    "backoff_max": 1800,
+    "response_format": "xml",
+    "now_playing_settle": 2,
+    "watch_mode": "poll",
+    "engine": "sync",
+    "players": [],
 }
 
 logger = logging.getLogger("yams")
@@ -69,6 +96,50 @@ def read_from_file(path, working_config):
         logger.info("Couldn't open config at path {}!: {}".format(path, e))
 
 
+def player_configs(config):
+    """
+    Returns the config for each of the MPD instances listed under 'players', if any: the main config, with the
+    player's own settings (e.g. mpd_host, mpd_port, session_file, scrobble_threshold) on top. A player without a
+    name is named after its host and port, and one without its own session_file or cache_file (or spool_dir,
+    dead_letter_file) gets one next to the main one, with its name added, e.g. scrobbles-kitchen.cache.
+
+    :param config: The YAMS config
+    :type config: dict
+    :rtype: list
+    """
+
+    if "players" not in config or not config["players"]:
+        return []
+
+    players = []
+    names = set()
+    for entry in config["players"]:
+        player = dict(config)
+        del player["players"]
+        player.update(entry)
+        if "name" not in entry:
+            player["name"] = "{}:{}".format(player["mpd_host"], player["mpd_port"])
+        player["name"] = str(player["name"])
+
+        if player["name"] in names:
+            logger.error(
+                "There's more than one player called {}, please give them different names.".format(
+                    player["name"]
+                )
+            )
+            exit(1)
+        names.add(player["name"])
+
+        suffix = re.sub(r"[^\w.-]", "_", player["name"])
+        for option in PLAYER_FILE_OPTIONS:
+            if option in config and config[option] and option not in entry:
+                root, extension = os.path.splitext(config[option])
+                player[option] = "{}-{}{}".format(root, suffix, extension)
+        players.append(player)
+
+    return players
+
+
 def bootstrap_config():
     """ Creates a config directory and writes a suitable base config into it"""
 
@@ -333,6 +404,12 @@ def process_cli_args():
         action="store_true",
         help="If set to True will not exit on initial MPD connection failure. (E.g. always reconnect) Default: False",
     )
+    parser.add_argument(
+        "-u",
+        "--uploader",
+        action="store_true",
+        help="Don't watch MPD, just submit the scrobbles queued in a shared spool directory by other instances of yams (needs the 'spooldir' cache_backend). Only one uploader can run per spool directory. Default: False",
+    )
     parser.add_argument(
         "-a",
         "--attach",
@@ -340,6 +417,43 @@ def process_cli_args():
         help='Runs "tail -F" on a running instance of yams\' log file. "Attaches" to it, for all intents and purposes. NB: You will still need to kill it by hand. Default: False',
     )
 
+    commands = parser.add_subparsers(
+        dest="command",
+        title="commands",
+        metavar="COMMAND",
+        description="Run one of these instead of watching MPD, then exit.",
+    )
+    export_parser = commands.add_parser(
+        "export",
+        help="Write the scrobbles waiting in the cache out to a JSONL or CSV file",
+    )
+    export_parser.add_argument(
+        "bulk_file",
+        nargs="?",
+        default="-",
+        help="The file to write to. Default: stdout",
+        metavar="FILE",
+    )
+    import_parser = commands.add_parser(
+        "import",
+        help="Submit the scrobbles in a JSONL or CSV file (e.g. from another scrobbler or an offline device) to Last.FM",
+    )
+    import_parser.add_argument(
+        "bulk_file",
+        nargs="?",
+        default="-",
+        help="The file to read from. Default: stdin",
+        metavar="FILE",
+    )
+    for command_parser in (export_parser, import_parser):
+        command_parser.add_argument(
+            "-f",
+            "--format",
+            dest="bulk_format",
+            choices=["jsonl", "csv"],
+            help="The file's format. Default: guessed from its extension, or jsonl",
+        )
+
     return parser.parse_args()
 
 
@@ -480,6 +594,12 @@ def configure():
     # 6.1 Lets do this after saving the config, as we don't ever really want to save this to disk
     if args.no_daemon:
         config["no_daemon"] = args.no_daemon
+    if args.uploader:
+        config["uploader"] = args.uploader
+    if args.command:
+        config["command"] = args.command
+        config["bulk_file"] = args.bulk_file
+        config["bulk_format"] = args.bulk_format
 
     # 7 Kill or not? (We're doing this all the way down here as the user might have defined a non-standard pid in their config file)
     if args.kill_daemon:
@@ -502,7 +622,8 @@ def configure():
             os.remove(config["pid_file"])
 
     # 10 Log file setup (specifically set after check_old_pid to ensure the previous log isn't deleted accidentally)
-    if not args.kill_daemon and not config["disable_log"]:
+    # Bulk commands only log to the terminal, so the last run's log is left alone
+    if not args.kill_daemon and not config["disable_log"] and not args.command:
         # The default
         path = config["log_file"]
         if os.path.exists(path):
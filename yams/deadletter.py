@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import threading
+import time
+
+from yams.cache import cache_path
+
+logger = logging.getLogger("yams")
+
+
+class DeadLetters:
+    """
+    The scrobbles Last.FM rejected outright, set aside so they stop holding up the rest of the cache. They're
+    appended to a file one JSON object a line, like 'yams export' writes (with the error and the time they were
+    quarantined added), so they can be looked at, fixed up and sent again with 'yams import'.
+    Thread safe.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def add(self, scrobbles, reason):
+        """
+        Quarantine some scrobbles
+
+        :param scrobbles: The scrobbles Last.FM rejected
+        :param reason: Why it rejected them, e.g. the error it sent back
+
+        :type scrobbles: list
+        :type reason: str
+        """
+
+        if not scrobbles:
+            return
+
+        quarantined = int(time.time())
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as dead_letters:
+                for scrobble in scrobbles:
+                    record = dict(scrobble)
+                    record["error"] = reason
+                    record["quarantined"] = quarantined
+                    dead_letters.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        logger.warn(
+            "Quarantined {} scrobbles Last.FM rejected ({}) in {}".format(
+                len(scrobbles), reason, self.path
+            )
+        )
+
+
+def open_dead_letters(config):
+    """
+    Open the dead letters file, dead_letter_file if it's set, otherwise next to the scrobbles cache
+    (scrobbles.rejected)
+
+    :param config: The YAMS config
+    :type config: dict
+    :rtype: DeadLetters
+    """
+
+    return DeadLetters(
+        config["dead_letter_file"]
+        if "dead_letter_file" in config and config["dead_letter_file"]
+        else cache_path(config, "rejected")
+    )
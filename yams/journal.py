@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from itertools import islice
+import json
+import logging
+import os
+import threading
+import time
+
+from yams.cache import ScrobbleCache, scrobble_identity, triage_scrobbles
+from yams.record import Scrobble, as_scrobble
+
+logger = logging.getLogger("yams")
+
+JOURNAL_ENQUEUE = "enqueue"
+JOURNAL_ACK = "ack"
+# How long (in seconds) to wait before trying again, after compacting the journal failed (e.g. with the disk full)
+JOURNAL_COMPACT_RETRY_INTERVAL = 300
+
+
+class ScrobbleJournal(ScrobbleCache):
+    """
+    An append-only scrobbles cache. Every queued scrobble is written as an 'enqueue' record and every removal as an
+    'ack' record, one JSON object per line, so a change costs a single small write instead of a rewrite of the whole
+    cache.
+
+    Writes are flushed to the OS straight away, but fsync'd in groups: once 'fsync_batch' records are waiting, or
+    'fsync_interval' seconds after the first unsynced write, whichever comes first. Once acknowledged records outnumber
+    the live ones (and there are at least 'compact_threshold' of them), the journal is rewritten without them in the
+    background. In write-behind mode, records are held in memory until the journal is flushed.
+    """
+
+    def __init__(
+        self,
+        path,
+        fsync_interval=1,
+        fsync_batch=32,
+        compact_threshold=1000,
+        **write_options
+    ):
+        super().__init__(**write_options)
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fsync_batch = fsync_batch
+        self.compact_threshold = compact_threshold
+
+        # seq -> scrobble, in the order they were queued
+        self._entries = OrderedDict()
+        # identity -> seq, for constant time duplicate checks
+        self._index = {}
+        self._next_seq = 0
+        # How many acknowledged records the journal file still contains
+        self._acked = 0
+        self._unsynced = 0
+        # Records waiting to be written, in write-behind mode
+        self._buffer = []
+        # Lines written while a compaction is running, these are copied over to the compacted journal
+        self._compaction_tail = None
+        self._compaction_acked = 0
+        # Don't try compacting again before this time, if the last attempt failed
+        self._compact_after = 0
+        self._closed = False
+
+        self._replay()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+        self._wakeup = threading.Condition(self._lock)
+        self._committer = threading.Thread(
+            target=self._run, name="yams-journal", daemon=True
+        )
+        self._committer.start()
+
+    def _replay(self):
+        """ Rebuild the queue from the journal on disk, discarding a torn final record if we crashed mid-write """
+
+        if not os.path.exists(self.path):
+            return
+
+        start = time.time()
+        good_offset = 0
+        offset = 0
+
+        with open(self.path, "rb") as journal:
+            for line in journal:
+                offset += len(line)
+                try:
+                    self._apply(json.loads(line.decode("utf-8")))
+                    good_offset = offset
+                except Exception as e:
+                    logger.warn(
+                        "Skipping unreadable record in scrobble journal {} at byte {}: {}".format(
+                            self.path, offset - len(line), e
+                        )
+                    )
+
+        # Anything after the last good record is a partial write, cut it off so new records start on a fresh line
+        if good_offset < offset:
+            with open(self.path, "rb+") as journal:
+                journal.truncate(good_offset)
+
+        logger.info(
+            "Read {} pending scrobbles from journal {} in {}s".format(
+                len(self._entries), self.path, format(time.time() - start, ".2f")
+            )
+        )
+
+    def _apply(self, record):
+        if record["op"] == JOURNAL_ENQUEUE:
+            scrobble = Scrobble.from_dict(record["scrobble"])
+            self._entries[record["seq"]] = scrobble
+            self._index[scrobble_identity(scrobble)] = record["seq"]
+            self._next_seq = max(self._next_seq, record["seq"] + 1)
+        elif record["op"] == JOURNAL_ACK:
+            for seq in record["seq"]:
+                self._forget(seq)
+            self._acked += len(record["seq"])
+        else:
+            raise ValueError("Unknown journal record: {}".format(record["op"]))
+
+    def _write(self, record):
+        """ Append a record to the journal. Must be called with the lock held. """
+
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+
+        if self.write_behind:
+            self._buffer.append(line)
+            self._changed()
+        else:
+            self._append_lines([line])
+
+    def _write_out(self):
+        lines = self._buffer
+        self._buffer = []
+        self._append_lines(lines)
+        self._sync()
+
+    def _append_lines(self, lines):
+        self._file.writelines(lines)
+        self._file.flush()
+
+        if self._compaction_tail is not None:
+            self._compaction_tail.extend(lines)
+
+        self._unsynced += len(lines)
+        if self._unsynced >= self.fsync_batch:
+            self._sync()
+        else:
+            self._wakeup.notify()
+
+    def _sync(self):
+        if self._unsynced > 0:
+            os.fsync(self._file.fileno())
+            logger.debug("Synced {} journal records to disk".format(self._unsynced))
+            self._unsynced = 0
+
+    def _compaction_due(self):
+        """ Is the journal mostly dead weight? Must be called with the lock held. """
+
+        return (
+            self._compaction_tail is None
+            and self._acked >= self.compact_threshold
+            and self._acked > len(self._entries)
+        )
+
+    def _needs_compaction(self):
+        return self._compaction_due() and time.time() >= self._compact_after
+
+    def _run(self):
+        """ Background thread: group commits pending fsyncs and compacts the journal when it's mostly dead weight """
+
+        while True:
+            with self._lock:
+                while (
+                    not self._closed
+                    and self._unsynced == 0
+                    and not self._needs_compaction()
+                ):
+                    # If compacting failed, wake up again when it's time to retry
+                    self._wakeup.wait(
+                        self._compact_after - time.time()
+                        if self._compaction_due()
+                        else None
+                    )
+                if self._closed:
+                    return
+
+                # Give other writers a chance to join this commit
+                deadline = time.time() + self.fsync_interval
+                while (
+                    not self._closed and self._unsynced > 0 and time.time() < deadline
+                ):
+                    self._wakeup.wait(deadline - time.time())
+                self._sync()
+                compact = self._needs_compaction()
+
+            if compact:
+                self.compact()
+
+    def compact(self):
+        """ Rewrite the journal so it only contains the scrobbles still waiting to be submitted """
+
+        with self._lock:
+            if self._compaction_tail is not None or self._closed:
+                return
+            self.flush()
+            snapshot = list(self._entries.items())
+            self._compaction_tail = []
+            self._compaction_acked = 0
+
+        start = time.time()
+        compacted_path = self.path + ".compact"
+
+        try:
+            with open(compacted_path, "w", encoding="utf-8") as compacted:
+                for seq, scrobble in snapshot:
+                    compacted.write(
+                        json.dumps(
+                            {
+                                "op": JOURNAL_ENQUEUE,
+                                "seq": seq,
+                                "scrobble": scrobble.to_dict(),
+                            },
+                            separators=(",", ":"),
+                        )
+                        + "\n"
+                    )
+
+                # Anything written since we took our snapshot has to come along, too
+                with self._lock:
+                    compacted.writelines(self._compaction_tail)
+                    compacted.flush()
+                    os.fsync(compacted.fileno())
+
+                    self._sync()
+                    self._file.close()
+                    os.replace(compacted_path, self.path)
+                    self._file = open(self.path, "a", encoding="utf-8")
+
+                    self._acked = self._compaction_acked
+                    self._compaction_tail = None
+
+            logger.info(
+                "Compacted scrobble journal to {} records in {}s".format(
+                    len(snapshot), format(time.time() - start, ".2f")
+                )
+            )
+        except Exception as e:
+            logger.warn(
+                "Could not compact scrobble journal, trying again in {}s: {}".format(
+                    JOURNAL_COMPACT_RETRY_INTERVAL, e
+                )
+            )
+            with self._lock:
+                self._compaction_tail = None
+                self._compact_after = time.time() + JOURNAL_COMPACT_RETRY_INTERVAL
+                if self._file.closed:
+                    self._file = open(self.path, "a", encoding="utf-8")
+            if os.path.exists(compacted_path):
+                os.remove(compacted_path)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _forget(self, seq):
+        """ Remove a scrobble from the queue and the index. Must be called with the lock held. """
+
+        scrobble = self._entries.pop(seq, None)
+        if scrobble is None:
+            return
+        identity = scrobble_identity(scrobble)
+        if self._index.get(identity) == seq:
+            del self._index[identity]
+
+    def __contains__(self, scrobble):
+        with self._lock:
+            return scrobble_identity(scrobble) in self._index
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self._entries.values()))
+
+    def append(self, scrobble):
+        with self._lock:
+            identity = scrobble_identity(scrobble)
+            if identity in self._index:
+                return False
+
+            scrobble = as_scrobble(scrobble)
+            seq = self._next_seq
+            self._next_seq += 1
+            self._entries[seq] = scrobble
+            self._index[identity] = seq
+            self._write(
+                {"op": JOURNAL_ENQUEUE, "seq": seq, "scrobble": scrobble.to_dict()}
+            )
+            return True
+
+    def extend(self, scrobbles):
+        with self._lock:
+            added = len([scrobble for scrobble in scrobbles if self.append(scrobble)])
+            self._sync()
+            return added
+
+    def pending(self, count):
+        with self._lock:
+            return list(islice(self._entries.values(), count))
+
+    def truncate(self, count):
+        with self._lock:
+            acked = list(islice(self._entries.keys(), count))
+            if not acked:
+                return
+            for seq in acked:
+                self._forget(seq)
+            self._acknowledge(acked)
+
+            logger.debug(
+                "Removed {} scrobbles from journal, {} left to submit.".format(
+                    len(acked), len(self._entries)
+                )
+            )
+
+    def remove(self, scrobbles):
+        with self._lock:
+            acked = []
+            for scrobble in scrobbles:
+                seq = self._index.get(scrobble_identity(scrobble))
+                if seq is not None:
+                    self._forget(seq)
+                    acked.append(seq)
+            if acked:
+                self._acknowledge(acked)
+            return len(acked)
+
+    def _acknowledge(self, acked):
+        """ Journal the removal of the given scrobbles. Must be called with the lock held. """
+
+        self._write({"op": JOURNAL_ACK, "seq": acked})
+        self._acked += len(acked)
+        if self._compaction_tail is not None:
+            self._compaction_acked += len(acked)
+        if self._needs_compaction():
+            self._wakeup.notify()
+
+    def _triage(self, oldest):
+        entries = list(self._entries.items())
+        scrobbles, removed = triage_scrobbles(
+            (scrobble for seq, scrobble in entries), oldest
+        )
+
+        seqs = {id(scrobble): seq for seq, scrobble in entries}
+        self._entries = OrderedDict(
+            (seqs[id(scrobble)], scrobble) for scrobble in scrobbles
+        )
+        self._index = {
+            scrobble_identity(scrobble): seq for seq, scrobble in self._entries.items()
+        }
+
+        # Only removals are journaled, the new order is rebuilt by triaging again after a restart
+        dropped = [seq for seq, scrobble in entries if seq not in self._entries]
+        if dropped:
+            self._acknowledge(dropped)
+        return removed
+
+    def flush(self):
+        with self._lock:
+            super().flush()
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._stop_flushing.set()
+            self.flush()
+            self._closed = True
+            self._wakeup.notify()
+        self._committer.join()
+        with self._lock:
+            self._file.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger("yams")
+
+# Last.FM's error code for "Rate limit exceeded"
+LASTFM_RATE_LIMIT_ERROR = 29
+
+# When Last.FM tells us to slow down, the rate is cut by this factor (but never below MIN_RATE requests a second)...
+THROTTLE_FACTOR = 0.5
+MIN_RATE = 0.1
+# ...then it creeps back up by this fraction of the configured rate with every request that gets through
+RECOVERY_STEP = 0.05
+
+
+class TokenBucket:
+    """
+    A token bucket rate limiter: requests can be made at 'rate' a second on average, in bursts of up to 'capacity'.
+    The rate is cut back whenever Last.FM says we're going too fast, and recovers gradually after that.
+    Thread safe.
+    """
+
+    def __init__(self, rate, capacity):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        """ Must be called with the lock held """
+
+        now = time.time()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a token
+
+        :param timeout: How long (in seconds) to wait at most, forever if not given
+        :type timeout: float
+
+        :return: True if we got a token, False if we'd have had to wait longer than 'timeout'
+        :rtype: bool
+        """
+
+        give_up = None if timeout is None else time.time() + timeout
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate
+
+            if give_up is not None and time.time() + wait > give_up:
+                return False
+            time.sleep(wait)
+
+    def available(self):
+        """ Returns how many requests could be made right now, without waiting """
+
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def throttle(self):
+        """ Last.FM says we're going too fast: slow down, and start from an empty bucket """
+
+        with self._lock:
+            self.rate = max(MIN_RATE, self.rate * THROTTLE_FACTOR)
+            self._tokens = 0
+            self._updated = time.time()
+        logger.warn(
+            "Rate limited by Last.FM, slowing down to {} requests/s".format(
+                format(self.rate, ".2f")
+            )
+        )
+
+    def recover(self):
+        """ A request got through, speed back up a little (if we'd slowed down) """
+
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(
+                    self.max_rate, self.rate + self.max_rate * RECOVERY_STEP
+                )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+import time
+
+from yams.cache import cache_path, scrobble_identity
+from yams.record import as_scrobble
+
+logger = logging.getLogger("yams")
+
+# How long (in seconds) to take a track to be, if we don't know
+RECENT_SCROBBLE_WINDOW = 600
+# Playing a track again can start a little sooner than one track length later, as far as we can tell (we only see
+# where it's got to every so often), so the window two plays count as one in is this much shorter (in seconds), or
+# half a track length shorter for tracks shorter than twice this
+RECENT_SCROBBLE_MARGIN = 10
+
+
+class RecentScrobbles:
+    """
+    A small, persistent index of the scrobbles Last.FM has recently accepted, so the same play can't be submitted
+    twice - not even after a restart, or an MPD reconnect that makes us watch the same track again.
+
+    A scrobble is a duplicate of a recent one if it's the same track by the same artist, started within one track
+    length of it (or RECENT_SCROBBLE_WINDOW seconds, if we don't know the duration), less RECENT_SCROBBLE_MARGIN:
+    playing a track again can't start any sooner than that. At most 'size' scrobbles are remembered, least recently
+    seen first out, and none for longer than 'max_age' seconds after Last.FM accepted them (however old the scrobble
+    itself is, e.g. one from a backlog).
+    """
+
+    def __init__(self, path, size=1000, max_age=86400):
+        self.path = path
+        self.size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+
+        # identity -> (track length, when it was accepted), least recently seen first
+        self._entries = OrderedDict()
+        # (artist, track) -> set of timestamps, for looking up plays of the same track
+        self._by_track = {}
+
+        self._read()
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            now = time.time()
+            with open(self.path) as recent_file:
+                for entry in json.load(recent_file):
+                    # Older indexes didn't say when a scrobble was accepted, so count from now
+                    artist, track, timestamp, length = entry[:4]
+                    accepted = entry[4] if len(entry) > 4 else now
+                    self._remember((artist, track, timestamp), length, accepted)
+            self._evict()
+            logger.debug(
+                "Read {} recent scrobbles from {}".format(len(self._entries), self.path)
+            )
+        except Exception as e:
+            logger.warn(
+                "Could not read recent scrobbles from {}: {}".format(self.path, e)
+            )
+
+    def _write(self):
+        """ Save the index, atomically. Must be called with the lock held. """
+
+        temporary_path = self.path + ".tmp"
+        try:
+            with open(temporary_path, "w") as recent_file:
+                json.dump(
+                    [
+                        list(identity) + list(entry)
+                        for identity, entry in self._entries.items()
+                    ],
+                    recent_file,
+                    separators=(",", ":"),
+                )
+            os.replace(temporary_path, self.path)
+        except Exception as e:
+            logger.warn(
+                "Could not write recent scrobbles to {}: {}".format(self.path, e)
+            )
+
+    def _remember(self, identity, length, accepted):
+        self._entries[identity] = (length, accepted)
+        self._entries.move_to_end(identity)
+        self._by_track.setdefault(identity[:2], set()).add(identity[2])
+
+    def _forget(self, identity):
+        del self._entries[identity]
+        timestamps = self._by_track[identity[:2]]
+        timestamps.discard(identity[2])
+        if not timestamps:
+            del self._by_track[identity[:2]]
+
+    def _evict(self):
+        """ Drop scrobbles accepted more than max age ago, then the least recently seen ones if we're over size """
+
+        oldest = time.time() - self.max_age
+        for identity in [
+            identity
+            for identity, (_, accepted) in self._entries.items()
+            if accepted < oldest
+        ]:
+            self._forget(identity)
+        while len(self._entries) > self.size:
+            self._forget(next(iter(self._entries)))
+
+    @staticmethod
+    def _length(scrobble):
+        try:
+            return int(float(scrobble["duration"])) or RECENT_SCROBBLE_WINDOW
+        except (KeyError, ValueError):
+            return RECENT_SCROBBLE_WINDOW
+
+    @staticmethod
+    def _window(length):
+        """ Returns how close together (in seconds) two plays of a track 'length' seconds long count as one """
+
+        return length - min(RECENT_SCROBBLE_MARGIN, length / 2)
+
+    def _match(self, scrobble):
+        """ Returns the identity of the recent scrobble the given one duplicates, or None. Lock must be held. """
+
+        artist, track, timestamp = scrobble_identity(scrobble)
+        for recent_timestamp in self._by_track.get((artist, track), ()):
+            identity = (artist, track, recent_timestamp)
+            window = self._window(
+                max(self._entries[identity][0], self._length(scrobble))
+            )
+            if abs(timestamp - recent_timestamp) < window:
+                return identity
+        return None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, scrobble):
+        """
+        Has this scrobble (or another play it can't be told apart from) been accepted recently?
+
+        :param scrobble: The scrobble
+        :type scrobble: yams.record.Scrobble or dict
+        :rtype: bool
+        """
+
+        with self._lock:
+            identity = self._match(scrobble)
+            if identity is None:
+                return False
+            self._entries.move_to_end(identity)
+            return True
+
+    def add(self, scrobbles):
+        """
+        Remember that Last.FM has accepted these scrobbles, and save the index to disk
+
+        :param scrobbles: The accepted scrobbles
+        :type scrobbles: list
+        """
+
+        accepted = int(time.time())
+        with self._lock:
+            for scrobble in scrobbles:
+                scrobble = as_scrobble(scrobble)
+                self._remember(
+                    scrobble_identity(scrobble), self._length(scrobble), accepted
+                )
+            self._evict()
+            self._write()
+
+
+def open_recent_scrobbles(config):
+    """
+    Open the index of recently accepted scrobbles, which sits next to the scrobbles cache (scrobbles.recent)
+
+    :param config: The YAMS config
+    :type config: dict
+    :rtype: RecentScrobbles
+    """
+
+    return RecentScrobbles(
+        cache_path(config, "recent"),
+        size=config["recent_scrobbles_size"]
+        if "recent_scrobbles_size" in config
+        else 1000,
+        max_age=config["recent_scrobbles_max_age"]
+        if "recent_scrobbles_max_age" in config
+        else 86400,
+    )
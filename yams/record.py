@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+from collections.abc import Mapping
+import sys
+from urllib.parse import quote_plus
+
+# Every field a queued scrobble can have, in the order Last.FM documents them
+SCROBBLE_FIELDS = (
+    "artist",
+    "track",
+    "timestamp",
+    "album",
+    "trackNumber",
+    "albumArtist",
+    "duration",
+)
+
+# Fields whose values are shared by lots of scrobbles (e.g. everything off the same album), these are interned
+INTERNED_FIELDS = ("artist", "album", "albumArtist", "trackNumber")
+
+
+class Scrobble(Mapping):
+    """
+    A scrobble waiting to be submitted. Stored in slots rather than a dict and with its artist/album strings interned,
+    so a backlog of thousands of scrobbles from the same handful of albums stays small.
+
+    Behaves like a read-only dict of the fields that are set, so it can be used anywhere a scrobble dict could.
+    """
+
+    __slots__ = SCROBBLE_FIELDS + ("_fragments",)
+
+    def __init__(
+        self,
+        artist,
+        track,
+        timestamp,
+        album=None,
+        trackNumber=None,
+        albumArtist=None,
+        duration=None,
+    ):
+        self.artist = sys.intern(str(artist))
+        self.track = str(track)
+        self.timestamp = timestamp
+        self.album = None if album is None else sys.intern(str(album))
+        self.trackNumber = None if trackNumber is None else sys.intern(str(trackNumber))
+        self.albumArtist = None if albumArtist is None else sys.intern(str(albumArtist))
+        self.duration = None if duration is None else str(duration)
+        self._fragments = None
+
+    @classmethod
+    def from_dict(cls, scrobble):
+        """
+        Create a Scrobble from a scrobble dict (e.g. one created by make_scrobble, or read from an old cache file).
+        Unknown keys are dropped.
+
+        :param scrobble: The scrobble's fields
+        :type scrobble: dict
+        :rtype: Scrobble
+        """
+
+        fields = {}
+        for field in SCROBBLE_FIELDS:
+            if field in scrobble:
+                value = scrobble[field]
+                # Just in case an old cache has held on to one of mpd's multi-value tags
+                if isinstance(value, list):
+                    # An empty tag is as good as a missing one
+                    if not value:
+                        continue
+                    value = value[0]
+                fields[field] = value
+        return cls(**fields)
+
+    def fragments(self):
+        """
+        Returns the scrobble's fields encoded for a request to Last.FM, as (field, UTF-8 value, URL-encoded value)
+        tuples: the first for the signature, the second for the request body. They're worked out the first time a
+        scrobble is sent, then kept, so retrying it doesn't mean encoding it all over again.
+
+        :rtype: tuple
+        """
+
+        if self._fragments is None:
+            self._fragments = tuple(
+                (field, value.encode("utf-8"), quote_plus(value).encode("ascii"))
+                for field, value in ((field, str(self[field])) for field in self)
+            )
+        return self._fragments
+
+    def to_dict(self):
+        """ Returns the scrobble as a plain dict, e.g. for serialization """
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        value = getattr(self, key) if key in SCROBBLE_FIELDS else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self):
+        for field in SCROBBLE_FIELDS:
+            if getattr(self, field) is not None:
+                yield field
+
+    def __len__(self):
+        return len([field for field in self])
+
+    def __repr__(self):
+        return "Scrobble({})".format(self.to_dict())
+
+
+def as_scrobble(scrobble):
+    """
+    Returns the given scrobble as a Scrobble, converting it if it's a dict
+
+    :param scrobble: The scrobble
+    :type scrobble: Scrobble or dict
+    :rtype: Scrobble
+    """
+
+    if isinstance(scrobble, Scrobble):
+        return scrobble
+    return Scrobble.from_dict(scrobble)
+
+
+def as_scrobbles(scrobbles):
+    """
+    Returns the given scrobbles (e.g. read from an old cache file) as Scrobbles, skipping any that can't be one as
+    they're missing an artist, track or timestamp. Last.FM would never accept those anyway, see
+    yams.cache.triage_scrobbles.
+
+    :param scrobbles: The scrobbles
+    :type scrobbles: iterable
+
+    :return: The Scrobbles, and how many were skipped
+    :rtype: (list,int)
+    """
+
+    converted = []
+    skipped = 0
+    for scrobble in scrobbles:
+        try:
+            converted.append(as_scrobble(scrobble))
+        except (TypeError, ValueError):
+            skipped += 1
+    return converted, skipped
@@ -1,63 +1,77 @@
 #!/usr/bin/env python3
 
-import requests, hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+from functools import lru_cache
+import hashlib
+import json
 import xml.etree.ElementTree as ET
 from mpd import MPDClient
 from mpd.base import ConnectionError
-import select
-from pathlib import Path
+import signal
+import socket
+import threading
 import time
 import logging
-import yaml
 import os
+import re
 from sys import exit
-
-from yams.configure import configure, remove_log_stream_of_type
+from urllib.parse import quote_plus
+
+from yams.configure import configure, player_configs, remove_log_stream_of_type
+from yams.cache import open_scrobble_cache
+from yams.record import as_scrobble
+from yams.recent import open_recent_scrobbles
+from yams.deadletter import open_dead_letters
+from yams import transport
 import yams
 
 MAX_TRACKS_PER_SCROBBLE = 50
 SCROBBLE_RETRY_INTERVAL = 10
-SCROBBLE_DISK_SAVE_INTERVAL = 1200
+# How often (in seconds) the whole cache is triaged before submitting from it
+CACHE_TRIAGE_INTERVAL = 3600
+# How many batches to have in flight at once when draining a backlog
+DRAIN_CONCURRENCY = 4
+
+# Why Last.FM ignored a scrobble (the code of its ignoredMessage, 0 meaning it was accepted). Only hitting the daily
+# limit is worth trying again, the rest will be ignored however many times they're sent.
+IGNORED_REASONS = {
+    1: "artist ignored",
+    2: "track ignored",
+    3: "timestamp too old",
+    4: "timestamp too new",
+    5: "daily scrobble limit exceeded",
+}
+RETRYABLE_IGNORED_CODES = {5}
+
+# Last.FM's error code for "Invalid parameters": it won't take a request because of what's in it. When a batch of
+# scrobbles is rejected, it's split up to find the ones to blame - unless BISECTION_GIVE_UP scrobbles have been
+# rejected on their own without any others getting through.
+REJECTED_BATCH_ERRORS = {6}
+BISECTION_GIVE_UP = 4
+LASTFM_ERROR_PATTERN = re.compile(r'<error\s+code="(\d+)"|"error"\s*:\s*(\d+)')
+
+# The formats Last.FM can respond in. JSON's cheaper to parse, XML is what Last.FM sends if you don't ask.
+RESPONSE_FORMATS = ["xml", "json"]
+_response_format = "xml"
+
+# How to keep an eye on the track that's playing: by polling MPD every update_interval seconds, or by waiting on
+# MPD's idle command, and waking up just when the track's due to be watched or scrobbled
+WATCH_MODES = ["poll", "idle"]
+# Wake up this long (in seconds) after a track's due, so it's definitely past the threshold by the time we check
+IDLE_WAKE_MARGIN = 0.25
+# How many tracks to remember the details of (see TrackCache)
+TRACK_CACHE_SIZE = 32
+# What runs the daemon: the original loop (blocking on MPD and sending from an uploader thread), or an asyncio event
+# loop that does it all at once (see yams.aio)
+ENGINES = ["sync", "asyncio"]
+
+# Pre-encoded request bodies (see encode_scrobbles) are sent as a form, like requests does with a dict
+FORM_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
 
 logger = logging.getLogger("yams")
 
-SCROBBLES = str(Path(Path.home(), ".config/yams/scrobbles.cache"))
-
-
-def save_failed_scrobbles_to_disk(path, scrobbles):
-    logger.info("Writing scrobbles to disk...")
-    if os.path.exists(path):
-        os.remove(path)
-
-    with open(path, "w+") as file_stream:
-        yaml.dump(
-            {"scrobbles": scrobbles},
-            file_stream,
-            default_flow_style=False,
-            Dumper=yaml.Dumper,
-        )
-    logger.info("Failed scrobbles written to: {}".format(path))
-
-
-def read_failed_scrobbles_from_disk(path):
-
-    if os.path.exists(path):
-        try:
-            with open(path) as scrobbles_file_stream:
-                scrobbles_file = yaml.load(
-                    scrobbles_file_stream, Loader=yaml.FullLoader
-                )
-
-                logger.info("Scrobbles found, reading from file at {}...".format(path))
-                if "scrobbles" in scrobbles_file:
-                    for scrobble in scrobbles_file["scrobbles"]:
-                        for key in scrobble.keys():
-                            logger.debug("[{}]: {}".format(key, scrobble[key]))
-                    return scrobbles_file["scrobbles"]
-        except Exception as e:
-            logger.warn("Couldn't read failed scrobbles file!: {}".format(e))
-    return []
-
 
 def sign_signature(parameters, secret=""):
     """
@@ -76,11 +90,13 @@ def sign_signature(parameters, secret=""):
     to_hash = ""
 
     hasher = hashlib.md5()
+    debug = logger.isEnabledFor(logging.DEBUG)
     for key in keys:
         hasher.update(str(key).encode("utf-8"))
         hasher.update(str(parameters[key]).encode("utf-8"))
         # to_hash += str(key)+str(parameters[key])
-        logger.debug("Hashing: {}".format(str(key) + str(parameters[key])))
+        if debug:
+            logger.debug("Hashing: {}".format(str(key) + str(parameters[key])))
 
     if len(secret) > 0:
         hasher.update(secret.encode("utf-8"))
@@ -91,37 +107,170 @@ def sign_signature(parameters, secret=""):
     return hashed_form
 
 
-def make_request(url, parameters, POST=False):
+@lru_cache(maxsize=None)
+def indexed_key(field, index):
+    """
+    Returns the key for one of a batch's scrobble fields, e.g. 'track[12]', as UTF-8 (for the signature) and
+    URL-encoded (for the request body)
+
+    :rtype: (bytes,bytes)
+    """
+
+    key = "{}[{}]".format(field, index)
+    return key.encode("utf-8"), quote_plus(key).encode("ascii")
+
+
+@lru_cache(maxsize=None)
+def signing_order(count):
     """
-    Make a generic GET or POST request to an URL, and parse its resultant XML. Can throw an exception.
+    Returns the indices of a batch of 'count' scrobbles in the order sign_signature would come across them, i.e.
+    sorted as strings: 'track[10]' comes before 'track[1]', as ']' sorts after '0'
+
+    :rtype: tuple
+    """
+
+    return tuple(sorted(range(count), key=lambda index: "{}]".format(index)))
+
+
+def encode_scrobbles(tracks, api_key, api_secret, session_key):
+    """
+    Build the signed, URL-encoded body of a track.scrobble request, from each scrobble's pre-encoded fields (see
+    yams.record.Scrobble.fragments), without sorting the whole request's worth of keys or encoding any value twice.
+    Signs exactly as sign_signature would.
+
+    :param tracks: The scrobbles to send (no more than MAX_TRACKS_PER_SCROBBLE), as Scrobble objects or scrobble dicts
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+
+    :type tracks: list
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+
+    :rtype: bytes
+    """
+
+    parameters = {"method": "track.scrobble", "api_key": api_key, "sk": session_key}
+
+    # field -> {index: (UTF-8 value, URL-encoded value)}
+    fields = {}
+    for index, track in enumerate(tracks):
+        for field, signed, encoded in as_scrobble(track).fragments():
+            fields.setdefault(field, {})[index] = (signed, encoded)
+
+    # Every 'field[i]' key sorts together, where 'field[' would
+    blocks = sorted(
+        [(name, name) for name in parameters]
+        + [(field + "[", field) for field in fields]
+    )
+    order = signing_order(len(tracks))
+
+    signature = []
+    body = []
+    for _, name in blocks:
+        if name in parameters:
+            value = str(parameters[name])
+            signature += [name.encode("utf-8"), value.encode("utf-8")]
+            body.append(
+                "{}={}".format(quote_plus(name), quote_plus(value)).encode("ascii")
+            )
+            continue
+
+        values = fields[name]
+        for index in order:
+            if index in values:
+                signed_key, encoded_key = indexed_key(name, index)
+                signed, encoded = values[index]
+                signature += [signed_key, signed]
+                body.append(encoded_key + b"=" + encoded)
+
+    signature.append(api_secret.encode("utf-8"))
+    body.append(b"api_sig=" + hashlib.md5(b"".join(signature)).hexdigest().encode())
+    return b"&".join(body)
+
+
+def configure_response_format(config):
+    """
+    Set the format Last.FM is asked to respond to scrobbles and now playing updates in, from the config:
+    response_format, one of RESPONSE_FORMATS
+
+    :param config: The YAMS config
+    :type config: dict
+    """
+
+    global _response_format
+
+    response_format = (
+        config["response_format"] if "response_format" in config else "xml"
+    )
+    if response_format not in RESPONSE_FORMATS:
+        logger.warn(
+            "Unknown response_format '{}', expected one of: {}. Using xml.".format(
+                response_format, ", ".join(RESPONSE_FORMATS)
+            )
+        )
+        response_format = "xml"
+    _response_format = response_format
+
+
+def make_request(url, parameters, POST=False, deadline=None, response_format="xml"):
+    """
+    Make a generic GET or POST request to an URL, and parse its response. Can throw an exception.
+    Requests go through a pool of keep-alive connections (see yams.transport).
     :param url: The URL to make the request to
-    :param parameters: A dictionary of data to send with your request
+    :param parameters: A dictionary of data to send with your request, or an already URL-encoded POST body
     :param POST: (Optional) A POST request will be sent (instead of GET) if this is True
+    :param deadline: (Optional) The operation this request is part of, bounding how long it can take
+    :param response_format: (Optional) The format to ask Last.FM to respond in, one of RESPONSE_FORMATS
 
     :type url: str
-    :type parameters: dict
+    :type parameters: dict or bytes
     :type POST: bool
+    :type deadline: yams.transport.Deadline
+    :type response_format: str
 
-    :return: The parsed XML object
-    :rtype: xml.etree.ElementTree
+    :raises yams.transport.RequestTimeout: If the request timed out
+    :raises yams.transport.HTTPStatusError: If Last.FM responded with an HTTP error
+
+    :return: The parsed XML object (or JSON dict), None if it couldn't be parsed
+    :rtype: xml.etree.ElementTree or dict
     """
 
-    logger.debug("Making request to '{}':\n'{}'".format(url, parameters))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Making request to '{}':\n'{}'".format(url, parameters))
 
-    if not POST:
-        response = requests.get(url, parameters)
+    # The format isn't part of the signature, so it's added after signing
+    if isinstance(parameters, bytes):
+        if response_format != "xml":
+            parameters += "&format={}".format(response_format).encode("ascii")
+        response = transport.request(
+            "POST", url, deadline, data=parameters, headers=FORM_HEADERS
+        )
     else:
-        response = requests.post(url, data=parameters)
+        if response_format != "xml":
+            parameters = dict(parameters, format=response_format)
+
+        if not POST:
+            response = transport.request("GET", url, deadline, params=parameters)
+        else:
+            response = transport.request("POST", url, deadline, data=parameters)
 
-    logger.debug("Response: {}".format(response.text))
+    if debug:
+        logger.debug("Response: {}".format(response.text))
 
     if response.ok:
+        # Parsed straight from the bytes, without decoding them into a string first
         try:
-            xml = ET.fromstring(response.text)
-            return xml
+            if response_format == "json":
+                return json.loads(response.content)
+            return ET.fromstring(response.content)
         except Exception as e:
             logger.error(
-                "Something went wrong parsing the XML. Error: {}. Failing...".format(e)
+                "Something went wrong parsing the {}. Error: {}. Failing...".format(
+                    response_format.upper(), e
+                )
             )
             return None
     logger.info(
@@ -130,7 +279,9 @@ def make_request(url, parameters, POST=False):
         )
     )
     logger.info("Response: {}".format(response.text))
-    return None
+    raise transport.HTTPStatusError(
+        response.status_code, response.reason, response.text
+    )
 
 
 def get_token(url, api_key, api_secret):
@@ -276,7 +427,9 @@ def extract_single(container, key):
     return ""
 
 
-def now_playing(track_info, status, url, api_key, api_secret, session_key):
+def now_playing(
+    track_info, status, url, api_key, api_secret, session_key, deadline=None
+):
     """
     Send your currently playing track's info to Last.FM
 
@@ -286,12 +439,14 @@ def now_playing(track_info, status, url, api_key, api_secret, session_key):
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
+    :param deadline: How long the request can take, request_deadline seconds if not given
 
     :type track_info: dict
     :type url: str
     :type api_key: str
     :type api_secret: str
     :type session_key: str
+    :type deadline: yams.transport.Deadline
     """
 
     parameters = make_scrobble(
@@ -307,11 +462,14 @@ def now_playing(track_info, status, url, api_key, api_secret, session_key):
     # logger.info(parameters)
 
     try:
-        xml = make_request(url, parameters, True)
+        make_request(url, parameters, True, deadline, _response_format)
         # logger.info(xml.tag)
         # for child in xml[0]:
         #    logger.info(child.text)
         logger.info("Now playing was a success!")
+    except transport.RequestTimeout as e:
+        logger.warn("Timed out sending now playing to Last.FM!")
+        logger.debug("Error: {}".format(e))
     except Exception as e:
         logger.warn("Could not send now playing Last.FM!")
         logger.debug("Error: {}".format(e))
@@ -365,93 +523,363 @@ def make_scrobble(track_info, status, api_secret=None, **other):
     return scrobble
 
 
-def scrobble_tracks(tracks, url, api_key, api_secret, session_key):
+def response_error(response):
+    """
+    Returns the error Last.FM responded with, in a response to a request it turned down without an HTTP error
+    status, None if it didn't
+
+    :param response: The parsed response
+    :type response: xml.etree.ElementTree or dict
+    :rtype: str
+    """
+
+    if isinstance(response, dict):
+        if "error" not in response:
+            return None
+        return json.dumps(response)
+    if response.get("status") != "failed":
+        return None
+    return ET.tostring(response, encoding="unicode")
+
+
+def accepted_count(response):
+    """
+    Returns how many scrobbles Last.FM accepted, going by a track.scrobble response's totals
+
+    :param response: The parsed response
+    :type response: xml.etree.ElementTree or dict
+    :rtype: int
+    """
+
+    if isinstance(response, dict):
+        return int(response["scrobbles"]["@attr"]["accepted"])
+    return int(response.find("scrobbles").get("accepted"))
+
+
+def ignored_codes(response):
     """
-    Attempts to scrobble multiple tracks at once to Last.FM
+    Returns the ignoredMessage code of each scrobble in a track.scrobble response, in the order they were sent (0
+    meaning it was accepted), or None if the response doesn't list them
+
+    :param response: The parsed response
+    :type response: xml.etree.ElementTree or dict
+    :rtype: list
+    """
+
+    if isinstance(response, dict):
+        scrobbles = response.get("scrobbles", {}).get("scrobble")
+        if scrobbles is None:
+            return None
+        # A lone scrobble isn't wrapped in a list
+        if isinstance(scrobbles, dict):
+            scrobbles = [scrobbles]
+        messages = [scrobble.get("ignoredMessage") for scrobble in scrobbles]
+    else:
+        scrobbles = response.find("scrobbles")
+        if scrobbles is None:
+            return None
+        messages = [
+            scrobble.find("ignoredMessage")
+            for scrobble in scrobbles.findall("scrobble")
+        ]
 
-    :param tracks: The list of failed scrobbles, in the form of the scrobbles cache
+    codes = []
+    for message in messages:
+        try:
+            codes.append(int(message.get("code", 0)) if message is not None else 0)
+        except ValueError:
+            codes.append(-1)
+    return codes
+
+
+def post_scrobbles(tracks, url, api_key, api_secret, session_key, deadline=None):
+    """
+    Send one track.scrobble request for the given tracks (no more than MAX_TRACKS_PER_SCROBBLE of them), and sort
+    them by what Last.FM made of each one (see IGNORED_REASONS). Can throw an exception.
+
+    :param tracks: The scrobbles to send, as Scrobble objects or scrobble dicts
     :param url: The base Last.FM API url
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
+    :param deadline: How long the request can take, request_deadline seconds if not given
 
     :type tracks: list
     :type url: str
     :type api_key: str
     :type api_secret: str
     :type session_key: str
+    :type deadline: yams.transport.Deadline
+
+    :raises yams.transport.RequestTimeout: If the request timed out
+    :raises yams.transport.HTTPStatusError: If Last.FM responded with an HTTP error (see is_rejected_batch)
 
-    :return: Returns a tuple of (accepted count of scrobbles, submitted count of scrobbles). This will not always be the same as the amount of scrobbles you sent in, so you should truncate your cache accordingly.
-    :rtype: (int,int)
+    :return: Returns a tuple of (accepted scrobbles, scrobbles Last.FM will never accept, scrobbles to try again)
+    :rtype: (list,list,list)
     """
 
-    # Sanity check
-    if len(tracks) < 1:
-        logger.debug("Failed sanity check for scrobble tracks")
-        return
+    if logger.isEnabledFor(logging.DEBUG):
+        for track in tracks:
+            logger.debug("Adding {} to mass scrobble request.".format(track))
+    body = encode_scrobbles(tracks, api_key, api_secret, session_key)
 
-    logger.info("Attempting mass scroble for {} tracks!".format(len(tracks)))
-    parameters = {
-        "method": "track.scrobble",
-        "api_key": api_key,
-        "sk": session_key,
-    }
+    response = make_request(url, body, True, deadline, _response_format)
+    if response is None:
+        logger.warn(
+            "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
+                num_tracks=len(tracks)
+            )
+        )
+        return [], [], list(tracks)
+    error = response_error(response)
+    if error is not None:
+        # Last.FM doesn't always send an error status along with an error
+        raise transport.HTTPStatusError(200, "failed", error)
+
+    codes = ignored_codes(response)
+    if codes is None or len(codes) != len(tracks):
+        # Can't tell which ones were ignored, so go by the totals
+        accepted = accepted_count(response)
+        if accepted > 0:
+            logger.info("Scrobbles accepted: {}".format(accepted))
+            logger.info("Mass scrobbling was a success!")
+            return list(tracks), [], []
+        logger.warn(
+            "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
+                num_tracks=len(tracks)
+            )
+        )
+        return [], [], list(tracks)
 
-    max_scrobbles = (
-        MAX_TRACKS_PER_SCROBBLE
-        if len(tracks) > MAX_TRACKS_PER_SCROBBLE
-        else len(tracks)
-    )
+    accepted, ignored, retry = [], [], []
+    for track, code in zip(tracks, codes):
+        if code == 0:
+            accepted.append(track)
+            continue
 
-    for i in range(0, max_scrobbles):
-        logger.debug("Adding {} to mass scrobble request.".format(tracks[i]))
-        # We probably don't need to use the extract_single's, here, but better safe than sorry!
-        parameters["track[{}]".format(i)] = extract_single(tracks[i], "track")
-        parameters["artist[{}]".format(i)] = extract_single(tracks[i], "artist")
-        parameters["timestamp[{}]".format(i)] = extract_single(tracks[i], "timestamp")
-
-        if "album" in tracks[i]:
-            parameters["album[{}]".format(i)] = extract_single(tracks[i], "album")
-        if "trackNumber" in tracks[i]:
-            parameters["trackNumber[{}]".format(i)] = extract_single(
-                tracks[i], "trackNumber"
+        reason = IGNORED_REASONS.get(code, "unknown reason {}".format(code))
+        if code in RETRYABLE_IGNORED_CODES or code not in IGNORED_REASONS:
+            retry.append(track)
+            logger.warn(
+                "Last.FM ignored {} ({}), queuing for later.".format(
+                    track["track"], reason
+                )
+            )
+        else:
+            ignored.append(track)
+            logger.warn(
+                "Last.FM ignored {} ({}), dropping it.".format(track["track"], reason)
             )
 
-        if "albumArtist" in tracks[i]:
-            parameters["albumArtist[{}]".format(i)] = extract_single(tracks[i], "albumArtist")
-        if "duration" in tracks[i]:
-            parameters["duration[{}]".format(i)] = extract_single(tracks[i], "duration")
+    logger.info(
+        "Scrobbles accepted: {}, ignored: {}, to retry: {}".format(
+            len(accepted), len(ignored), len(retry)
+        )
+    )
+    if accepted:
+        logger.info("Mass scrobbling was a success!")
+    return accepted, ignored, retry
 
-    parameters["api_sig"] = sign_signature(parameters, api_secret)
 
-    try:
-        xml = make_request(url, parameters, True)
-        if xml:
-            logger.debug("Received response: [{}] - {}".format(xml.tag, xml.attrib))
-            logger.debug(
-                "XML Received for mass scrobble: {}".format(
-                    ET.tostring(xml, encoding="utf-8").decode("utf-8")
-                )
-            )
+def is_rejected_batch(error):
+    """
+    Did Last.FM turn a request down because of what was in it (see REJECTED_BATCH_ERRORS), rather than because of
+    a problem on its end?
 
-            accepted = int(xml.find("scrobbles").get("accepted"))
-            if accepted > 0:
-                logger.info("Scrobbles accepted: {}".format(accepted))
-                logger.info("Mass scrobbling was a success!")
+    :param error: The error Last.FM responded with
+    :type error: yams.transport.HTTPStatusError
+    :rtype: bool
+    """
 
-                return accepted, max_scrobbles
-            else:
-                logger.warn(
-                    "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
-                        num_tracks=len(tracks)
-                    )
-                )
+    if isinstance(error, transport.RateLimited) or error.status_code >= 500:
+        return False
+
+    match = LASTFM_ERROR_PATTERN.search(error.text or "")
+    if match is not None:
+        return int(match.group(1) or match.group(2)) in REJECTED_BATCH_ERRORS
+    return error.status_code == 400
+
+
+def describe_error(error):
+    """ Returns Last.FM's own description of an error it responded with, if it gave one """
+
+    match = LASTFM_ERROR_PATTERN.search(error.text or "")
+    if match is None:
+        return str(error)
+    try:
+        if match.group(1) is not None:
+            message = ET.fromstring(error.text).find("error").text
         else:
+            message = json.loads(error.text).get("message")
+    except Exception:
+        message = None
+    return "error {}: {}".format(
+        match.group(1) or match.group(2), (message or "").strip() or error.reason
+    )
+
+
+def bisect_rejected_batch(
+    tracks, url, api_key, api_secret, session_key, deadline=None, dead_letters=None
+):
+    """
+    Find the scrobbles that got a batch rejected (see is_rejected_batch), by sending it again in halves, then
+    halves of whichever halves are still rejected, and so on. Scrobbles Last.FM rejects on their own are given up
+    on, and quarantined in the dead letters file if we're keeping one, while everything else in the batch is sent
+    as usual.
+
+    A scrobble is only ever quarantined once something else in the batch has got through: if BISECTION_GIVE_UP
+    scrobbles have been rejected on their own and nothing has, the request itself must be wrong (not the scrobbles),
+    so the whole batch is left to try again later.
+
+    :param tracks: The rejected batch, as Scrobble objects or scrobble dicts
+    :param url: The base Last.FM API url
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+    :param deadline: How long each request can take, request_deadline seconds if not given
+    :param dead_letters: Where to quarantine the rejected scrobbles, if anywhere
+
+    :type tracks: list
+    :type url: str
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+    :type deadline: yams.transport.Deadline
+    :type dead_letters: yams.deadletter.DeadLetters
+
+    :return: Returns a tuple of (accepted scrobbles, scrobbles Last.FM will never accept, scrobbles to try again)
+    :rtype: (list,list,list)
+    """
+
+    logger.warn(
+        "Last.FM rejected a batch of {} scrobbles, looking for the bad ones...".format(
+            len(tracks)
+        )
+    )
+
+    accepted, ignored, retry, rejected = [], [], [], []
+    reason = None
+    got_through = False
+    # The whole batch has already been sent, so start with its halves
+    middle = len(tracks) // 2
+    halves = (
+        [list(tracks[middle:]), list(tracks[:middle])] if middle else [list(tracks)]
+    )
+
+    while halves:
+        if not got_through and len(rejected) >= BISECTION_GIVE_UP:
             logger.warn(
-                "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
-                    num_tracks=len(tracks)
-                )
+                "Last.FM rejected every scrobble we tried on its own, the request must be wrong. Queuing for later."
             )
+            for half in halves:
+                retry += half
+            retry += rejected
+            return accepted, ignored, retry
+
+        half = halves.pop()
+        try:
+            result = post_scrobbles(
+                half, url, api_key, api_secret, session_key, deadline
+            )
+        except transport.HTTPStatusError as e:
+            if not is_rejected_batch(e):
+                logger.debug("Error: {}".format(e))
+                retry += half
+            elif len(half) == 1:
+                rejected += half
+                reason = describe_error(e)
+            else:
+                # The first half's tried first
+                middle = len(half) // 2
+                halves += [half[middle:], half[:middle]]
+            continue
+        except Exception as e:
+            logger.debug("Error: {}".format(e))
+            retry += half
+            continue
+
+        got_through = True
+        accepted += result[0]
+        ignored += result[1]
+        retry += result[2]
+
+    if rejected and not got_through:
+        retry += rejected
+    elif rejected:
+        for track in rejected:
+            logger.warn("Last.FM rejected {} ({})".format(track["track"], reason))
+        if dead_letters is not None:
+            dead_letters.add(rejected, reason)
+        ignored += rejected
+    return accepted, ignored, retry
+
+
+def scrobble_tracks(
+    tracks, url, api_key, api_secret, session_key, deadline=None, dead_letters=None
+):
+    """
+    Attempts to scrobble multiple tracks at once to Last.FM, and sorts them by what Last.FM made of each one (see
+    IGNORED_REASONS). If Last.FM rejects the whole batch because of what's in it, the scrobbles to blame are found
+    and set aside (see bisect_rejected_batch), so they can't hold up the rest of the cache.
+
+    :param tracks: The list of failed scrobbles, as Scrobble objects or scrobble dicts
+    :param url: The base Last.FM API url
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+    :param deadline: How long the request can take, request_deadline seconds if not given
+    :param dead_letters: Where to quarantine scrobbles Last.FM rejects, if anywhere
+
+    :type tracks: list
+    :type url: str
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+    :type deadline: yams.transport.Deadline
+    :type dead_letters: yams.deadletter.DeadLetters
+
+    :return: Returns a tuple of (accepted scrobbles, scrobbles Last.FM will never accept, scrobbles to try again).
+    Only the first MAX_TRACKS_PER_SCROBBLE tracks are sent, the rest aren't in any of them. If the request failed,
+    every track sent is to be tried again.
+    :rtype: (list,list,list)
+    """
+
+    # Sanity check
+    if len(tracks) < 1:
+        logger.debug("Failed sanity check for scrobble tracks")
+        return [], [], []
+
+    logger.info("Attempting mass scroble for {} tracks!".format(len(tracks)))
+    submitted = list(tracks[:MAX_TRACKS_PER_SCROBBLE])
+
+    try:
+        return post_scrobbles(
+            submitted, url, api_key, api_secret, session_key, deadline
+        )
+    except transport.HTTPStatusError as e:
+        if is_rejected_batch(e):
+            return bisect_rejected_batch(
+                submitted,
+                url,
+                api_key,
+                api_secret,
+                session_key,
+                deadline,
+                dead_letters,
+            )
+        logger.warn(
+            "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
+                num_tracks=len(tracks)
+            )
+        )
+        logger.debug("Error: {}".format(e))
+    except transport.RequestTimeout as e:
+        logger.warn(
+            "Timed out scrobbling {num_tracks} tracks, queuing for later.".format(
+                num_tracks=len(tracks)
+            )
+        )
+        logger.debug("Error: {}".format(e))
     except Exception as e:
         logger.warn(
             "Failed to scrobble {num_tracks} tracks, queuing for later.".format(
@@ -460,14 +888,229 @@ def scrobble_tracks(tracks, url, api_key, api_secret, session_key):
         )
         logger.debug("Error: {}".format(e))
 
-    return 0, 0
+    return [], [], submitted
+
+
+def triage_cache_if_due(cache):
+    """
+    Triage the whole cache if it hasn't been for CACHE_TRIAGE_INTERVAL seconds (see ScrobbleCache.triage)
+
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :type cache: yams.cache.ScrobbleCache
+
+    :return: False if the cache isn't ready to be submitted from just yet
+    :rtype: bool
+    """
+
+    if time.time() - cache.last_triage > CACHE_TRIAGE_INTERVAL:
+        if cache.triage() is None:
+            logger.debug("Scrobbles cache isn't ready to be triaged yet, will retry.")
+            return False
+    return True
+
+
+def submit_cached_scrobbles(
+    cache,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    recent=None,
+    deadline=None,
+    dead_letters=None,
+):
+    """
+    Try to submit the oldest batch of scrobbles in the cache, removing the ones Last.FM accepted (or will never
+    accept) from it. Scrobbles that Last.FM has recently accepted already are removed without being sent again.
+
+    Before the first batch (and every CACHE_TRIAGE_INTERVAL seconds after that), the whole cache is triaged, so we
+    don't waste requests on scrobbles Last.FM can never accept.
+
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :param url: The base Last.FM API url
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+    :param recent: The recently accepted scrobbles, if we're keeping track of them
+    :param deadline: How long the submission can take, request_deadline seconds if not given
+    :param dead_letters: Where to quarantine scrobbles Last.FM rejects, if anywhere
+
+    :type cache: yams.cache.ScrobbleCache
+    :type url: str
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+    :type recent: yams.recent.RecentScrobbles
+    :type deadline: yams.transport.Deadline
+    :type dead_letters: yams.deadletter.DeadLetters
+    """
+
+    if not triage_cache_if_due(cache):
+        return
+
+    batch = cache.pending(MAX_TRACKS_PER_SCROBBLE)
+    if len(batch) < 1:
+        return
+
+    tracks = batch
+    skipped = []
+    if recent is not None:
+        tracks = [track for track in batch if track not in recent]
+        skipped = [track for track in batch if track in recent]
+        if len(tracks) < len(batch):
+            logger.info(
+                "Skipping {} cached scrobbles that have already been submitted.".format(
+                    len(batch) - len(tracks)
+                )
+            )
+        if len(tracks) < 1:
+            cache.truncate(len(batch))
+            return
+
+    accepted, ignored, _ = scrobble_tracks(
+        tracks, url, api_key, api_secret, session_key, deadline, dead_letters
+    )
+    if recent is not None and accepted:
+        recent.add(accepted)
+    # Only the scrobbles Last.FM asked us to send again (or didn't get) stay queued
+    done = skipped + accepted + ignored
+    if done:
+        cache.remove(done)
+    cache.release()
+
+
+def drain_cached_scrobbles(
+    cache,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    recent=None,
+    concurrency=DRAIN_CONCURRENCY,
+    deadline=None,
+    partial_batches=True,
+    dead_letters=None,
+):
+    """
+    Drain a large backlog from the cache, keeping up to 'concurrency' batches in flight at once (within the rate limit,
+    see yams.transport). Keeps going until the cache is empty, nothing's getting through, or we run out of time.
+    Throughput and the time left to go are logged as we go.
+
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :param url: The base Last.FM API url
+    :param api_key: Your API key
+    :param api_secret: Your API secret (given to you when you got your API key)
+    :param session_key: Your Last.FM session key
+    :param recent: The recently accepted scrobbles, if we're keeping track of them
+    :param concurrency: How many batches to send at once
+    :param deadline: How long the whole drain can take, drain_deadline seconds if not given
+    :param partial_batches: Send the last few scrobbles, even if they don't fill a batch?
+    :param dead_letters: Where to quarantine scrobbles Last.FM rejects, if anywhere
+
+    :type cache: yams.cache.ScrobbleCache
+    :type url: str
+    :type api_key: str
+    :type api_secret: str
+    :type session_key: str
+    :type recent: yams.recent.RecentScrobbles
+    :type concurrency: int
+    :type deadline: yams.transport.Deadline
+    :type partial_batches: bool
+    :type dead_letters: yams.deadletter.DeadLetters
+
+    :return: The number of scrobbles removed from the cache
+    :rtype: int
+    """
+
+    if not triage_cache_if_due(cache):
+        return 0
+
+    deadline = deadline or transport.Deadline.for_drain()
+    start = time.time()
+    drained = 0
+
+    def submit(batch):
+        return scrobble_tracks(
+            batch,
+            url,
+            api_key,
+            api_secret,
+            session_key,
+            deadline.operation(),
+            dead_letters,
+        )
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="yams-drain") as pool:
+        while not deadline.expired:
+            scrobbles = cache.pending(concurrency * MAX_TRACKS_PER_SCROBBLE)
+            if not scrobbles:
+                break
+
+            done = []
+            tracks = scrobbles
+            if recent is not None:
+                tracks = [track for track in scrobbles if track not in recent]
+                done = [track for track in scrobbles if track in recent]
+            if not partial_batches:
+                tracks = tracks[: len(tracks) - len(tracks) % MAX_TRACKS_PER_SCROBBLE]
+
+            batches = [
+                tracks[i : i + MAX_TRACKS_PER_SCROBBLE]
+                for i in range(0, len(tracks), MAX_TRACKS_PER_SCROBBLE)
+            ]
+            # Each batch takes a copy of our context along, so e.g. log messages still say which player it's for
+            results = [
+                pool.submit(contextvars.copy_context().run, submit, batch)
+                for batch in batches
+            ]
+            accepted = []
+            for result in results:
+                batch_accepted, batch_ignored, _ = result.result()
+                accepted += batch_accepted
+                done += batch_ignored
+
+            if recent is not None and accepted:
+                recent.add(accepted)
+            done += accepted
+            cache.remove(done)
+            cache.release()
+            drained += len(done)
+
+            remaining = len(cache)
+            elapsed = time.time() - start
+            rate = drained / elapsed if elapsed > 0 else 0
+            logger.info(
+                "Drained {} scrobbles in {}s ({} scrobbles/s), {} left{}".format(
+                    drained,
+                    format(elapsed, ".1f"),
+                    format(rate, ".1f"),
+                    remaining,
+                    ", about {}s to go".format(format(remaining / rate, ".0f"))
+                    if rate > 0 and remaining > 0
+                    else "",
+                )
+            )
+
+            # Nothing (more) to send, or nothing's getting through
+            if not done:
+                break
+
+    return drained
 
 
 def scrobble_track(
-    track_info, status, timestamp, url, api_key, api_secret, session_key
+    track_info,
+    status,
+    timestamp,
+    url,
+    api_key,
+    api_secret,
+    session_key,
+    recent=None,
+    deadline=None,
 ):
     """
-    Scrobble your track with Last.FM
+    Scrobble your track with Last.FM. If Last.FM has recently accepted this same play, nothing is sent.
 
     :param track_info: The track's info from mpd
     :param status: A dictionary containing the mpd player status
@@ -476,6 +1119,8 @@ def scrobble_track(
     :param api_key: Your API key
     :param api_secret: Your API secret (given to you when you got your API key)
     :param session_key: Your Last.FM session key
+    :param recent: The recently accepted scrobbles, if we're keeping track of them
+    :param deadline: How long the scrobble can take, request_deadline seconds if not given
 
     :type track_info: dict
     :type status: dict
@@ -484,8 +1129,20 @@ def scrobble_track(
     :type api_key: str
     :type api_secret: str
     :type session_key: str
+    :type recent: yams.recent.RecentScrobbles
+    :type deadline: yams.transport.Deadline
     """
 
+    if recent is not None:
+        scrobble = make_scrobble(track_info, status, timestamp=timestamp)
+        if scrobble in recent:
+            logger.info(
+                "{} has already been scrobbled, not scrobbling it again.".format(
+                    scrobble["track"]
+                )
+            )
+            return True
+
     logger.info("Scrobbling!")
     parameters = make_scrobble(
         track_info,
@@ -498,23 +1155,45 @@ def scrobble_track(
     )
 
     try:
-        xml = make_request(url, parameters, True)
+        response = make_request(url, parameters, True, deadline, _response_format)
+        if response is not None and response_error(response) is not None:
+            logger.error("Last.FM turned the scrobble request down.")
+            logger.debug("Error: {}".format(response_error(response)))
+            response = None
+    except transport.RequestTimeout as e:
+        logger.error("The scrobble request timed out.")
+        logger.debug("Error: {}".format(e))
+        response = None
     except Exception as e:
         logger.error("Something went wrong with the scrobble request.")
         logger.debug("Error: {}".format(e))
-        xml = False
-
-    if xml:
-        logger.info(
-            "Scrobbles accepted: {}".format(xml.find("scrobbles").get("accepted"))
-        )
-        logger.info("Scrobbling was a success!")
+        response = None
 
-        logger.debug(
-            "XML Received for scrobble: {}".format(
-                ET.tostring(xml, encoding="utf-8").decode("utf-8")
+    codes = ignored_codes(response) if response is not None else None
+    code = codes[0] if codes else 0
+    if code != 0:
+        reason = IGNORED_REASONS.get(code, "unknown reason {}".format(code))
+        if code in RETRYABLE_IGNORED_CODES or code not in IGNORED_REASONS:
+            logger.warn(
+                "Last.FM ignored {} ({}), queuing for later.".format(
+                    track_info["title"], reason
+                )
             )
-        )
+            return False
+        else:
+            # No use queuing it, it'll never be accepted
+            logger.warn(
+                "Last.FM ignored {} ({}), dropping it.".format(
+                    track_info["title"], reason
+                )
+            )
+            return True
+
+    if response is not None:
+        logger.info("Scrobbles accepted: {}".format(accepted_count(response)))
+        logger.info("Scrobbling was a success!")
+        if recent is not None:
+            recent.add([scrobble])
         return True
 
     logger.warn(
@@ -525,54 +1204,119 @@ def scrobble_track(
     return False
 
 
-def truncate_pending_scrobbles_list(count, scrobbles, path_to_cache):
+class TrackInfo:
+    """
+    What we need to know about a track MPD's playing, worked out once when it starts rather than on every check: its
+    tags, whether it can be scrobbled at all, and its scrobble (without a timestamp)
     """
-    Removes 'count' number of scrobbles from the current cached list and then writes to disk if necessary.
 
-    :param count: The number of scrobbles to remove
-    :param scrobbles: The list of cached scrobbles to remove from
-    :param path_to_cache: The path to the cached scrobbles file, if a write to disk is necessary
+    __slots__ = ("song", "title", "artist", "album", "scrobbleable", "scrobble")
 
-    :type count: int
-    :type scrobbles: list
-    :type path_to_cache: str
+    def __init__(self, song, status):
+        self.song = song
+        self.title = extract_single(song, "title")
+        self.artist = extract_single(song, "artist")
+        self.album = extract_single(song, "album")
+        self.scrobbleable = is_track_scrobbleable(song, status)
+        self.scrobble = make_scrobble(song, status) if self.scrobbleable else None
 
-    :return: The truncated list of scrobbles, or an empty list (if the count to remove was larger than the length of the scrobbles list)
-    :rtype: list
+
+class TrackCache:
     """
+    The details of the last few tracks MPD has played (see TrackInfo), keyed by their songid and the version of the
+    playlist, so we only need to fetch (and parse) a track's tags when a different track starts or the playlist's
+    been changed. Least recently played first out.
 
-    if count >= len(scrobbles):
-        logger.debug(
-            "Removing all ({}/{}) scrobbles from cache".format(count, len(scrobbles))
-        )
+    Tracks are only cached while MPD's playing (or paused) them: when it's stopped it still reports the songid, but
+    not the duration, so a track would be cached as one that can't be scrobbled.
+    """
 
-        if os.path.exists(path_to_cache):
-            logger.debug("Removing scrobble cache: {}".format(path_to_cache))
-            os.remove(path_to_cache)
+    def __init__(self, size=TRACK_CACHE_SIZE):
+        self.size = size
+        self._tracks = OrderedDict()
 
-        return []
-    else:
-        scrobbles = scrobbles[count:]
-        logger.debug(
-            "Removed {} scrobbles from cache, {} left to submit.".format(
-                count, len(scrobbles)
-            )
+    @staticmethod
+    def key(status):
+        """ Returns the key for the track in the given player status, None if nothing's playing """
+
+        if "songid" not in status:
+            return None
+        return status["songid"], status.get("playlist")
+
+    def get(self, status):
+        key = self.key(status)
+        if key not in self._tracks:
+            return None
+        self._tracks.move_to_end(key)
+        return self._tracks[key]
+
+    @staticmethod
+    def cacheable(status):
+        """ Does the given player status tell us everything about the track that TrackInfo works out? """
+
+        return status.get("state") in ("play", "pause") and (
+            "duration" in status or "time" in status
         )
-        save_failed_scrobbles_to_disk(path_to_cache, scrobbles)
 
-        return scrobbles
+    def put(self, status, track):
+        key = self.key(status)
+        if key is None or not self.cacheable(status):
+            return
+        self._tracks[key] = track
+        self._tracks.move_to_end(key)
+        while len(self._tracks) > self.size:
+            self._tracks.popitem(last=False)
 
 
-def print_song_info(client):
+def mpd_player_state(client, tracks=None):
+    """
+    Fetch the player status and the current track from MPD. Given a track cache, only the status is fetched if the
+    track's in it. Otherwise both are fetched in one go (as a command list), so it takes a single round trip, and
+    both are from the same moment - never the status of one track and the info of the next.
+
+    :param client: The MPD client object
+    :param tracks: The tracks we've already fetched, if we're keeping track of them
+
+    :type client: mpd.MPDClient
+    :type tracks: TrackCache
+
+    :return: The player status and current track
+    :rtype: (dict,TrackInfo)
+    """
+
+    if tracks is not None:
+        status = client.status()
+        track = tracks.get(status)
+        if track is not None:
+            return status, track
+
+    client.command_list_ok_begin()
+    client.status()
+    client.currentsong()
+    status, song = client.command_list_end()
+
+    track = TrackInfo(song, status)
+    if tracks is not None:
+        tracks.put(status, track)
+    return status, track
+
+
+def print_song_info(client, status=None, song=None):
     """
     Print a song's playback information
 
     :param client: The MPD client object
+    :param status: The player status, fetched from MPD if not given
+    :param song: The current track, fetched from MPD if not given
+
     :type client: mpd.MPDClient
+    :type status: dict
+    :type song: dict
     """
 
-    song = client.currentsong()
-    status = client.status()
+    if status is None or song is None:
+        status, track = mpd_player_state(client)
+        song = track.song
 
     # Storing duration info in "time" is deprecated, as per the mpd spec,
     # however some servers (namely mopidy) still do this. Bad mopidy, bad.
@@ -601,30 +1345,32 @@ def print_song_info(client):
         )
 
 
-def mpd_wait_for_play(client):
+def mpd_wait_for_play(client, tracks=None):
     """
     Block and wait for mpd to switch to the "play" action. Will continue blocking if the play action is not a valid, scrobbleable track.
 
     :param client: The MPD client object
+    :param tracks: The tracks we've already fetched, if we're keeping track of them
+
     :type client: mpd.MPDClient
+    :type tracks: TrackCache
 
-    :return: True when client is set to play - blocks otherwise
-    :rtype: bool
+    :return: The player status and current track from mpd when client is set to play - blocks otherwise. None if something went wrong.
+    :rtype: (dict,TrackInfo)
     """
 
     # These need to be out here as there is an external try/catch block checking to see if we hit a connection error, and handle that gracefully
-    status = client.status()
-    song = client.currentsong()
+    status, track = mpd_player_state(client, tracks)
 
     try:
         state = status["state"]
 
         in_suitable_state = state == "play"
-        appropriate_track = is_track_scrobbleable(song, status)
+        appropriate_track = track.scrobbleable
 
         # Prevents us from printing song info if we're not switching tracks
         if in_suitable_state and appropriate_track:
-            return True
+            return status, track
 
         while not in_suitable_state or not appropriate_track:
 
@@ -639,24 +1385,71 @@ def mpd_wait_for_play(client):
             )  # handle changes
 
             # The state has now changed
-            status = client.status()
-            song = client.currentsong()
+            status, track = mpd_player_state(client, tracks)
             state = status["state"]
 
             in_suitable_state = state == "play"
-            appropriate_track = is_track_scrobbleable(song, status)
+            appropriate_track = track.scrobbleable
 
             logger.info("Received state: {}".format(state))
 
-        print_song_info(client)
-        return True
+        print_song_info(client, status, track.song)
+        return status, track
 
     except Exception as e:
         logger.exception(
             "Something went wrong waiting on MPD's Idle event: {}".format(e)
         )
 
-    return False
+    return None
+
+
+def interrupt_idle(client):
+    """
+    Send MPD a noidle straight down the client's socket, so an idle() blocking in another thread returns
+
+    :param client: The MPD client object, waiting on idle()
+    :type client: mpd.MPDClient
+    """
+
+    try:
+        sock = socket.socket(fileno=os.dup(client.fileno()))
+    except Exception as e:
+        logger.debug("Could not interrupt MPD's idle: {}".format(e))
+        return
+    try:
+        sock.sendall(b"noidle\n")
+    except OSError as e:
+        logger.debug("Could not interrupt MPD's idle: {}".format(e))
+    finally:
+        sock.close()
+
+
+def mpd_idle(client, timeout=None):
+    """
+    Block until MPD's player changes (a new track, a seek, a pause...), or 'timeout' seconds have gone by
+
+    :param client: The MPD client object
+    :param timeout: How long to wait at most (in seconds), forever if not given
+
+    :type client: mpd.MPDClient
+    :type timeout: float
+
+    :return: The subsystems that changed, empty if we timed out
+    :rtype: list
+    """
+
+    if timeout is None:
+        return client.idle("player")
+
+    # Interrupt the idle when time's up (MPD ignores a noidle that comes in too late)
+    timer = threading.Timer(timeout, interrupt_idle, args=(client,))
+    timer.daemon = True
+    timer.start()
+    try:
+        return client.idle("player")
+    finally:
+        timer.cancel()
 
 
 def is_track_scrobbleable(song, status):
@@ -697,22 +1490,69 @@ def is_track_scrobbleable(song, status):
     return scrobbleable
 
 
-def mpd_watch_track(client, session, config):
+def real_time_scrobble_threshold(reported_start_time, song_duration, threshold):
+    """
+    Work out the scrobble threshold for a track we started watching late, when using real time
+
+    :param reported_start_time: Where the track was (in seconds) when we started watching it
+    :param song_duration: How long the track is (in seconds)
+    :param threshold: The usual scrobble threshold (a percentage)
+
+    :type reported_start_time: float
+    :type song_duration: float
+    :type threshold: float
+
+    :return: The threshold (a percentage) adjusted for the late start
+    :rtype: float
+    """
+
+    # So, if we're using real time, and our default_scrobble_threshold is less than 50, we need to do some math:
+    # Assuming we might have started late, how many real world seconds do I have to listen to to be able to say I've listened to N% (where N = default_scrobble_threshold) of music? Take that amount of seconds and turn it into its own threshold (added to the aforementioned late start time) and baby you've got a stew going
+    scrobble_threshold = (
+        (
+            reported_start_time
+            + (song_duration - reported_start_time) * (threshold / 100)
+        )
+        / song_duration
+    ) * 100
+    logger.info(
+        "While the scrobbling threshold would normally be {}%, since we're starting at {}s (out of {}s, a.k.a. {}%), it's now {}%".format(
+            threshold,
+            format(reported_start_time, ".1f"),
+            format(song_duration, ".1f"),
+            format(reported_start_time / song_duration * 100, ".1f"),
+            format(scrobble_threshold, ".1f"),
+        )
+    )
+    logger.debug(
+        "(start + ( total - start ) * threshold) / total =  ( {0} + ( {1} - {0} ) * {2} ) / {1}".format(
+            reported_start_time, song_duration, threshold,
+        )
+    )
+    return scrobble_threshold
+
+
+def mpd_watch_track(client, config, cache, uploader=None):
     """
-    The main loop - watches MPD and tracks the currently playing song. Sends Last.FM updates if need be.
+    The main loop - watches MPD and tracks the currently playing song. Decides when to send Last.FM updates, and
+    leaves sending them to the uploader, so we never wait on the network.
 
     :param client: The MPD client object
-    :param session: The Session key for last.fm
     :param config: The global config file
+    :param cache: The queue of scrobbles waiting to be (re)submitted
+    :param uploader: The uploader that sends our updates. Without one, scrobbles are only queued in the cache.
+
+    With the 'idle' watch_mode (see WATCH_MODES), MPD isn't polled: we wait on its idle command, and work out when
+    the track will be due to be watched or scrobbled to wake up just then. Seeking, pausing or changing tracks wakes
+    us up too, and we plan again from there.
 
     :type client: mpd.MPDClient
-    :type session: str
     :type config: dict
+    :type cache: yams.cache.ScrobbleCache
+    :type uploader: yams.uploader.Uploader
     """
 
     base_url = config["base_url"]
-    api_key = config["api_key"]
-    api_secret = config["api_secret"]
 
     use_real_time = config["real_time"]
     allow_scrobble_same_song_twice_in_a_row = config[
@@ -723,46 +1563,33 @@ def mpd_watch_track(client, session, config):
     scrobble_min_time = config["scrobble_min_time"]
     watch_threshold = config["watch_threshold"]
     update_interval = config["update_interval"]
+    watch_mode = config["watch_mode"] if "watch_mode" in config else "poll"
 
     current_watched_track = ""
     reject_track = ""
-
-    cache_file_path = config["cache_file"]
-
-    failed_scrobbles = read_failed_scrobbles_from_disk(cache_file_path)
+    tracks = TrackCache()
 
     # For use with `use_real_time` parameter
     start_time = time.time()
     reported_start_time = 0
 
-    last_rescrobble_attempt_time = time.time()
-
-    while mpd_wait_for_play(client):
+    while True:
+        playing = mpd_wait_for_play(client, tracks)
+        if not playing:
+            break
+        status, track = playing
+        song = track.song
 
         scrobble_threshold = default_scrobble_threshold
 
-        status = client.status()
         state = status["state"]
 
-        # Check to see if we've got any tracks to scrobble (this is on a timer just in case)
-        if time.time() - last_rescrobble_attempt_time > SCROBBLE_RETRY_INTERVAL:
-            if len(failed_scrobbles) > 0:
-                accepted_count, submitted_count = scrobble_tracks(
-                    failed_scrobbles, base_url, api_key, api_secret, session
-                )
-                if accepted_count > 0:
-                    failed_scrobbles = truncate_pending_scrobbles_list(
-                        submitted_count, failed_scrobbles, cache_file_path
-                    )
-            last_rescrobble_attempt_time = time.time()
-
         if state == "play":
 
             # The time since the song claims it started, that we've been able to measure in python
             real_time_elapsed = reported_start_time + (time.time() - start_time)
             # logger.info(real_time_elapsed)
 
-            song = client.currentsong()
             # logger.debug("Song info: {}".format(song))
 
             # Here we check if duration is in the track_info and use it if we can
@@ -776,9 +1603,8 @@ def mpd_watch_track(client, session, config):
                 else status["time"].split(":")[-1]
             )
 
-            title = extract_single(song, "title")
-            artist = extract_single(song, "artist")
-            album = extract_single(song, "album")
+            title = track.title
+            artist = track.artist
 
             elapsed = float(status["elapsed"])
 
@@ -803,31 +1629,8 @@ def mpd_watch_track(client, session, config):
                 reported_start_time = elapsed - watch_threshold
 
                 if use_real_time:
-                    # So, if we're using real time, and our default_scrobble_threshold is less than 50, we need to do some math:
-                    # Assuming we might have started late, how many real world seconds do I have to listen to to be able to say I've listened to N% (where N = default_scrobble_threshold) of music? Take that amount of seconds and turn it into its own threshold (added to the aforementioned late start time) and baby you've got a stew going
-                    scrobble_threshold = (
-                        (
-                            reported_start_time
-                            + (song_duration - reported_start_time)
-                            * (default_scrobble_threshold / 100)
-                        )
-                        / song_duration
-                    ) * 100
-                    logger.info(
-                        "While the scrobbling threshold would normally be {}%, since we're starting at {}s (out of {}s, a.k.a. {}%), it's now {}%".format(
-                            default_scrobble_threshold,
-                            format(reported_start_time, ".1f"),
-                            format(song_duration, ".1f"),
-                            format(reported_start_time / song_duration * 100, ".1f"),
-                            format(scrobble_threshold, ".1f"),
-                        )
-                    )
-                    logger.debug(
-                        "(start + ( total - start ) * threshold) / total =  ( {0} + ( {1} - {0} ) * {2} ) / {1}".format(
-                            reported_start_time,
-                            song_duration,
-                            default_scrobble_threshold,
-                        )
+                    scrobble_threshold = real_time_scrobble_threshold(
+                        reported_start_time, song_duration, default_scrobble_threshold
                     )
                 else:
                     scrobble_threshold = default_scrobble_threshold
@@ -849,7 +1652,12 @@ def mpd_watch_track(client, session, config):
                         ),
                     )
                 )
-                now_playing(song, status, base_url, api_key, api_secret, session)
+                if uploader is not None:
+                    uploader.now_playing(song, status)
+                    # Have a connection ready for when the track's due to be scrobbled
+                    transport.schedule_prewarm(
+                        base_url, (song_duration * scrobble_threshold / 100) - elapsed,
+                    )
 
             elif current_watched_track == title:
 
@@ -867,44 +1675,12 @@ def mpd_watch_track(client, session, config):
                         >= (scrobble_threshold / 100) * song_duration
                     ):
                         current_watched_track = ""
-                        if len(failed_scrobbles) < 1:
-                            # If we don't have any pending scrobbles, try to scrobble this
-                            scrobble_succeeded = scrobble_track(
-                                song,
-                                status,
-                                start_time,
-                                base_url,
-                                api_key,
-                                api_secret,
-                                session,
-                            )
-                            # If we've failed, add it to the list for future scrobbles (and write it to the disk)
-                            if not scrobble_succeeded:
-                                failed_scrobble = make_scrobble(
-                                    song, status, timestamp=start_time
-                                )
-                                if failed_scrobble not in failed_scrobbles:
-                                    failed_scrobbles.append(failed_scrobble)
-                                    save_failed_scrobbles_to_disk(
-                                        cache_file_path, failed_scrobbles
-                                    )
+                        if uploader is not None:
+                            uploader.scrobble(song, status, start_time)
                         else:
-                            # If we have failed and queued up scrobbles, add this one to the list and try to do them all in one go
-                            failed_scrobble = make_scrobble(
-                                song, status, timestamp=start_time
-                            )
-                            if failed_scrobble not in failed_scrobbles:
-                                failed_scrobbles.append(failed_scrobble)
-                                save_failed_scrobbles_to_disk(
-                                    cache_file_path, failed_scrobbles
-                                )
-                            accepted_count, submitted_count = scrobble_tracks(
-                                failed_scrobbles, base_url, api_key, api_secret, session
-                            )
-                            if accepted_count > 0:
-                                failed_scrobbles = truncate_pending_scrobbles_list(
-                                    submitted_count, failed_scrobbles, cache_file_path
-                                )
+                            # Someone else is uploading from this cache, queue it for them
+                            cache.append(dict(track.scrobble, timestamp=start_time))
+                            logger.info("Queued {} for the uploader.".format(title))
 
                         if not allow_scrobble_same_song_twice_in_a_row:
                             reject_track = title
@@ -916,7 +1692,107 @@ def mpd_watch_track(client, session, config):
                             )
                         )
 
-            time.sleep(update_interval)
+            if watch_mode != "idle":
+                time.sleep(update_interval)
+                continue
+
+            # Work out when there'll next be something to do, going by where the track is now
+            real_time_elapsed = reported_start_time + (time.time() - start_time)
+            wake_in = None
+            if current_watched_track == title:
+                # When it's due to be scrobbled
+                wake_in = max(
+                    song_duration * scrobble_threshold / 100 - elapsed,
+                    scrobble_min_time - elapsed,
+                    (scrobble_threshold / 100) * song_duration - real_time_elapsed
+                    if use_real_time
+                    else 0,
+                )
+            elif (
+                title != ""
+                and title != reject_track
+                and percent_elapsed < scrobble_threshold
+            ):
+                # When it's due to be watched
+                wake_in = max(
+                    watch_threshold - elapsed, watch_threshold - real_time_elapsed
+                )
+
+            if wake_in is not None:
+                wake_in = max(0, wake_in) + IDLE_WAKE_MARGIN
+                logger.debug(
+                    "Waiting on MPD for up to {}s".format(format(wake_in, ".1f"))
+                )
+            else:
+                logger.debug("Nothing to do until MPD's player changes")
+            changes = mpd_idle(client, wake_in)
+            if changes:
+                logger.debug("Received event in subsystem: {}".format(changes))
+
+
+def upload_spooled_scrobbles(session, config, cache, recent=None, dead_letters=None):
+    """
+    The uploader's main loop - submits the scrobbles other instances of yams queue in a shared spool directory.
+    Scrobbles are sent in full batches of MAX_TRACKS_PER_SCROBBLE wherever possible (several at once, see
+    drain_cached_scrobbles): a partial batch is only sent once 'spool_upload_interval' seconds have gone by since the
+    last upload.
+
+    :param session: The Session key for last.fm
+    :param config: The global config file
+    :param cache: The shared spool, locked for uploading
+    :param recent: The recently accepted scrobbles, so we never submit one twice
+    :param dead_letters: Where to quarantine scrobbles Last.FM rejects, if anywhere
+
+    :type session: str
+    :type config: dict
+    :type cache: yams.spooldir.SpoolDirectory
+    :type recent: yams.recent.RecentScrobbles
+    :type dead_letters: yams.deadletter.DeadLetters
+    """
+
+    base_url = config["base_url"]
+    api_key = config["api_key"]
+    api_secret = config["api_secret"]
+    upload_interval = config["spool_upload_interval"]
+    concurrency = (
+        config["drain_concurrency"]
+        if "drain_concurrency" in config
+        else DRAIN_CONCURRENCY
+    )
+
+    last_upload_time = 0
+
+    while True:
+        queued = len(cache)
+        if not transport.is_available(base_url):
+            # Last.FM's down, wait for the backoff to run out
+            pass
+        elif queued >= MAX_TRACKS_PER_SCROBBLE:
+            drain_cached_scrobbles(
+                cache,
+                base_url,
+                api_key,
+                api_secret,
+                session,
+                recent,
+                concurrency,
+                partial_batches=False,
+                dead_letters=dead_letters,
+            )
+            last_upload_time = time.time()
+        elif queued > 0 and time.time() - last_upload_time >= upload_interval:
+            submit_cached_scrobbles(
+                cache,
+                base_url,
+                api_key,
+                api_secret,
+                session,
+                recent,
+                dead_letters=dead_letters,
+            )
+            last_upload_time = time.time()
+
+        time.sleep(SCROBBLE_RETRY_INTERVAL)
 
 
 def find_session(session_file_path, base_url, api_key, api_secret, interactive=True):
@@ -1041,12 +1917,67 @@ def connect_to_mpd(host, port):
     return client
 
 
+def run_bulk_command(command, session, config):
+    """
+    Run a bulk import or export (in the foreground), then exit
+
+    :param command: Either 'import' or 'export'
+    :param session: The Session key for last.fm
+    :param config: The global config file
+
+    :type command: str
+    :type session: str
+    :type config: dict
+    """
+
+    from yams.bulk import export_scrobbles, import_scrobbles
+
+    cache = open_scrobble_cache(config)
+    recent = open_recent_scrobbles(config)
+    dead_letters = open_dead_letters(config)
+    status = 0
+
+    try:
+        if command == "export":
+            export_scrobbles(cache, config["bulk_file"], config["bulk_format"])
+        else:
+            import_scrobbles(
+                config["bulk_file"],
+                session,
+                config,
+                cache,
+                recent,
+                config["bulk_format"],
+                dead_letters,
+            )
+    except KeyboardInterrupt:
+        logger.info("Keyboard Interrupt detected - Exiting!")
+        status = 1
+    except Exception as e:
+        logger.error("Could not {} scrobbles: {}".format(command, e))
+        status = 1
+
+    cache.close()
+    exit(status)
+
+
+def handle_sigterm(signum, frame):
+    """ Treat SIGTERM (e.g. from 'yams -k') like a Keyboard Interrupt, so we get a chance to shut down cleanly """
+
+    logger.info("Received SIGTERM")
+    raise KeyboardInterrupt()
+
+
 def cli_run():
     """ Command line entrypoint """
 
     session = ""
     config = configure()
     logger.info("Starting up YAMS v{}".format(yams.VERSION))
+    transport.configure_timeouts(config)
+    transport.configure_rate_limit(config)
+    transport.configure_circuit_breaker(config)
+    configure_response_format(config)
 
     session_file = config["session_file"]
     base_url = config["base_url"]
@@ -1056,45 +1987,162 @@ def cli_run():
     mpd_host = config["mpd_host"]
     mpd_port = config["mpd_port"]
 
+    command = config["command"] if "command" in config else None
+
+    # Exporting only needs the cache
+    if command == "export":
+        run_bulk_command(command, "", config)
+
+    keep_alive = config["keep_alive"] if "keep_alive" in config else False
+    uploading_spool = config["uploader"] if "uploader" in config else False
+    # Several MPD instances can be watched from this one process (see player_configs), each with its own session
+    players = [] if command or uploading_spool else player_configs(config)
+
     interactive_shell_available = (
         not config["non_interactive"] if "non_interactive" in config else True
     )
-    user_name, session = find_session(
-        session_file, base_url, api_key, api_secret, interactive_shell_available
-    )
+    if not players:
+        user_name, session = find_session(
+            session_file, base_url, api_key, api_secret, interactive_shell_available
+        )
 
-    keep_alive = config["keep_alive"] if "keep_alive" in config else False
+    if command == "import":
+        run_bulk_command(command, session, config)
+
+    sessions = []
+    for player in players:
+        logger.info("Finding the Last.FM session for {}...".format(player["name"]))
+        sessions.append(
+            find_session(
+                player["session_file"],
+                player["base_url"],
+                player["api_key"],
+                player["api_secret"],
+                interactive_shell_available,
+            )[1]
+        )
 
-    client = None
+    engine = config["engine"] if "engine" in config else "sync"
+    if engine not in ENGINES:
+        logger.warn(
+            "Unknown engine '{}', expected one of: {}. Using sync.".format(
+                engine, ", ".join(ENGINES)
+            )
+        )
+        engine = "sync"
 
-    try:
-        client = connect_to_mpd(mpd_host, mpd_port)
-    except Exception as e:
-        logger.error(
-            "Could not connect to MPD! Check that your config is correct and that MPD is running. Error: {}".format(
-                e
+    # Players are always watched on one event loop, whatever engine they're set to
+    ignored_engines = sorted(
+        set(str(player["engine"]) for player in players if "engine" in player)
+        - {"asyncio"}
+    )
+    if ignored_engines:
+        logger.warn(
+            "Players always run on the asyncio engine, ignoring engine: {}. Set engine to asyncio to silence this warning.".format(
+                ", ".join(ignored_engines)
             )
         )
-        if not keep_alive:
-            exit(1)
-        else:
-            logger.warn("Not dying, will keep alive and wait for MPD.")
+
+    client = None
+
+    # The uploader never talks to MPD, and players connect to theirs once they're running
+    if not uploading_spool and not players:
+        try:
+            client = connect_to_mpd(mpd_host, mpd_port)
+        except Exception as e:
+            logger.error(
+                "Could not connect to MPD! Check that your config is correct and that MPD is running. Error: {}".format(
+                    e
+                )
+            )
+            if not keep_alive:
+                exit(1)
+            else:
+                logger.warn("Not dying, will keep alive and wait for MPD.")
 
     # If we're allowed to daemonize, do so
     if "no_daemon" in config:
         if not config["no_daemon"]:
             fork(config)
             remove_log_stream_of_type(logging.StreamHandler)
+            # Don't share connections with the process we forked from
+            transport.reset_session()
         # NOTE: Comment these 2 lines out if you don't want YAMS to save a pid file in no-daemon mode
         elif config["no_daemon"] and "pid_file" in config:
             save_pid(config["pid_file"])
 
+    if players:
+        from yams.aio import Player, run_players
+
+        # Every player has a cache of its own, opened after forking too
+        players = [
+            Player(
+                player,
+                player_session,
+                open_scrobble_cache(player),
+                open_recent_scrobbles(player),
+                open_dead_letters(player),
+            )
+            for player, player_session in zip(players, sessions)
+        ]
+        signal.signal(signal.SIGTERM, handle_sigterm)
+        run_players(players)
+
+        for player in players:
+            player.close()
+        logger.info("Shutting down...")
+        exit(0)
+
+    # Opened after forking, as the cache may run its own background threads
+    cache = open_scrobble_cache(config)
+    recent = open_recent_scrobbles(config)
+    dead_letters = open_dead_letters(config)
+    # Make sure the cache gets flushed to disk when we're killed
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    # Shared caches are drained by a separate uploader process ('yams --uploader'), so we don't send anything at all
+    uploader = None
+    if not cache.shared and not uploading_spool and engine == "sync":
+        from yams.uploader import Uploader
+
+        uploader = Uploader(session, config, cache, recent, dead_letters)
+        uploader.start()
+
+    if uploading_spool:
+        if not cache.shared or not cache.lock_uploader():
+            logger.error(
+                "Can't upload: the uploader needs the 'spooldir' cache_backend, and only one uploader can run per spool directory."
+            )
+            cache.close()
+            exit(1)
+
+        try:
+            upload_spooled_scrobbles(session, config, cache, recent, dead_letters)
+        except KeyboardInterrupt:
+            logger.info("Keyboard Interrupt detected - Exiting!")
+
+        cache.close()
+        logger.info("Shutting down...")
+        exit(0)
+
+    if engine == "asyncio":
+        from yams.aio import run_engine
+
+        # The asyncio engine makes connections of its own
+        if client:
+            client.close()
+        run_engine(session, config, cache, recent, dead_letters)
+
+        cache.close()
+        logger.info("Shutting down...")
+        exit(0)
+
     RECONNECT_TIMEOUT = 10
 
     while True:
         if client:
             try:
-                mpd_watch_track(client, session, config)
+                mpd_watch_track(client, config, cache, uploader)
             # User is in no-daemon mode and wants to exit
             except KeyboardInterrupt:
                 print("")
@@ -1131,6 +2179,10 @@ def cli_run():
     except:
         logger.warn("Could not gracefully disconnect from Mpd...")
 
+    if uploader is not None:
+        uploader.stop()
+    cache.close()
+
     logger.info("Shutting down...")
     exit(0)
 
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import sqlite3
+import time
+
+from yams.cache import LOAD_CHUNK_SIZE, ScrobbleCache, scrobble_identity
+from yams.record import Scrobble
+
+logger = logging.getLogger("yams")
+
+STATE_PENDING = 0
+STATE_IN_FLIGHT = 1
+STATE_ACKED = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scrobbles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artist TEXT NOT NULL,
+    track TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    state INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL,
+    scrobble TEXT NOT NULL,
+    UNIQUE (artist, track, timestamp)
+);
+CREATE INDEX IF NOT EXISTS scrobbles_by_state ON scrobbles (state, timestamp);
+"""
+
+
+class ScrobbleSpool(ScrobbleCache):
+    """
+    A scrobbles cache backed by SQLite. Scrobbles move from pending, to in-flight (while a batch is being submitted),
+    to acked. Batches are picked straight off the (state, timestamp) index and duplicates are rejected by a unique key
+    on (artist, track, timestamp), so nothing but the in-flight batch is ever held in memory.
+
+    Acked scrobbles are kept around for 'acked_retention' seconds, so that re-queuing a scrobble that has already been
+    submitted is a no-op. In write-behind mode, changes are committed when the spool is flushed.
+    """
+
+    def __init__(self, path, acked_retention=1209600, **write_options):
+        super().__init__(**write_options)
+        self.path = path
+        self.acked_retention = acked_retention
+        self._in_flight = []
+
+        # Transactions are managed by hand, see _transaction()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+        with self._transaction():
+            # Anything left in flight was never acknowledged, we must have died mid-submission
+            self._db.execute(
+                "UPDATE scrobbles SET state = ? WHERE state = ?",
+                (STATE_PENDING, STATE_IN_FLIGHT),
+            )
+            expired = self._db.execute(
+                "DELETE FROM scrobbles WHERE state = ? AND updated < ?",
+                (STATE_ACKED, time.time() - self.acked_retention),
+            ).rowcount
+
+        logger.info(
+            "Opened scrobble spool {}: {} pending scrobbles ({} expired acked scrobbles removed)".format(
+                path, len(self), expired
+            )
+        )
+
+    @contextmanager
+    def _transaction(self, changes=1):
+        """
+        Make a change to the spool atomically. The change is committed right away, or on the next flush in
+        write-behind mode.
+        """
+
+        with self._lock:
+            if not self._db.in_transaction:
+                self._db.execute("BEGIN")
+            self._db.execute("SAVEPOINT change")
+            try:
+                yield
+            except Exception:
+                self._db.execute("ROLLBACK TO change")
+                raise
+            finally:
+                self._db.execute("RELEASE change")
+            self._changed(changes)
+
+    def _write_out(self):
+        if self._db.in_transaction:
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def _row(scrobble):
+        return scrobble_identity(scrobble) + (
+            time.time(),
+            json.dumps(dict(scrobble), separators=(",", ":")),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM scrobbles WHERE state IN (?, ?)",
+                (STATE_PENDING, STATE_IN_FLIGHT),
+            ).fetchone()[0]
+
+    def __contains__(self, scrobble):
+        with self._lock:
+            return (
+                self._db.execute(
+                    "SELECT 1 FROM scrobbles WHERE artist = ? AND track = ? AND timestamp = ? AND state != ?",
+                    scrobble_identity(scrobble) + (STATE_ACKED,),
+                ).fetchone()
+                is not None
+            )
+
+    def __iter__(self):
+        # Page through the queue, so it's never all in memory (or the lock held) at once
+        last = (-1, -1)
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT timestamp, id, scrobble FROM scrobbles WHERE state != ? AND (timestamp, id) > (?, ?) ORDER BY timestamp, id LIMIT ?",
+                    (STATE_ACKED,) + last + (LOAD_CHUNK_SIZE,),
+                ).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield Scrobble.from_dict(json.loads(row[2]))
+            last = rows[-1][:2]
+
+    def append(self, scrobble):
+        with self._transaction():
+            return (
+                self._db.execute(
+                    "INSERT OR IGNORE INTO scrobbles (artist, track, timestamp, updated, scrobble) VALUES (?, ?, ?, ?, ?)",
+                    self._row(scrobble),
+                ).rowcount
+                > 0
+            )
+
+    def extend(self, scrobbles):
+        with self._transaction():
+            return self._db.executemany(
+                "INSERT OR IGNORE INTO scrobbles (artist, track, timestamp, updated, scrobble) VALUES (?, ?, ?, ?, ?)",
+                (self._row(scrobble) for scrobble in scrobbles),
+            ).rowcount
+
+    def pending(self, count):
+        with self._transaction():
+            rows = self._db.execute(
+                "SELECT id, scrobble FROM scrobbles WHERE state = ? ORDER BY timestamp LIMIT ?",
+                (STATE_PENDING, count),
+            ).fetchall()
+
+            ids = [row[0] for row in rows]
+            self._set_state(ids, STATE_IN_FLIGHT)
+            self._in_flight.extend(ids)
+
+            return [Scrobble.from_dict(json.loads(row[1])) for row in rows]
+
+    def truncate(self, count):
+        with self._transaction(count):
+            acked = self._in_flight[:count]
+            # Nothing handed out? Then just acknowledge the oldest pending scrobbles
+            if len(acked) < count:
+                acked += [
+                    row[0]
+                    for row in self._db.execute(
+                        "SELECT id FROM scrobbles WHERE state = ? ORDER BY timestamp LIMIT ?",
+                        (STATE_PENDING, count - len(acked)),
+                    )
+                ]
+
+            self._set_state(acked, STATE_ACKED)
+            self._set_state(self._in_flight[count:], STATE_PENDING)
+            self._in_flight = []
+
+            logger.debug(
+                "Acknowledged {} scrobbles in spool, {} left to submit.".format(
+                    len(acked), len(self)
+                )
+            )
+
+    def remove(self, scrobbles):
+        with self._transaction():
+            ids = []
+            for scrobble in scrobbles:
+                row = self._db.execute(
+                    "SELECT id FROM scrobbles WHERE artist = ? AND track = ? AND timestamp = ? AND state != ?",
+                    scrobble_identity(scrobble) + (STATE_ACKED,),
+                ).fetchone()
+                if row is not None:
+                    ids.append(row[0])
+
+            self._set_state(ids, STATE_ACKED)
+            removed = set(ids)
+            self._in_flight = [
+                scrobble_id
+                for scrobble_id in self._in_flight
+                if scrobble_id not in removed
+            ]
+            return len(ids)
+
+    def release(self):
+        with self._transaction():
+            self._set_state(self._in_flight, STATE_PENDING)
+            self._in_flight = []
+
+    def _triage(self, oldest):
+        # Duplicates can't get in and batches already come out in timestamp order, so there's only deleting to do
+        with self._transaction():
+            removed = Counter(
+                expired=self._db.execute(
+                    "DELETE FROM scrobbles WHERE state = ? AND timestamp < ?",
+                    (STATE_PENDING, oldest),
+                ).rowcount,
+                malformed=self._db.execute(
+                    "DELETE FROM scrobbles WHERE state = ? AND (artist = '' OR track = '')",
+                    (STATE_PENDING,),
+                ).rowcount,
+            )
+        return +removed
+
+    def _set_state(self, ids, state):
+        """ Move the scrobbles with the given ids into a new state. Must be called with the lock held. """
+
+        now = time.time()
+        self._db.executemany(
+            "UPDATE scrobbles SET state = ?, updated = ? WHERE id = ?",
+            ((state, now, scrobble_id) for scrobble_id in ids),
+        )
+
+    def close(self):
+        with self._lock:
+            self.release()
+            super().close()
+            self._db.close()
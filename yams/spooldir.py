@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import fcntl
+import hashlib
+import heapq
+import json
+import logging
+import os
+import threading
+
+from yams.cache import ScrobbleCache, scrobble_identity, triage_scrobbles
+from yams.record import Scrobble, as_scrobble
+
+logger = logging.getLogger("yams")
+
+SPOOL_RECORD_EXTENSION = ".json"
+SPOOL_LOCK_FILE = "uploader.lock"
+# Records that turn out not to be scrobbles at all are moved here, rather than deleted
+SPOOL_BAD_DIRECTORY = "bad"
+
+
+class SpoolDirectory(ScrobbleCache):
+    """
+    A scrobbles cache that can be shared by several YAMS processes, e.g. one per MPD instance on the same host.
+    Each scrobble is a file of its own: it's written to 'tmp' and then linked into 'new', so other processes never see
+    a partial record and queuing the same scrobble twice fails atomically (the file name is derived from the
+    scrobble's identity, timestamp first, so listing 'new' gives the queue in order).
+
+    Any number of processes can queue scrobbles, but only the uploader (see lock_uploader()) takes them back out.
+    In write-behind mode records aren't fsync'd before they're linked in.
+    """
+
+    # Drained by a separate uploader process, the processes queuing scrobbles never submit them themselves
+    shared = True
+
+    def __init__(self, path, **write_options):
+        super().__init__(**write_options)
+        self.path = path
+        self._tmp = os.path.join(path, "tmp")
+        self._new = os.path.join(path, "new")
+        self._lock_file = None
+        # The names of the records handed out by pending(), oldest first
+        self._in_flight = []
+        self._sequence = 0
+
+        os.makedirs(self._tmp, exist_ok=True)
+        os.makedirs(self._new, exist_ok=True)
+
+        logger.info(
+            "Opened scrobble spool directory {}: {} pending scrobbles".format(
+                path, len(self)
+            )
+        )
+
+    @staticmethod
+    def _record_name(scrobble):
+        artist, track, timestamp = scrobble_identity(scrobble)
+        digest = hashlib.sha1(
+            "{}\0{}\0{}".format(artist, track, timestamp).encode("utf-8")
+        ).hexdigest()[:20]
+        return "{:012d}-{}{}".format(timestamp, digest, SPOOL_RECORD_EXTENSION)
+
+    def _records(self):
+        return [
+            name
+            for name in os.listdir(self._new)
+            if name.endswith(SPOOL_RECORD_EXTENSION)
+        ]
+
+    def _read_record(self, name):
+        """
+        Returns the scrobble in a record, or None if it's gone or can't be read right now (it's left where it is, to
+        try again later)
+
+        :raises ValueError: If the record isn't a scrobble
+        """
+
+        try:
+            with open(os.path.join(self._new, name), "rb") as record:
+                data = record.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warn("Could not read spooled scrobble {}: {}".format(name, e))
+            return None
+
+        try:
+            return Scrobble.from_dict(json.loads(data.decode("utf-8")))
+        except TypeError as e:
+            # e.g. it's missing an artist
+            raise ValueError(e)
+
+    def _read_record_or_quarantine(self, name):
+        """ Like _read_record, but moves records that aren't scrobbles out of the queue rather than raising """
+
+        try:
+            return self._read_record(name)
+        except ValueError as e:
+            self._quarantine(name, e)
+            return None
+
+    def _quarantine(self, name, error):
+        """ Move a record that isn't a scrobble out of the queue, into 'bad' """
+
+        bad = os.path.join(self.path, SPOOL_BAD_DIRECTORY)
+        try:
+            os.makedirs(bad, exist_ok=True)
+            os.replace(os.path.join(self._new, name), os.path.join(bad, name))
+            logger.warn(
+                "Spooled scrobble {} is malformed ({}), moved it to {}".format(
+                    name, error, bad
+                )
+            )
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warn(
+                "Spooled scrobble {} is malformed ({}), but couldn't be moved to {}: {}".format(
+                    name, error, bad, e
+                )
+            )
+
+    def _remove_records(self, names):
+        for name in names:
+            try:
+                os.remove(os.path.join(self._new, name))
+            except FileNotFoundError:
+                pass
+
+    def lock_uploader(self):
+        """
+        Try to become the spool's uploader. Only one process can hold this lock at a time, it's released when the
+        spool is closed (or the process dies).
+
+        :return: True if we're the uploader, False if another process already is
+        :rtype: bool
+        """
+
+        with self._lock:
+            if self._lock_file is not None:
+                return True
+
+            lock_file = open(os.path.join(self.path, SPOOL_LOCK_FILE), "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+
+            self._lock_file = lock_file
+            return True
+
+    def __len__(self):
+        return len(self._records())
+
+    def __contains__(self, scrobble):
+        return os.path.exists(os.path.join(self._new, self._record_name(scrobble)))
+
+    def __iter__(self):
+        for name in sorted(self._records()):
+            scrobble = self._read_record_or_quarantine(name)
+            if scrobble is not None:
+                yield scrobble
+
+    def append(self, scrobble):
+        scrobble = as_scrobble(scrobble)
+        name = self._record_name(scrobble)
+
+        with self._lock:
+            self._sequence += 1
+            tmp_path = os.path.join(
+                self._tmp,
+                "{}.{}.{}.{}".format(
+                    name, os.getpid(), threading.get_ident(), self._sequence
+                ),
+            )
+
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as record:
+                json.dump(scrobble.to_dict(), record, separators=(",", ":"))
+                if not self.write_behind:
+                    record.flush()
+                    os.fsync(record.fileno())
+            # link() won't replace an existing record, so this is where duplicates get turned away
+            os.link(tmp_path, os.path.join(self._new, name))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def pending(self, count):
+        with self._lock:
+            batch = []
+            for name in heapq.nsmallest(count, self._records()):
+                scrobble = self._read_record_or_quarantine(name)
+                if scrobble is not None:
+                    batch.append(scrobble)
+                    self._in_flight.append(name)
+            return batch
+
+    def truncate(self, count):
+        with self._lock:
+            acked = self._in_flight[:count]
+            # Nothing handed out? Then just acknowledge the oldest records
+            if len(acked) < count:
+                acked += heapq.nsmallest(
+                    count - len(acked),
+                    [name for name in self._records() if name not in acked],
+                )
+            self._remove_records(acked)
+            self._in_flight = []
+
+            logger.debug(
+                "Removed {} scrobbles from spool directory, {} left to submit.".format(
+                    len(acked), len(self)
+                )
+            )
+
+    def remove(self, scrobbles):
+        with self._lock:
+            names = [self._record_name(scrobble) for scrobble in scrobbles]
+            removed = [
+                name for name in names if os.path.exists(os.path.join(self._new, name))
+            ]
+            self._remove_records(removed)
+            self._in_flight = [name for name in self._in_flight if name not in names]
+            return len(removed)
+
+    def release(self):
+        with self._lock:
+            self._in_flight = []
+
+    def _triage(self, oldest):
+        # Listing 'new' already gives us the queue in timestamp order, so there's only removing to do. Records that
+        # can't be read right now are left alone, only those that aren't scrobbles are moved out of the way.
+        records = []
+        malformed = 0
+        for name in self._records():
+            try:
+                scrobble = self._read_record(name)
+            except ValueError as e:
+                self._quarantine(name, e)
+                malformed += 1
+                continue
+            if scrobble is not None:
+                records.append((name, scrobble))
+
+        scrobbles, removed = triage_scrobbles(
+            (scrobble for name, scrobble in records), oldest
+        )
+        kept = set(id(scrobble) for scrobble in scrobbles)
+        self._remove_records(
+            [name for name, scrobble in records if id(scrobble) not in kept]
+        )
+
+        if malformed:
+            removed["malformed"] += malformed
+        return removed
+
+    def close(self):
+        with self._lock:
+            super().close()
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
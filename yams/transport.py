@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from yams.backoff import Backoff, CircuitBreaker
+from yams.ratelimit import LASTFM_RATE_LIMIT_ERROR, TokenBucket
+
+logger = logging.getLogger("yams")
+
+# How many connections to Last.FM to keep open at once
+HTTP_POOL_SIZE = 4
+# Connections that have been idle for longer than this (in seconds) may well have been closed by the other end
+HTTP_IDLE_TIMEOUT = 30
+# How long (in seconds) before a request is expected to open its connection
+PREWARM_LEAD_TIME = 5
+
+# Default timeouts (in seconds): for connecting, for each read from the socket, and for a whole logical operation
+# (e.g. a scrobble) or a drain of the scrobbles cache, which may each take several requests
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 15
+OPERATION_DEADLINE = 30
+DRAIN_DEADLINE = 120
+
+# Last.FM asks for no more than 5 requests a second, on average
+RATE_LIMIT = 5
+RATE_LIMIT_BURST = 10
+
+# After this many failed requests in a row, stop sending requests to the endpoint for a while (see CircuitBreaker),
+# backing off for BACKOFF_BASE seconds the first time, doubling up to BACKOFF_MAX seconds if it stays down
+CIRCUIT_BREAKER_THRESHOLD = 3
+BACKOFF_BASE = 10
+BACKOFF_MAX = 1800
+
+# Matched against the raw bytes, in either response format (XML or JSON)
+RATE_LIMIT_ERROR_PATTERN = re.compile(
+    r'<error\s+code="{0}"|"error"\s*:\s*{0}\b'.format(LASTFM_RATE_LIMIT_ERROR).encode()
+)
+
+_timeouts = {
+    "connect": CONNECT_TIMEOUT,
+    "read": READ_TIMEOUT,
+    "operation": OPERATION_DEADLINE,
+    "drain": DRAIN_DEADLINE,
+}
+
+_rate_limiter = TokenBucket(RATE_LIMIT, RATE_LIMIT_BURST)
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+_circuit_breaker_settings = {
+    "threshold": CIRCUIT_BREAKER_THRESHOLD,
+    "base": BACKOFF_BASE,
+    "max": BACKOFF_MAX,
+}
+
+_session = None
+_session_lock = threading.Lock()
+_last_used = 0
+# owner -> the prewarm scheduled for it (see schedule_prewarm)
+_prewarm_timers = {}
+_prewarm_lock = threading.Lock()
+
+
+class TransportError(Exception):
+    """ A request to Last.FM didn't get a usable response """
+
+    pass
+
+
+class RequestTimeout(TransportError):
+    """ A request (or the operation it was part of) ran out of time. Worth retrying. """
+
+    pass
+
+
+class HTTPStatusError(TransportError):
+    """ Last.FM answered a request with an HTTP error """
+
+    def __init__(self, status_code, reason, text=""):
+        super().__init__("Status: {}, Reason: {}".format(status_code, reason))
+        self.status_code = status_code
+        self.reason = reason
+        self.text = text
+
+
+class RateLimited(HTTPStatusError):
+    """ Last.FM says we're making too many requests. Worth retrying, but more slowly. """
+
+    pass
+
+
+class CircuitOpen(TransportError):
+    """ The endpoint's been failing, so we're not sending it anything until it's time to try again """
+
+    pass
+
+
+class Deadline:
+    """
+    A time budget for a logical operation, e.g. a scrobble or a drain of the scrobbles cache. Every request made as
+    part of the operation gets the connect and read timeouts, cut down to whatever's left of the budget.
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = _timeouts["operation"] if seconds is None else seconds
+        self.expires = time.time() + self.seconds
+
+    @classmethod
+    def for_drain(cls):
+        """ The budget for draining the scrobbles cache, batch after batch """
+        return cls(_timeouts["drain"])
+
+    def operation(self):
+        """
+        Returns the budget for one operation within this one (e.g. a batch within a drain): the usual budget, or
+        whatever's left of this one if that's less
+
+        :rtype: Deadline
+        """
+        return Deadline(min(_timeouts["operation"], self.remaining()))
+
+    def remaining(self):
+        return max(0, self.expires - time.time())
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self):
+        """
+        Returns the (connect, read) timeouts for the next request
+
+        :raises RequestTimeout: If the budget's been spent
+        :rtype: (float,float)
+        """
+
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise RequestTimeout(
+                "Ran out of time after {}s".format(format(self.seconds, ".0f"))
+            )
+        return (
+            min(_timeouts["connect"], remaining),
+            min(_timeouts["read"], remaining),
+        )
+
+
+def configure_timeouts(config):
+    """
+    Set the request timeouts from the config: http_connect_timeout, http_read_timeout, request_deadline and
+    drain_deadline (all in seconds)
+
+    :param config: The YAMS config
+    :type config: dict
+    """
+
+    for key, option in (
+        ("connect", "http_connect_timeout"),
+        ("read", "http_read_timeout"),
+        ("operation", "request_deadline"),
+        ("drain", "drain_deadline"),
+    ):
+        if option in config:
+            _timeouts[key] = config[option]
+
+
+def configure_rate_limit(config):
+    """
+    Set the rate limit for requests to Last.FM from the config: rate_limit requests a second, in bursts of up to
+    rate_limit_burst
+
+    :param config: The YAMS config
+    :type config: dict
+    """
+
+    global _rate_limiter
+
+    _rate_limiter = TokenBucket(
+        config["rate_limit"] if "rate_limit" in config else RATE_LIMIT,
+        config["rate_limit_burst"]
+        if "rate_limit_burst" in config
+        else RATE_LIMIT_BURST,
+    )
+
+
+def configure_circuit_breaker(config):
+    """
+    Set how failing endpoints are backed off from, from the config: circuit_breaker_threshold failures in a row
+    before backing off, for backoff_base seconds at first, up to backoff_max seconds
+
+    :param config: The YAMS config
+    :type config: dict
+    """
+
+    for key, option in (
+        ("threshold", "circuit_breaker_threshold"),
+        ("base", "backoff_base"),
+        ("max", "backoff_max"),
+    ):
+        if option in config:
+            _circuit_breaker_settings[key] = config[option]
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
+
+
+def get_circuit_breaker(url):
+    """
+    Returns the circuit breaker for the endpoint (i.e. the host) the given URL belongs to
+
+    :param url: A URL on the endpoint
+    :type url: str
+    :rtype: yams.backoff.CircuitBreaker
+    """
+
+    endpoint = urlsplit(url).netloc
+    with _circuit_breakers_lock:
+        if endpoint not in _circuit_breakers:
+            _circuit_breakers[endpoint] = CircuitBreaker(
+                endpoint,
+                _circuit_breaker_settings["threshold"],
+                Backoff(
+                    _circuit_breaker_settings["base"], _circuit_breaker_settings["max"]
+                ),
+            )
+        return _circuit_breakers[endpoint]
+
+
+def is_available(url):
+    """
+    Would a request to the given URL be sent right now, or is its endpoint being backed off from?
+
+    :param url: The URL we'd send a request to
+    :type url: str
+    :rtype: bool
+    """
+
+    return get_circuit_breaker(url).ready()
+
+
+def rate_limit_available():
+    """ Returns how many requests to Last.FM could be made right now, without waiting for the rate limiter """
+
+    return _rate_limiter.available()
+
+
+def is_rate_limited(response):
+    """
+    Does this response say we're making too many requests?
+
+    :param response: A response from Last.FM
+    :type response: requests.Response
+    :rtype: bool
+    """
+
+    return response.status_code == 429 or (
+        RATE_LIMIT_ERROR_PATTERN.search(response.content) is not None
+    )
+
+
+def get_session():
+    """
+    Returns the HTTP session all Last.FM requests go through, so they share a pool of keep-alive connections rather
+    than paying for a new connection every time
+
+    :rtype: requests.Session
+    """
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def reset_session():
+    """ Close every pooled connection, e.g. after forking, so the new process starts with connections of its own """
+
+    global _session
+
+    with _prewarm_lock:
+        for timer in _prewarm_timers.values():
+            timer.cancel()
+        _prewarm_timers.clear()
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def request(method, url, deadline=None, api_call=True, **kwargs):
+    """
+    Send a request through the pooled session. API calls wait for the rate limiter first, and aren't sent at all
+    while the endpoint's circuit breaker is open: timeouts, connection errors and server errors count as failures.
+
+    :param method: The HTTP method, e.g. 'GET' or 'POST'
+    :param url: The URL to send the request to
+    :param deadline: The operation this request is part of, a new one (of request_deadline seconds) if not given
+    :param api_call: Is this a Last.FM API call, rather than e.g. a prewarm?
+    :param kwargs: Anything else requests.Session.request takes
+
+    :type method: str
+    :type url: str
+    :type deadline: Deadline
+    :type api_call: bool
+
+    :raises RequestTimeout: If the request timed out, or the operation's out of time
+    :raises RateLimited: If Last.FM says we're making too many requests
+    :raises CircuitOpen: If we're backing off from the endpoint
+    :rtype: requests.Response
+    """
+
+    global _last_used
+
+    deadline = deadline or Deadline()
+    # Checked before the rate limiter, so requests that won't be sent don't use up its tokens
+    breaker = get_circuit_breaker(url) if api_call else None
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpen(
+            "Not sending {} {}, backing off for another {}s".format(
+                method, url, format(breaker.retry_in(), ".0f")
+            )
+        )
+
+    try:
+        if api_call and not _rate_limiter.acquire(deadline.remaining()):
+            raise RequestTimeout(
+                "Ran out of time waiting for the rate limiter to let {} {} through".format(
+                    method, url
+                )
+            )
+        timeout = deadline.timeout()
+    except RequestTimeout:
+        if breaker is not None:
+            breaker.release()
+        raise
+
+    start = time.time()
+    healthy = False
+    try:
+        response = get_session().request(method, url, timeout=timeout, **kwargs)
+        healthy = response.status_code < 500
+    except requests.exceptions.Timeout as e:
+        raise RequestTimeout("{} {} timed out: {}".format(method, url, e)) from e
+    finally:
+        _last_used = time.time()
+        logger.debug(
+            "{} {} took {}s".format(method, url, format(_last_used - start, ".3f"))
+        )
+        if breaker is not None:
+            if healthy:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+
+    if api_call:
+        if is_rate_limited(response):
+            _rate_limiter.throttle()
+            raise RateLimited(response.status_code, response.reason, response.text)
+        _rate_limiter.recover()
+    return response
+
+
+def prewarm(url):
+    """
+    Open a connection to the given URL in the background (unless we've got one that's been used recently), so the
+    next request to it doesn't have to wait for the connection to be set up
+
+    :param url: The URL we'll be sending a request to
+    :type url: str
+    """
+
+    if time.time() - _last_used < HTTP_IDLE_TIMEOUT or not is_available(url):
+        return
+
+    def warm_up():
+        try:
+            request("HEAD", url, api_call=False)
+            logger.debug("Opened a connection to {}".format(url))
+        except Exception as e:
+            logger.debug("Could not open a connection to {}: {}".format(url, e))
+
+    threading.Thread(target=warm_up, name="yams-prewarm", daemon=True).start()
+
+
+def schedule_prewarm(url, delay, owner=None):
+    """
+    Open a connection to the given URL in 'delay' seconds (less PREWARM_LEAD_TIME), e.g. just before a track is due
+    to be scrobbled. Replaces the prewarm previously scheduled by the same owner, but not anyone else's.
+
+    :param url: The URL we'll be sending a request to
+    :param delay: How long (in seconds) until we expect to send it
+    :param owner: Who it's for, e.g. the name of the player whose track is due
+
+    :type url: str
+    :type delay: float
+    :type owner: str
+    """
+
+    timer = threading.Timer(max(0, delay - PREWARM_LEAD_TIME), prewarm, args=(url,))
+    timer.daemon = True
+    with _prewarm_lock:
+        previous = _prewarm_timers.pop(owner, None)
+        if previous is not None:
+            previous.cancel()
+        _prewarm_timers[owner] = timer
+    timer.start()
+
+
+def cancel_prewarm(owner=None):
+    """ Cancel the prewarm scheduled by the given owner, if there is one """
+
+    with _prewarm_lock:
+        timer = _prewarm_timers.pop(owner, None)
+    if timer is not None:
+        timer.cancel()
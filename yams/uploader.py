@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+import logging
+import queue
+import threading
+import time
+
+from yams import transport
+from yams.scrobble import (
+    DRAIN_CONCURRENCY,
+    MAX_TRACKS_PER_SCROBBLE,
+    SCROBBLE_RETRY_INTERVAL,
+    drain_cached_scrobbles,
+    make_scrobble,
+    now_playing,
+    scrobble_track,
+    submit_cached_scrobbles,
+)
+
+logger = logging.getLogger("yams")
+
+# Jobs for the uploader
+JOB_NOW_PLAYING = "now_playing"
+JOB_SCROBBLE = "scrobble"
+JOB_STOP = "stop"
+
+# How long (in seconds) the track has to stay the same before we send a now playing update for it
+NOW_PLAYING_SETTLE_TIME = 2
+# How long (in seconds) after sending a now playing update for a track we won't send it again, if we don't know how
+# long the track is
+NOW_PLAYING_RESEND_INTERVAL = 600
+# Now playing updates are skipped if there are scrobbles waiting to go, and fewer requests than this left in the
+# rate limiter's bucket
+NOW_PLAYING_RESERVE = 2
+
+
+class UploadWork:
+    """
+    What an uploader does, without any of the waiting: run the jobs the watcher hands over, send the latest now
+    playing update once it's due, and keep on draining the scrobbles cache - whether or not anything's playing. A
+    backlog of more than one batch is drained several batches at a time (see drain_cached_scrobbles). Uploader runs
+    this on a thread of its own, yams.aio.AsyncUploader as a task on an event loop.
+
+    Now playing updates wait for the track to settle ('now_playing_settle' seconds) first, and only the latest one is
+    sent, if several pile up. The same track isn't sent twice in a row (e.g. after reconnecting to MPD) unless it's
+    been playing for longer than it lasts, and an update gives way to scrobbles if the rate limit is running low (see
+    NOW_PLAYING_RESERVE). While Last.FM is down (see
+    yams.transport.CircuitBreaker) nothing is sent: now playing updates are dropped, scrobbles go straight into the
+    cache, and the cache is retried once the backoff's up.
+
+    Jobs must be run one at a time, but now_playing(), wait_time() and stop() can be called from anywhere.
+    """
+
+    def __init__(self, session, config, cache, recent=None, dead_letters=None):
+        self.session = session
+        self.base_url = config["base_url"]
+        self.api_key = config["api_key"]
+        self.api_secret = config["api_secret"]
+        self.cache = cache
+        self.recent = recent
+        self.dead_letters = dead_letters
+        self.concurrency = (
+            config["drain_concurrency"]
+            if "drain_concurrency" in config
+            else DRAIN_CONCURRENCY
+        )
+
+        self.settle_time = (
+            config["now_playing_settle"]
+            if "now_playing_settle" in config
+            else NOW_PLAYING_SETTLE_TIME
+        )
+
+        # The latest now playing update, (song, status, when it's due), and the last one we sent, (track, when)
+        self._now_playing = None
+        self._now_playing_sent = None
+        self._now_playing_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._last_retry_time = 0
+
+    def now_playing(self, song, status):
+        """ Replace the pending now playing update, it's due once the track's been playing for the settle time """
+
+        with self._now_playing_lock:
+            self._now_playing = (song, status, time.time() + self.settle_time)
+
+    def stop(self):
+        """ Stop sending anything new: scrobbles from here on are just queued in the cache """
+
+        self._stopping.set()
+
+    def wait_time(self):
+        """ Returns how long (in seconds) to wait for a job, before there's something else to do """
+
+        timeout = SCROBBLE_RETRY_INTERVAL
+        with self._now_playing_lock:
+            if self._now_playing is not None:
+                timeout = max(0, min(timeout, self._now_playing[2] - time.time()))
+        return timeout
+
+    def step(self, job, jobs_waiting=False):
+        """
+        Run a job (if there is one), then whatever else is due: the now playing update, and retrying the cache
+
+        :param job: The job to run, or None
+        :param jobs_waiting: Are there more jobs waiting to be run after this one?
+
+        :type job: tuple
+        :type jobs_waiting: bool
+        """
+
+        try:
+            if job is not None:
+                self._run_job(job)
+            self._send_now_playing_if_due(jobs_waiting)
+
+            if (
+                not self._stopping.is_set()
+                and time.time() - self._last_retry_time > SCROBBLE_RETRY_INTERVAL
+                and transport.is_available(self.base_url)
+            ):
+                if len(self.cache) > MAX_TRACKS_PER_SCROBBLE:
+                    drain_cached_scrobbles(
+                        self.cache,
+                        self.base_url,
+                        self.api_key,
+                        self.api_secret,
+                        self.session,
+                        self.recent,
+                        self.concurrency,
+                        dead_letters=self.dead_letters,
+                    )
+                elif len(self.cache) > 0:
+                    submit_cached_scrobbles(
+                        self.cache,
+                        self.base_url,
+                        self.api_key,
+                        self.api_secret,
+                        self.session,
+                        self.recent,
+                        dead_letters=self.dead_letters,
+                    )
+                self._last_retry_time = time.time()
+        except Exception:
+            logger.exception("Something went wrong uploading to Last.FM!")
+
+    def _send_now_playing_if_due(self, jobs_waiting):
+        with self._now_playing_lock:
+            if self._now_playing is None or self._now_playing[2] > time.time():
+                return
+            song, status, _ = self._now_playing
+            self._now_playing = None
+        if self._stopping.is_set():
+            return
+
+        track = make_scrobble(song, status)
+        key = tuple(sorted((field, str(value)) for field, value in track.items()))
+        if self._now_playing_sent is not None and self._now_playing_sent[0] == key:
+            try:
+                resend_interval = float(track["duration"])
+            except (KeyError, ValueError):
+                resend_interval = NOW_PLAYING_RESEND_INTERVAL
+            if time.time() - self._now_playing_sent[1] < resend_interval:
+                logger.debug(
+                    "Already sent now playing for {}, not sending it again.".format(
+                        track["track"]
+                    )
+                )
+                return
+
+        if not transport.is_available(self.base_url):
+            logger.info("Last.FM is unavailable, not sending now playing.")
+        elif (
+            jobs_waiting or len(self.cache) > 0
+        ) and transport.rate_limit_available() < NOW_PLAYING_RESERVE:
+            logger.info("Not sending now playing, saving requests for scrobbles.")
+        else:
+            self._now_playing_sent = (key, time.time())
+            now_playing(
+                song,
+                status,
+                self.base_url,
+                self.api_key,
+                self.api_secret,
+                self.session,
+            )
+
+    def _run_job(self, job):
+        # Now playing updates just wake us up, they're sent once they're due (see _send_now_playing_if_due)
+        if job[0] == JOB_SCROBBLE:
+            song, status, timestamp = job[1:]
+
+            # We're shutting down, or backing off from Last.FM, so don't send it - it'll keep in the cache
+            if self._stopping.is_set() or not transport.is_available(self.base_url):
+                self.cache.append(make_scrobble(song, status, timestamp=timestamp))
+            elif len(self.cache) < 1:
+                # If we don't have any pending scrobbles, try to scrobble this
+                scrobble_succeeded = scrobble_track(
+                    song,
+                    status,
+                    timestamp,
+                    self.base_url,
+                    self.api_key,
+                    self.api_secret,
+                    self.session,
+                    self.recent,
+                )
+                # If we've failed, add it to the list for future scrobbles (and write it to the disk)
+                if not scrobble_succeeded:
+                    self.cache.append(make_scrobble(song, status, timestamp=timestamp))
+            else:
+                # If we have failed and queued up scrobbles, add this one to the list and try to do them all in one go
+                self.cache.append(make_scrobble(song, status, timestamp=timestamp))
+                submit_cached_scrobbles(
+                    self.cache,
+                    self.base_url,
+                    self.api_key,
+                    self.api_secret,
+                    self.session,
+                    self.recent,
+                    dead_letters=self.dead_letters,
+                )
+
+
+class Uploader(threading.Thread):
+    """
+    Makes every request to Last.FM, in the background, so watching MPD never has to wait on the network. The watcher
+    hands over now playing updates and scrobbles (see now_playing() and scrobble()), which are sent in order, by the
+    uploader's own thread (see UploadWork).
+    """
+
+    def __init__(self, session, config, cache, recent=None, dead_letters=None):
+        super().__init__(name="yams-uploader", daemon=True)
+        self.work = UploadWork(session, config, cache, recent, dead_letters)
+        self._jobs = queue.Queue()
+
+    def now_playing(self, song, status):
+        """
+        Send a now playing update for a track, once it's been playing for the settle time (unless another update
+        replaces it before then)
+
+        :param song: The track's info from mpd
+        :param status: A dictionary containing the mpd player status
+
+        :type song: dict
+        :type status: dict
+        """
+
+        self.work.now_playing(song, status)
+        # Wake the uploader up, so it knows when the update's due
+        self._jobs.put_nowait((JOB_NOW_PLAYING,))
+
+    def scrobble(self, song, status, timestamp):
+        """
+        Scrobble a track. If that fails (or there's a backlog to get through first), it's queued in the cache.
+
+        :param song: The track's info from mpd
+        :param status: A dictionary containing the mpd player status
+        :param timestamp: The starting time of the track, as a UTC Unix Timestamp
+
+        :type song: dict
+        :type status: dict
+        :type timestamp: float
+        """
+
+        self._jobs.put_nowait((JOB_SCROBBLE, song, status, timestamp))
+
+    def stop(self):
+        """
+        Stop the uploader, once it's finished whatever it's sending right now. Scrobbles that haven't been sent yet
+        are queued in the cache.
+        """
+
+        self.work.stop()
+        self._jobs.put((JOB_STOP,))
+        self.join()
+
+    def run(self):
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.work.wait_time())
+            except queue.Empty:
+                job = None
+            if job is not None and job[0] == JOB_STOP:
+                return
+            self.work.step(job, not self._jobs.empty())